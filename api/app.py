@@ -1,8 +1,10 @@
 import os
+from urllib.parse import urlparse
 
 import uvicorn
 from fastapi import FastAPI, Depends, Request, HTTPException
 from fastapi.responses import JSONResponse
+from fastapi.staticfiles import StaticFiles
 from pydantic import ValidationError
 from starlette.middleware.cors import CORSMiddleware
 
@@ -96,6 +98,11 @@ datasets.include_router(exports, prefix='/{dataset_id}/exports', tags=['exports'
 # Users ➤ Tasks 🔒 Admin partially (for generator)
 app.include_router(tasks, prefix=f'{PREFIX}/tasks', tags=['tasks'], dependencies=[Depends(logged_user)])
 
+# Stored images, when single node
+if Config.STORAGE_BACKEND == 'local':
+    app.mount(urlparse(Config.STORAGE_LOCAL_URL).path.rstrip('/'),
+              StaticFiles(directory=Config.STORAGE_LOCAL_PATH), name='storage')
+
 
 @app.get('/traceback')
 def traceback_generator():
@@ -1,5 +1,5 @@
 import os
-from typing import Any, List
+from typing import Any, Dict, List, Optional
 
 from fastapi import FastAPI
 from pydantic import AnyHttpUrl, BaseSettings
@@ -20,6 +20,7 @@ class Settings(BaseSettings):
 
     ROOT_PATH: str = os.path.abspath(os.path.join(FastAPI().root_path, os.pardir))
     DATASOURCES_PATH: str = os.path.join(ROOT_PATH, 'api', 'workflows', 'generator', 'datasources')
+    DOWNLOADS_PATH: str = os.path.join(ROOT_PATH, 'api', 'workflows', 'generator', 'downloads')
 
     UI_URL: str = 'https://localhost:5069'
     API_URI: str = 'http://127.0.0.1:4069'
@@ -37,13 +38,17 @@ class Settings(BaseSettings):
             'key': 'coco2014',
             'name': 'COCO 2014',
             'download_url': 'http://images.cocodataset.org/annotations/annotations_trainval2014.zip',
-            'filenames': ['instances_val2014.json', 'instances_train2014.json']
+            'filenames': ['instances_val2014.json', 'instances_train2014.json'],
+            'images_path': os.environ.get('COCO2014_IMAGES_PATH'),  # local copy of the images, if any
+            'images_folders': ['val2014', 'train2014']
         },
         {
             'key': 'coco2017',
             'name': 'COCO 2017',
             'download_url': 'http://images.cocodataset.org/annotations/annotations_trainval2017.zip',
-            'filenames': ['instances_val2017.json', 'instances_train2017.json']
+            'filenames': ['instances_val2017.json', 'instances_train2017.json'],
+            'images_path': os.environ.get('COCO2017_IMAGES_PATH'),  # local copy of the images, if any
+            'images_folders': ['val2017', 'train2017']
         },
     ]
 
@@ -82,10 +87,50 @@ class Settings(BaseSettings):
         }
     }
 
+    STORAGE_BACKEND: str = 's3'  # `s3`, `local` (single node) or `memory` (load tests & benchmarks)
+    STORAGE_LOCAL_PATH: str = os.environ.get('STORAGE_LOCAL_PATH', os.path.join(ROOT_PATH, 'storage'))
+    STORAGE_LOCAL_URL: str = f'{API_URI}/storage/'  # files of `local` storage, served by the API
+    STORAGE_GC_GRACE_PERIOD: int = 24 * 60 * 60  # 1 day, before unused deduplicated objects are deleted
+    STORAGE_GC_INTERVAL: int = 60 * 60  # 1 hour
+
     S3_BUCKET: str = 'dtserverdevbucket'
     S3_KEY: str = os.environ['S3_KEY']
     S3_SECRET: str = os.environ['S3_SECRET']
     S3_LOCATION: AnyHttpUrl = f'http://{S3_BUCKET}.s3.amazonaws.com/'
+    S3_ENDPOINT_URL: Optional[str] = None  # S3 compatible server (MinIO...), AWS when None
+    S3_MAX_POOL_CONNECTIONS: Optional[int] = None  # defaults to the largest pool of threads calling S3
+    S3_MULTIPART_THRESHOLD: int = 8 * 1024 * 1024  # 8 Mo, larger images are uploaded in parallel parts
+    IMAGES_UPLOAD_WORKERS: int = 16  # images of a request uploaded at once
+    IMAGES_INGEST_WORKERS: Optional[int] = None  # processes decoding & compressing uploads, defaults to cpu count
+    IMAGES_UPLOAD_MAX_BYTES: int = 256 * 1024 * 1024  # 256 Mo of files per upload request
+    IMAGES_DUPLICATE_DISTANCE: int = 4  # differing bits of 64 bits dHash, at most, between near duplicate images
+    IMAGE_RENDITIONS: Dict[str, int] = {'thumbnail': 128, 'preview': 384}  # largest side in px, full size is `path`
+    IMAGE_RENDITIONS_FORMAT: str = 'jpg'  # `jpg` or `webp`
+
+    AUGMENTOR_EXECUTOR: str = 'thread'  # `thread` or `process`
+    AUGMENTOR_MAX_WORKERS: Optional[int] = None  # augment & encode stage, defaults to cpu count
+    AUGMENTOR_IO_WORKERS: int = 16  # upload & write stage
+    AUGMENTOR_IO_QUEUE_SIZE: int = 64  # encoded images waiting for upload
+    AUGMENTOR_LABEL_MODE: str = 'geometric'  # `geometric` (box corners) or `raster` (ellipse masks)
+    AUGMENTOR_CACHE_MAX_BYTES: int = 512 * 1024 * 1024  # 512 Mo of decoded originals & masks, per chunk
+    AUGMENTOR_CHUNK_SIZE: int = 500  # samples of a task augmented by one worker
+    TASK_CHECKPOINT_INTERVAL: float = 5  # seconds between two checkpoints of a running task
+
+    DATASOURCE_DOWNLOAD_TIMEOUT: float = 60  # seconds without data before an archive download is resumed
+    DATASOURCE_DOWNLOAD_RETRIES: int = 5
+
+    GENERATOR_MAX_DOWNLOADS: int = 64  # images downloaded or waiting for upload at once
+    GENERATOR_HOST_CONCURRENCY: int = 16  # concurrent requests per remote host
+    GENERATOR_DOWNLOAD_TIMEOUT: float = 30  # seconds
+    GENERATOR_DOWNLOAD_RETRIES: int = 3
+    GENERATOR_DOWNLOAD_BACKOFF: float = 0.5  # seconds before first retry, doubled on each retry
+    GENERATOR_HEDGE_DELAY: float = 1  # seconds without answer before racing the next mirror of an image
+    GENERATOR_MIRROR_COMPRESS: bool = False  # resize images read from a local datasource copy before upload
+    GENERATOR_CACHE_MAX_BYTES: int = 5 * 1024 * 1024 * 1024  # 5 Go of downloaded images, per host
+    RENDER_CACHE_MAX_BYTES: int = 256 * 1024 * 1024  # 256 Mo of rendered virtual images, per process
+    RENDER_MAX_CONCURRENCY: Optional[int] = None  # virtual images rendered at once per process, defaults to cpu count
+    SAMPLE_CACHE_MAX_BYTES: int = 128 * 1024 * 1024  # 128 Mo of pipeline sample previews, per process
+    SAMPLE_CACHE_TTL: int = 10 * 60  # 10 minutes
 
     DB_ENCRYPTION_KEY: str = os.environ['DB_ENCRYPTION_KEY']
     DB_HOST: str = 'localhost:27017'
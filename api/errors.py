@@ -73,6 +73,7 @@ DATASET_NOT_FOUND = 'This dataset does not exist.'
 DATASET_ALREADY_EXISTS = 'This dataset already exists'
 IMAGE_NOT_FOUND = 'This image does not exists.'
 IMAGE_ALREADY_EXISTS = 'This image already exists.'
+UPLOAD_TOO_LARGE = 'These images are too large to be uploaded at once.'
 CATEGORY_NOT_FOUND = 'This category does not exist.'
 CATEGORY_ALREADY_EXISTS = 'This category already exists.'
 PIPELINE_NOT_FOUND = 'This pipeline does not exist.'
@@ -81,6 +82,7 @@ LABEL_NOT_FOUND = 'This label does not exist.'
 LABEL_ALREADY_EXISTS = 'This label already exists.'
 TASK_NOT_FOUND = 'This task does not exist.'
 TASK_ALREADY_EXISTS = 'This task already exists.'
+TASK_NOT_FAILED = 'Only a failed task can be retried.'
 NOTIFICATION_NOT_FOUND = 'This notification does not exist.'
 NOTIFICATION_ALREADY_EXISTS = 'This notification already exists.'
 
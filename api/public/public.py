@@ -4,7 +4,7 @@ import os
 from typing import List
 
 import cv2
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Response
 
 import errors
 from config import Config
@@ -12,7 +12,7 @@ from dependencies import get_ip_address
 from logger import logger
 from routers.images.models import Image
 from routers.labels.models import Label
-from routers.pipelines.core import perform_sample
+from routers.pipelines.core import perform_sample, render_virtual_image
 from routers.pipelines.models import SampleResponse
 from utils import parse
 from .models import PublicDatasetResponse, PublicSampleBody, NewsletterBody
@@ -70,6 +70,17 @@ def get_public_sample(payload: PublicSampleBody):
     }
 
 
+@public.get('/renders/{image_id}')
+def get_render(image_id):
+    """
+    Render a virtual augmented image (public, as stored images are). Only ids of images stored with `is_virtual`
+    are rendered, others are not found.
+    """
+    image_bytes = render_virtual_image(image_id)
+    logger.notify('Public', f'Render virtual image `{image_id}`')
+    return Response(content=image_bytes, media_type='image/jpeg', headers={'Cache-Control': 'public, max-age=31536000'})
+
+
 @public.post('/newsletter')
 def register_newsletter(payload: NewsletterBody):
     email = payload.email
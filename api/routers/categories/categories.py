@@ -5,6 +5,7 @@ from logger import logger
 from routers.categories.core import find_categories, find_category, find_images_of_category, remove_category, \
     insert_category
 from routers.categories.models import *
+from routers.images.models import ImageRendition
 from utils import parse
 
 categories = APIRouter()
@@ -31,11 +32,16 @@ def get_category(dataset_id, category_id):
 
 
 @categories.get('/{category_id}/images', response_model=ImagesCategoryResponse)
-def get_category(dataset_id, category_id, include_labels=False, offset: int = 0, limit: int = 0):
+def get_category(dataset_id,
+                 category_id,
+                 include_labels=False,
+                 offset: int = 0,
+                 limit: int = 0,
+                 rendition: Optional[ImageRendition] = None):
     """
-    Fetch images of a given category.
+    Fetch images of a given category, with paths of given rendition (full size by default).
     """
-    images, total_count = find_images_of_category(dataset_id, category_id, include_labels, offset, limit)
+    images, total_count = find_images_of_category(dataset_id, category_id, include_labels, offset, limit, rendition)
     response = {'images': images, 'total_count': total_count}
     logger.notify('Images', f'Fetch images for category `{category_id}` of dataset `{dataset_id}`')
     return parse(response)
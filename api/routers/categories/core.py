@@ -1,10 +1,11 @@
-from typing import List
+from typing import List, Optional
 from uuid import uuid4
 
 import errors
 from config import Config
 from routers.categories.models import Category, SuperCategory
-from routers.images.models import ImageExtended
+from routers.images.core import with_rendition
+from routers.images.models import ImageExtended, ImageRendition
 from routers.labels.core import find_labels_from_image_ids, find_labels_of_category
 
 db = Config.db
@@ -24,7 +25,8 @@ def find_category(dataset_id, category_id) -> Category:
     return Category.from_mongo(category)
 
 
-def find_images_of_category(dataset_id, category_id, include_labels=False, offset=0, limit=0) -> tuple[List[ImageExtended], int]:
+def find_images_of_category(dataset_id, category_id, include_labels=False, offset=0, limit=0,
+                            rendition: Optional[ImageRendition] = None) -> tuple[List[ImageExtended], int]:
     labels = find_labels_of_category(category_id)
     images = db.images.find({'dataset_id': dataset_id,
                              'pipeline_id': None,
@@ -33,7 +35,7 @@ def find_images_of_category(dataset_id, category_id, include_labels=False, offse
     total_count = db.images.count({'dataset_id': dataset_id,
                                    'pipeline_id': None,
                                    '_id': {'$in': [label.image_id for label in labels]}})
-    images = [ImageExtended.from_mongo(image) for image in images]
+    images = with_rendition([ImageExtended.from_mongo(image) for image in images], rendition)
     if include_labels:
         labels = find_labels_from_image_ids([image.id for image in images])
         if labels is not None:
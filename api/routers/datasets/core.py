@@ -2,6 +2,8 @@ from datetime import datetime
 from typing import List
 from uuid import uuid4
 
+from pymongo import UpdateOne
+
 import errors
 from config import Config
 from routers.categories.core import find_categories
@@ -77,6 +79,28 @@ def insert_dataset(user_id, payload: DatasetPostBody) -> Dataset:
     return dataset
 
 
+def recount_dataset(dataset_id):
+    """
+    Recompute image, augmented image & labels counters of a dataset from its documents,
+    once a task is done : chunks of a task do not count their own work, and a resumed one may count it twice.
+    """
+    image_count = db.images.count({'dataset_id': dataset_id, 'pipeline_id': None})
+    augmented_count = db.images.count({'dataset_id': dataset_id, 'pipeline_id': {'$ne': None}})
+    db.datasets.update_one({'_id': dataset_id},
+                           {'$set': {'image_count': image_count, 'augmented_count': augmented_count}})
+
+    category_ids = [category['_id'] for category in db.categories.find({'dataset_id': dataset_id}, {'_id': 1})]
+    if not category_ids:
+        return
+    labels_counts = {group['_id']: group['count'] for group in db.labels.aggregate([
+        {'$match': {'category_id': {'$in': category_ids}}},
+        {'$group': {'_id': '$category_id', 'count': {'$sum': 1}}}
+    ])}
+    db.categories.bulk_write([UpdateOne({'_id': category_id},
+                                        {'$set': {'labels_count': labels_counts.get(category_id, 0)}})
+                              for category_id in category_ids])
+
+
 def remove_dataset(user_id, dataset_id):
     dataset_to_remove = db.datasets.find_one({'_id': dataset_id})
 
@@ -1,5 +1,8 @@
-import json
+import fcntl
+import hashlib
 import os
+import shutil
+import time
 import zipfile
 from typing import List
 from uuid import uuid4
@@ -9,41 +12,118 @@ import requests
 import errors
 from config import Config
 from logger import logger
+from routers.datasources.index import is_indexed, load_index, update_index
 from routers.datasources.models import DatasourceKey
 
 db = Config.db
 
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def _file_size(path) -> int:
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def _remote_size(response):
+    """
+    Size of the remote file, from `Content-Range: bytes */<size>` of a 416 response. None if unknown.
+    """
+    size = response.headers.get('Content-Range', '').rpartition('/')[2]
+    return int(size) if size.isdigit() else None
+
+
+def _download_archive(url, path, sha256=None):
+    """
+    Download `url` to `path`, resuming a previous partial download (`<path>.part`) with a HTTP Range request,
+    and retrying dropped connections with exponential backoff. Size announced by the server, and `sha256` when
+    known, are checked before `<path>` is written.
+    """
+    part_path = f'{path}.part'
+    for attempt in range(Config.DATASOURCE_DOWNLOAD_RETRIES + 1):
+        offset = _file_size(part_path)
+        try:
+            with requests.get(url, stream=True, timeout=Config.DATASOURCE_DOWNLOAD_TIMEOUT,
+                              headers={'Range': f'bytes={offset}-'} if offset else {}) as response:
+                if response.status_code == 416:  # nothing left to download, if partial download has the remote size
+                    if _remote_size(response) == offset:
+                        break
+                    os.remove(part_path)  # larger than the remote file, start over
+                    continue
+                if response.status_code not in (200, 206):
+                    raise errors.APIError(503, 'Datasources', f'{url} answered {response.status_code}')
+                if response.status_code == 200:  # range not supported, start over
+                    offset = 0
+                total = offset + int(response.headers.get('Content-Length', 0))
+                with open(part_path, 'ab' if offset else 'wb') as fd:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        fd.write(chunk)
+            if os.path.getsize(part_path) >= total:
+                break
+        except requests.RequestException as e:  # connection dropped, timeout, truncated body
+            if attempt == Config.DATASOURCE_DOWNLOAD_RETRIES:
+                raise errors.APIError(503, 'Datasources', f'{url} unreachable, {str(e)}')
+        logger.notify('Datasources', f'Download of {url} interrupted at {_file_size(part_path)} bytes, '
+                                     f'resuming', level='warning')
+        time.sleep(2 ** attempt)
+    else:
+        raise errors.APIError(503, 'Datasources', f'Download of {url} incomplete')
+
+    if sha256:
+        digest = hashlib.sha256()
+        with open(part_path, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(DOWNLOAD_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        if digest.hexdigest() != sha256:
+            os.remove(part_path)
+            raise errors.InternalError('Datasources', f'Checksum mismatch for {url}')
+    os.replace(part_path, path)
+
+
+def _extract_annotations(zip_path, annotations_path, filenames):
+    """
+    Stream members `filenames` of the archive to `annotations_path`, ignoring other members.
+    Each file is written to a temporary file then renamed : readers never see a partial file.
+    """
+    os.makedirs(annotations_path, exist_ok=True)
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        members = {os.path.basename(member.filename): member for member in zip_ref.infolist()}
+        for filename in filenames:
+            if filename not in members:
+                raise errors.InternalError('Datasources', f'Filename {filename} not found in {zip_path}')
+            temporary = os.path.join(annotations_path, f'.{filename}.{uuid4()}')
+            with zip_ref.open(members[filename]) as source, open(temporary, 'wb') as target:
+                shutil.copyfileobj(source, target, DOWNLOAD_CHUNK_SIZE)  # CRC checked once member is read
+            os.replace(temporary, os.path.join(annotations_path, filename))
 
-def download_annotations(datasource_key: DatasourceKey):
-    if not os.path.exists(Config.DATASOURCES_PATH):
-        os.mkdir(Config.DATASOURCES_PATH)
 
+def download_annotations(datasource_key: DatasourceKey):
+    """
+    Download & extract annotations files of the datasource, and build their index, once : concurrent calls,
+    from any process of the host, wait for the first one to complete. An index out of date is built again.
+    """
+    datasource = [datasource for datasource in Config.DATASOURCES if datasource['key'] == datasource_key][0]
     datasource_path = os.path.join(Config.DATASOURCES_PATH, datasource_key)
-    if not os.path.exists(datasource_path):
-        os.mkdir(datasource_path)
-
     annotations_path = os.path.join(datasource_path, 'annotations')
-    datasource = [datasource for datasource in Config.DATASOURCES if datasource['key'] == datasource_key][0]
-
-    if os.path.exists(annotations_path):
-        return annotations_path, datasource
-
-    logger.notify('Datasources', f'Downloading {datasource["name"]}...')
+    paths = [os.path.join(annotations_path, filename) for filename in datasource['filenames']]
 
-    response = requests.get(datasource['download_url'], stream=True)
-    if response.status_code != 200:
-        raise errors.APIError(503, 'Datasources', f"Datasource {datasource['name']} unreachable")
-
-    datasource_path = os.path.join(Config.DATASOURCES_PATH, datasource_key)
-    zip_path = os.path.join(datasource_path, f'{datasource_key}.zip')
-    with open(zip_path, 'wb') as fd:
-        for chunk in response.iter_content(chunk_size=128):
-            fd.write(chunk)
+    def is_downloaded():
+        return all(os.path.exists(path) for path in paths)
 
-    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        zip_ref.extractall(datasource_path)
+    if is_downloaded() and is_indexed(paths):
+        return annotations_path, datasource
 
-    os.remove(zip_path)
+    os.makedirs(datasource_path, exist_ok=True)
+    with open(os.path.join(datasource_path, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not is_downloaded():
+            logger.notify('Datasources', f'Downloading {datasource["name"]}...')
+            zip_path = os.path.join(datasource_path, f'{datasource_key}.zip')
+            _download_archive(datasource['download_url'], zip_path, datasource.get('sha256'))
+            _extract_annotations(zip_path, annotations_path, datasource['filenames'])
+            os.remove(zip_path)
+
+        if not is_indexed(paths):  # unless indexed meanwhile
+            update_index(paths)
     return annotations_path, datasource
 
 
@@ -51,31 +131,29 @@ def find_datasources() -> List[dict]:
     return Config.DATASOURCES
 
 
+def annotations_files(datasource_key: DatasourceKey) -> List[str]:
+    datasource = [datasource for datasource in Config.DATASOURCES if datasource['key'] == datasource_key][0]
+    paths = []
+    for filename in datasource['filenames']:
+        path = os.path.join(Config.DATASOURCES_PATH, datasource_key, 'annotations', filename)
+        if not os.path.exists(path):
+            raise errors.InternalError('Datasoures', f'Filename {filename} not found for datasource {datasource_key}')
+        paths.append(path)
+    return paths
+
+
 def find_categories(datasource_key: DatasourceKey):
     try:
-        annotations_path, datasource = download_annotations(datasource_key)
+        download_annotations(datasource_key)
     except Exception as e:
         raise errors.InternalError('Datasoures', f'Download of {datasource_key} failed, {str(e)}')
 
-    filename = datasource['filenames'][0]
-    try:
-        json_file = open(os.path.join(annotations_path, filename), 'r')
-        datasource_content = json.load(json_file)
-        categories = datasource_content['categories']
-        datasource_annotations = datasource_content['annotations']
-        json_file.close()
-    except FileNotFoundError:
-        raise errors.InternalError('Datasoures', f'Filename {filename} not found for datasource {datasource_key}')
-
-    for category in categories:
-        category['labels_count'] = 0
-
-    for datasource_label in datasource_annotations:
-        category_id = datasource_label['category_id']
-        category_to_update = next(category for category in categories if category['id'] == category_id)
-        category_to_update['labels_count'] += 1
+    index = load_index(annotations_files(datasource_key))
+    categories = [dict(category) for category in index.categories]
+    labels_counts = index.labels_counts()
 
     for category in categories:
+        category['labels_count'] = labels_counts[category['id']]
         category['_id'] = str(uuid4())
         category.pop('id', None)
 
@@ -83,24 +161,10 @@ def find_categories(datasource_key: DatasourceKey):
 
 
 def find_max_image_count(datasource_key, selected_categories):
-    datasource_path = os.path.join(Config.DATASOURCES_PATH, datasource_key)
-    annotations_path = os.path.join(datasource_path, 'annotations')
-    datasource = [datasource for datasource in Config.DATASOURCES if datasource['key'] == datasource_key][0]
-    filename = datasource['filenames'][0]
-
     try:
-        json_file = open(os.path.join(annotations_path, filename), 'r')
-        json_remote_dataset = json.load(json_file)
-        json_file.close()
-        categories_remote = [category for category in json_remote_dataset['categories']
-                             if category['name'] in selected_categories]
-        category_ids = [category['id'] for category in categories_remote]
-
-        labels_remote = [label for label in json_remote_dataset['annotations'] if label['category_id'] in category_ids]
-        del json_remote_dataset
-
-        image_remote_ids = [label['image_id'] for label in labels_remote]
-    except FileNotFoundError:
-        raise errors.InternalError('Datasoures', f'Filename {filename} not found for datasource {datasource_key}')
+        download_annotations(datasource_key)
+    except Exception as e:
+        raise errors.InternalError('Datasoures', f'Download of {datasource_key} failed, {str(e)}')
 
-    return len(set(image_remote_ids))
+    index = load_index(annotations_files(datasource_key))
+    return index.image_count(index.category_ids(selected_categories))
@@ -0,0 +1,239 @@
+import concurrent.futures
+import functools
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import time
+from array import array
+from typing import Dict, List, Tuple
+
+import numpy
+
+from logger import logger
+from utils import stream_json_arrays
+
+INDEX_VERSION = 1
+REPLACED_INDEX_TTL = 60  # seconds a replaced index is kept for readers still loading it
+
+LABEL_COLUMNS = ('label_image_ids', 'label_category_ids', 'label_bboxes')
+IMAGE_COLUMNS = ('image_ids', 'image_widths', 'image_heights', 'image_file_names', 'image_flickr_urls',
+                 'image_coco_urls')
+
+
+def index_path(path) -> str:
+    """
+    Index folder of the annotations file at `path` : `<datasource>/index/<filename>`.
+    """
+    annotations_path, filename = os.path.split(path)
+    return os.path.join(os.path.dirname(annotations_path), 'index', os.path.splitext(filename)[0])
+
+
+def merged_index_path(paths) -> str:
+    """
+    Index folder of the annotations files at `paths` merged : `<datasource>/index/<filename>+<filename>...`.
+    """
+    names = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    return os.path.join(os.path.dirname(os.path.dirname(paths[0])), 'index', '+'.join(names))
+
+
+def _source(path) -> dict:
+    stat = os.stat(path)
+    return {'version': INDEX_VERSION, 'size': stat.st_size, 'modified_at': stat.st_mtime}
+
+
+def _is_current(directory, meta) -> bool:
+    try:
+        with open(os.path.join(directory, 'meta.json'), 'r') as file:
+            return json.load(file) == meta
+    except (FileNotFoundError, ValueError):
+        return False
+
+
+def _versions(directory) -> List[Tuple[int, str]]:
+    """
+    Versioned folders `<directory>.<time>` of an index, with the time they were written at in ns, oldest first.
+    """
+    parent, name = os.path.split(directory)
+    pattern = re.compile(rf'{re.escape(name)}\.(\d+)')
+    versions = [match for match in map(pattern.fullmatch, os.listdir(parent)) if match]
+    return sorted((int(match.group(1)), os.path.join(parent, match.group(0))) for match in versions)
+
+
+def _write_index(directory, columns, categories, meta):
+    """
+    Write the index in a new versioned folder, then swap the symlink `directory` to it with an atomic rename :
+    concurrent readers see the previous version or this one, never a partial one nor none.
+    Versions replaced for more than `REPLACED_INDEX_TTL` are removed, readers have loaded them since.
+    """
+    parent = os.path.dirname(directory)
+    os.makedirs(parent, exist_ok=True)
+    temporary = tempfile.mkdtemp(dir=parent)
+    for column, values in columns.items():
+        numpy.save(os.path.join(temporary, f'{column}.npy'), values)
+    with open(os.path.join(temporary, 'categories.json'), 'w') as file:
+        json.dump(categories, file)
+    with open(os.path.join(temporary, 'meta.json'), 'w') as file:
+        json.dump(meta, file)
+
+    version = f'{directory}.{time.time_ns()}'
+    os.rename(temporary, version)
+    os.symlink(os.path.basename(version), temporary)
+    if os.path.isdir(directory) and not os.path.islink(directory):  # folder written before indices were versioned
+        shutil.rmtree(directory)
+    os.replace(temporary, directory)
+    versions = _versions(directory)
+    for (_, stale), (replaced_at, _) in zip(versions, versions[1:]):
+        if time.time_ns() - replaced_at > REPLACED_INDEX_TTL * 1e9:
+            shutil.rmtree(stale, ignore_errors=True)
+
+
+def build_index(path):
+    """
+    Stream the annotations file at `path` once, and write its columns as `.npy` files.
+    """
+    label_image_ids, label_category_ids, label_bboxes = array('q'), array('q'), array('d')
+    images = {column: [] for column in IMAGE_COLUMNS}
+    categories = []
+    for key, item in stream_json_arrays(path, ['images', 'annotations', 'categories']):
+        if key == 'annotations':
+            label_image_ids.append(item['image_id'])
+            label_category_ids.append(item['category_id'])
+            label_bboxes.extend(item['bbox'])
+        elif key == 'images':
+            images['image_ids'].append(item['id'])
+            images['image_widths'].append(item['width'])
+            images['image_heights'].append(item['height'])
+            images['image_file_names'].append((item.get('file_name') or '').encode())
+            images['image_flickr_urls'].append((item.get('flickr_url') or '').encode())
+            images['image_coco_urls'].append((item.get('coco_url') or '').encode())
+        else:
+            categories.append(item)
+
+    # Labels of an image are contiguous
+    label_image_ids = numpy.frombuffer(label_image_ids, dtype=numpy.int64)
+    order = numpy.argsort(label_image_ids, kind='stable')
+    columns = {'label_image_ids': label_image_ids[order],
+               'label_category_ids': numpy.frombuffer(label_category_ids, dtype=numpy.int64)[order],
+               'label_bboxes': numpy.frombuffer(label_bboxes, dtype=numpy.float64).reshape(-1, 4)[order],
+               'image_ids': numpy.array(images['image_ids'], dtype=numpy.int64),
+               'image_widths': numpy.array(images['image_widths'], dtype=numpy.int32),
+               'image_heights': numpy.array(images['image_heights'], dtype=numpy.int32)}
+    for column in ('image_file_names', 'image_flickr_urls', 'image_coco_urls'):
+        columns[column] = numpy.array(images[column], dtype=bytes)
+
+    _write_index(index_path(path), columns, categories, _source(path))
+    logger.notify('Datasources', f'Indexed {len(order)} labels of {len(columns["image_ids"])} images '
+                                 f'from `{os.path.basename(path)}`')
+
+
+class DatasourceIndex:
+    """
+    Columns of one or several merged annotations files, memory mapped : every process of the host shares
+    the same pages.
+    Labels are sorted by image id.
+    """
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, 'categories.json'), 'r') as file:
+            self.categories: List[dict] = json.load(file)
+        for column in LABEL_COLUMNS + IMAGE_COLUMNS:
+            setattr(self, column, numpy.load(os.path.join(directory, f'{column}.npy'), mmap_mode='r'))
+
+    def category_ids(self, names) -> numpy.ndarray:
+        return numpy.array([category['id'] for category in self.categories if category['name'] in names],
+                           dtype=numpy.int64)
+
+    def labels_counts(self) -> Dict[int, int]:
+        counts = numpy.bincount(self.label_category_ids)
+        return {category['id']: int(counts[category['id']]) if category['id'] < len(counts) else 0
+                for category in self.categories}
+
+    def image_count(self, category_ids) -> int:
+        image_ids = self.label_image_ids[numpy.isin(self.label_category_ids, category_ids)]
+        # Sorted : count changes of image id
+        return int(numpy.count_nonzero(numpy.diff(image_ids))) + 1 if len(image_ids) else 0
+
+
+def build_indices(paths):
+    """
+    Build missing or out of date indices of the annotations files at `paths`, in parallel processes.
+    Celery pool processes are daemonic and cannot start processes : they build indices one after the other.
+    """
+    paths = [path for path in paths if not _is_current(index_path(path), _source(path))]
+    if len(paths) > 1 and not multiprocessing.current_process().daemon:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(len(paths), os.cpu_count())) as executor:
+            list(executor.map(build_index, paths))
+    else:
+        for path in paths:
+            build_index(path)
+
+
+def merge_indices(paths):
+    """
+    Merge indices of the annotations files at `paths` : an image listed in several files is kept once,
+    with its labels of the first file listing it.
+    """
+    indices = [DatasourceIndex(index_path(path)) for path in paths]
+    image_ids = numpy.concatenate([index.image_ids for index in indices])
+    _, first = numpy.unique(image_ids, return_index=True)
+    kept = numpy.zeros(len(image_ids), dtype=bool)
+    kept[first] = True
+
+    columns = {column: numpy.concatenate([getattr(index, column) for index in indices])[kept]
+               for column in IMAGE_COLUMNS}
+    labels = {column: [] for column in LABEL_COLUMNS}
+    offset = 0
+    for index in indices:
+        kept_image_ids = index.image_ids[kept[offset:offset + len(index.image_ids)]]
+        offset += len(index.image_ids)
+        selected = numpy.isin(index.label_image_ids, kept_image_ids)
+        for column in LABEL_COLUMNS:
+            labels[column].append(getattr(index, column)[selected])
+    label_image_ids = numpy.concatenate(labels['label_image_ids'])
+    order = numpy.argsort(label_image_ids, kind='stable')
+    for column in LABEL_COLUMNS:
+        columns[column] = numpy.concatenate(labels[column])[order]
+
+    categories = list({category['id']: category
+                       for index in reversed(indices) for category in index.categories}.values())
+    categories.sort(key=lambda category: category['id'])
+    _write_index(merged_index_path(paths), columns, categories, [_source(path) for path in paths])
+    logger.notify('Datasources', f'Merged {len(order)} labels of {len(columns["image_ids"])} images '
+                                 f'from {len(paths)} files')
+
+
+def _index_directory(paths) -> str:
+    return index_path(paths[0]) if len(paths) == 1 else merged_index_path(paths)
+
+
+def is_indexed(paths) -> bool:
+    """
+    Whether the index of the annotations files at `paths` merged is built & up to date.
+    """
+    return all(_is_current(index_path(path), _source(path)) for path in paths) and \
+        (len(paths) == 1 or _is_current(merged_index_path(paths), [_source(path) for path in paths]))
+
+
+def update_index(paths):
+    """
+    Build the missing or out of date indices of the annotations files at `paths`, then merge them.
+    """
+    build_indices(paths)
+    if len(paths) > 1 and not _is_current(merged_index_path(paths), [_source(path) for path in paths]):
+        merge_indices(paths)
+
+
+@functools.lru_cache(maxsize=8)
+def _load_index(version) -> DatasourceIndex:
+    return DatasourceIndex(version)
+
+
+def load_index(paths: List[str]) -> DatasourceIndex:
+    """
+    Index of the annotations files at `paths` merged, as last written by `update_index` : it is never built here,
+    so that API requests do not wait for it.
+    """
+    return _load_index(os.path.realpath(_index_directory(paths)))
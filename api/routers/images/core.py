@@ -1,100 +1,216 @@
+import collections
 import concurrent.futures
-from typing import List
+import concurrent.futures.process
+import hashlib
+import multiprocessing
+import os
+import re
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
 from uuid import uuid4
 
-import boto3
-import cv2
-import numpy
+from pymongo import UpdateOne
 
 import errors
 from config import Config
-from routers.images.models import Image, ImageExtended
+from routers.images.duplicates import DuplicateIndex
+from routers.images.ingest import RENDITIONS_ENCODING, ingest_image
+from routers.images.models import DuplicatesPolicy, Image, ImageExtended, ImageRendition
 from routers.labels.core import find_labels_from_image_ids, regroup_labels_by_category
 from routers.labels.models import Label
+from storage.core import DELETE_BATCH_SIZE, storage
+from utils import BulkWriter
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+CONTENT_KEY = re.compile(r'[0-9a-f]{64}(-\w+)?')  # sha256 of content, of deduplicated images & their renditions
 
 db = Config.db
-s3 = boto3.client(
-    "s3",
-    aws_access_key_id=Config.S3_KEY,
-    aws_secret_access_key=Config.S3_SECRET
-)
+
+_ingest_executor = None
+_ingest_executor_lock = threading.Lock()
 
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-def compress_image(image):
-    width = image.shape[1]
-    height = image.shape[0]
-    if width > 1280:
-        compression_ratio = width / 1280
-        dist_shape = (int(width / compression_ratio), int(height / compression_ratio))
-        image = cv2.resize(image, dist_shape)
-    elif height > 720:
-        compression_ratio = height / 720
-        dist_shape = (int(width / compression_ratio), int(height / compression_ratio))
-        image = cv2.resize(image, dist_shape)
-    return image
-
-
-def upload_image(image_bytes, image_id):
+def upload_image(image_bytes, image_id, deduplicate=False):
+    """
+    Store an image under its id. With `deduplicate`, it is stored under the hash of its content instead,
+    and uploaded only if no image with the same content was uploaded yet.
+    """
+    key = hashlib.sha256(image_bytes).hexdigest() if deduplicate else image_id
     try:
-        s3.put_object(Bucket=Config.S3_BUCKET, Key=image_id, Body=image_bytes, ACL='public-read')
-        path = f"{Config.S3_LOCATION}{image_id}"
+        if not (deduplicate and storage.exists(key)):
+            storage.put(key, image_bytes)
+        path = storage.url(key)
         return path
     except Exception as e:
         print(e)
-        raise errors.InternalError('Images', f'Cannot upload file to S3, {str(e)}')
-
-
-def upload_file(payload) -> Image:
-    file = payload['file']
-    filename = payload['filename']
-    dataset_id = payload['dataset_id']
-    if file and allowed_file(filename):
-        image_id = str(uuid4())
-        name = filename  # FIXME : secure filename
-        image = cv2.imdecode(numpy.fromstring(file.read(), numpy.uint8), cv2.IMREAD_UNCHANGED)
-        image = compress_image(image)
-        image_bytes = cv2.imencode('.jpg', image)[1].tostring()
-        path = upload_image(image_bytes, image_id)
-        return Image(
-            id=image_id,
-            dataset_id=dataset_id,
-            path=path,
-            name=name,
-            size=len(image_bytes),
-            width=image.shape[1],
-            height=image.shape[0],
-        )
+        raise errors.InternalError('Images', f'Cannot store file, {str(e)}')
 
 
-def delete_images_from_s3(image_ids):
-    def getrows_byslice(array):
-        for start in range(0, len(array), 1000):
-            yield array[start:start + 1000]
-
+def upload_renditions(renditions: Dict[str, bytes], path, deduplicate=False) -> Dict[str, str]:
+    """
+    Store renditions of the image at `path`, under its key suffixed with their name.
+    """
+    _, content_type, _ = RENDITIONS_ENCODING[Config.IMAGE_RENDITIONS_FORMAT]
+    paths = {}
     try:
-        for image_ids_to_delete in getrows_byslice(image_ids):
-            s3.delete_objects(
-                Bucket=Config.S3_BUCKET,
-                Delete={'Objects': [{'Key': image_id} for image_id in image_ids_to_delete]}
-            )
+        for name, image_bytes in renditions.items():
+            key = f'{storage.key(path)}-{name}'
+            if not (deduplicate and storage.exists(key)):
+                storage.put(key, image_bytes, content_type=content_type)
+            paths[name] = storage.url(key)
     except Exception as e:
-        raise errors.InternalError('Images', f'Cannot delete file from S3, {str(e)}')
+        raise errors.InternalError('Images', f'Cannot store file, {str(e)}')
+    return paths
+
+
+def with_rendition(images: List[Image], rendition: Optional[ImageRendition]) -> List[Image]:
+    """
+    Set `path` of `images` to their `rendition`, when they have one.
+    """
+    if rendition is not None:
+        for image in images:
+            image.path = (image.renditions or {}).get(rendition.value, image.path)
+    return images
 
 
-def delete_image_from_s3(image_id):
+def _file_size(file) -> int:
+    file.seek(0, 2)
+    size = file.tell()
+    file.seek(0)
+    return size
+
+
+def ingest_executor() -> concurrent.futures.ProcessPoolExecutor:
+    """
+    Pool of `IMAGES_INGEST_WORKERS` processes decoding uploads, shared by requests, started on first use.
+    """
+    global _ingest_executor
+    with _ingest_executor_lock:
+        if _ingest_executor is None:
+            _ingest_executor = concurrent.futures.ProcessPoolExecutor(max_workers=Config.IMAGES_INGEST_WORKERS,
+                                                                      mp_context=multiprocessing.get_context('spawn'))
+        return _ingest_executor
+
+
+def reset_ingest_executor():
+    """
+    Drop a broken pool (a worker was killed), a new one is started on next use.
+    """
+    global _ingest_executor
+    with _ingest_executor_lock:
+        if _ingest_executor is not None:
+            _ingest_executor.shutdown(wait=False)
+        _ingest_executor = None
+
+
+def _ingest_files(files):
+    """
+    Decode & compress `files` in the ingest processes, yielding `(filename, ingested)` in order. At most twice as
+    many files as processes are read in memory at once.
+    """
+    executor = ingest_executor()
+    window_size = 2 * (Config.IMAGES_INGEST_WORKERS or os.cpu_count())
+    pending = collections.deque()
     try:
-        s3.delete_object(
-            Bucket=Config.S3_BUCKET,
-            Key=image_id
-        )
+        for file in files:
+            future = executor.submit(ingest_image, file.file.read(), Config.IMAGE_RENDITIONS,
+                                     Config.IMAGE_RENDITIONS_FORMAT)
+            pending.append((file.filename, future))
+            if len(pending) >= window_size:
+                filename, future = pending.popleft()
+                yield filename, future.result()
+        while pending:
+            filename, future = pending.popleft()
+            yield filename, future.result()
+    except concurrent.futures.process.BrokenProcessPool as e:
+        reset_ingest_executor()
+        raise errors.InternalError('Images', f'Cannot decode images, {str(e)}')
+
+
+def store_file(dataset_id, image_id, filename, ingested, duplicate_of=None) -> Image:
+    image_bytes, (width, height), renditions, image_hash = ingested
+    path = upload_image(image_bytes, image_id)
+    return Image(
+        id=image_id,
+        dataset_id=dataset_id,
+        path=path,
+        name=filename,  # FIXME : secure filename
+        size=len(image_bytes),
+        width=width,
+        height=height,
+        renditions=upload_renditions(renditions, path),
+        dhash=image_hash,
+        duplicate_of=duplicate_of
+    )
+
+
+def find_image_paths(image_ids) -> List[str]:
+    """
+    Paths of images & of their renditions.
+    """
+    return [path
+            for image in db.images.find({'_id': {'$in': image_ids}}, {'path': 1, 'renditions': 1})
+            for path in [image['path'], *(image.get('renditions') or {}).values()]]
+
+
+def _unused_keys(paths) -> List[str]:
+    """
+    Keys of stored objects at `paths` not used by any image.
+    """
+    paths = set(path for path in paths if storage.key(path) is not None)
+    for field in ['path', *(f'renditions.{name}' for name in Config.IMAGE_RENDITIONS)]:
+        paths -= set(db.images.distinct(field, {field: {'$in': list(paths)}}))
+    return [storage.key(path) for path in paths]
+
+
+def delete_images_from_storage(paths):
+    """
+    Delete stored objects at `paths`, once their images documents are deleted : deduplicated objects still used
+    by other images are kept. Content addressed objects (`upload_image` with `deduplicate`) may be reused meanwhile
+    by an image whose document is not written yet : they are only marked, and deleted by `collect_storage_garbage`.
+    """
+    keys = _unused_keys(paths)
+    shared_keys = [key for key in keys if CONTENT_KEY.fullmatch(key)]
+    if shared_keys:
+        db.storage_garbage.bulk_write([UpdateOne({'_id': key}, {'$set': {'deleted_at': datetime.now()}}, upsert=True)
+                                       for key in shared_keys], ordered=False)
+    try:
+        storage.delete([key for key in keys if not CONTENT_KEY.fullmatch(key)])
+    except Exception as e:
+        raise errors.InternalError('Images', f'Cannot delete stored file, {str(e)}')
+
+
+def collect_storage_garbage() -> int:
+    """
+    Delete content addressed objects marked by `delete_images_from_storage` more than `STORAGE_GC_GRACE_PERIOD`
+    seconds ago, and still unused : documents of images reusing them were written within the grace period.
+    Returns the count of deleted objects.
+    """
+    deadline = datetime.now() - timedelta(seconds=Config.STORAGE_GC_GRACE_PERIOD)
+    keys = [garbage['_id'] for garbage in db.storage_garbage.find({'deleted_at': {'$lt': deadline}}, {'_id': 1})]
+    deleted = 0
+    for start in range(0, len(keys), DELETE_BATCH_SIZE):
+        batch = keys[start:start + DELETE_BATCH_SIZE]
+        unused_keys = _unused_keys([storage.url(key) for key in batch])
+        try:
+            storage.delete(unused_keys)
+        except Exception as e:
+            raise errors.InternalError('Images', f'Cannot delete stored file, {str(e)}')
+        db.storage_garbage.delete_many({'_id': {'$in': batch}, 'deleted_at': {'$lt': deadline}})
+        deleted += len(unused_keys)
+    return deleted
+
+
+def delete_image_from_storage(image_id):
+    try:
+        storage.delete([image_id])
     except Exception as e:
-        raise errors.InternalError('Images', f'Cannot delete file from S3, {str(e)}')
+        raise errors.InternalError('Images', f'Cannot delete stored file, {str(e)}')
 
 
 def find_all_images(dataset_id, offset=0, limit=0) -> List[Image]:
@@ -113,7 +229,8 @@ def find_images(dataset_id,
                 pipeline_id=None,
                 include_labels=False,
                 offset=0,
-                limit=0) -> List[ImageExtended]:
+                limit=0,
+                rendition: ImageRendition = None) -> List[ImageExtended]:
     if original_image_id and pipeline_id:
         query = {'dataset_id': dataset_id, 'original_image_id': original_image_id, 'pipeline_id': pipeline_id}
     elif pipeline_id:
@@ -129,7 +246,7 @@ def find_images(dataset_id,
                   .limit(limit))
     if images is None:
         raise errors.NotFound('Images', errors.IMAGE_NOT_FOUND)
-    images = [ImageExtended.from_mongo(image) for image in images]
+    images = with_rendition([ImageExtended.from_mongo(image) for image in images], rendition)
     if include_labels:
         labels = find_labels_from_image_ids([image.id for image in images])
         if labels is not None:
@@ -145,20 +262,44 @@ def find_image(dataset_id, image_id) -> Image:
     return Image.from_mongo(image)
 
 
-def insert_images(dataset_id, request_files) -> List[Image]:
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        results = executor.map(upload_file, [{'filename': file.filename, 'file': file.file, 'dataset_id': dataset_id}
-                                             for file in request_files])
-        images = list(filter(None.__ne__, results))
-        db.images.insert_many([image.mongo() for image in images])
-        db.datasets.update_one({'_id': dataset_id},
-                               {'$inc': {
-                                   'image_count': len(images)
-                               }},
-                               upsert=False)
+def insert_images(dataset_id, request_files, duplicates=DuplicatesPolicy.flag) -> List[Image]:
+    """
+    Uploaded files are decoded & compressed in processes, then stored by threads as soon as they are ready.
+    A request holds `IMAGES_UPLOAD_MAX_BYTES` of files at most.
+    Near duplicates of images of the dataset, or of this request, are stored with `duplicate_of` set, or skipped.
+    """
+    files = [file for file in request_files if file.file and allowed_file(file.filename)]
+    if sum(_file_size(file.file) for file in files) > Config.IMAGES_UPLOAD_MAX_BYTES:
+        raise errors.APIError(413, 'Images', errors.UPLOAD_TOO_LARGE)
+
+    index = DuplicateIndex.of_dataset(dataset_id) if duplicates != DuplicatesPolicy.keep else None
+    with BulkWriter() as writer, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=Config.IMAGES_UPLOAD_WORKERS) as executor:
+        storing = []
+        for filename, ingested in _ingest_files(files):
+            if ingested is None:
+                continue
+            image_id, duplicate_of = str(uuid4()), None
+            if index is not None:
+                duplicate_of = index.find(ingested[3])
+                if duplicate_of and duplicates == DuplicatesPolicy.skip:
+                    continue
+                index.add(image_id, ingested[3])
+            storing.append(executor.submit(store_file, dataset_id, image_id, filename, ingested, duplicate_of))
+
+        images = []
+        for future in storing:
+            image = future.result()
+            images.append(image)
+            writer.insert_one('images', image.mongo())
+            writer.increment('datasets', dataset_id, 'image_count', 1)
     return images
 
 
+def find_duplicates(dataset_id, max_distance=None) -> List[List[str]]:
+    return DuplicateIndex.of_dataset(dataset_id, max_distance).clusters()
+
+
 def remove_all_images(dataset_id):
     images = find_all_images(dataset_id)
     image_ids = [image.id for image in images if image.original_image_id is None]
@@ -174,9 +315,10 @@ def remove_original_images(dataset_id, image_ids):
     labels = [Label.from_mongo(label) for label in labels]
 
     # Delete images and associated labels
-    delete_images_from_s3(image_ids)
+    paths = find_image_paths(image_ids)
     db.images.delete_many({'dataset_id': dataset_id, '_id': {'$in': image_ids}})
     db.labels.delete_many({'image_id': {'$in': image_ids}})
+    delete_images_from_storage(paths)
 
     # Decrease labels_count on associated categories
     for category_id, labels_count in regroup_labels_by_category(labels).items():
@@ -197,9 +339,10 @@ def remove_augmented_images(dataset_id, augmented_image_ids):
     labels = [Label.from_mongo(label) for label in labels]
 
     # Delete augmented images and associated labels
-    delete_images_from_s3(augmented_image_ids)
+    paths = find_image_paths(augmented_image_ids)
     db.images.delete_many({'dataset_id': dataset_id, '_id': {'$in': augmented_image_ids}})
     db.labels.delete_many({'image_id': {'$in': augmented_image_ids}})
+    delete_images_from_storage(paths)
 
     # Decrease labels_count on associated categories
     for category_id, labels_count in regroup_labels_by_category(labels).items():
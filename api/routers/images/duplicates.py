@@ -0,0 +1,169 @@
+from typing import List, Optional
+
+import numpy
+
+from config import Config
+
+db = Config.db
+
+POPCOUNT = numpy.array([bin(value).count('1') for value in range(256)], dtype=numpy.uint8)
+MAX_DISTANCE = 16  # 17 bands of 3 or 4 bits, larger distances match unrelated images
+SHORT_RUN = 64  # runs of equal band keys compared pair by pair, longer ones blockwise
+BLOCK_SIZE = 1 << 22  # pairs of hashes compared at once in long runs, 32 Mo of differences
+
+
+def hamming(left: numpy.ndarray, right) -> numpy.ndarray:
+    """
+    Count of differing bits between hashes of `left` & `right`.
+    """
+    differences = numpy.ascontiguousarray(left ^ right)
+    if hasattr(numpy, 'bitwise_count'):  # numpy >= 2, counting bits of absolute values of signed integers
+        return numpy.bitwise_count(differences.view(numpy.uint64))
+    return POPCOUNT[differences.view(numpy.uint8)].reshape(differences.shape + (8,)).sum(axis=-1)
+
+
+def _components(count, left, right) -> numpy.ndarray:
+    """
+    Connected components of the graph of `count` nodes & edges `(left, right)` : the smallest node of its component,
+    for each node.
+    """
+    labels = numpy.arange(count)
+    while True:
+        lowest = numpy.minimum(labels[left], labels[right])
+        updated = labels.copy()
+        numpy.minimum.at(updated, left, lowest)
+        numpy.minimum.at(updated, right, lowest)
+        updated = updated[updated]
+        if numpy.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+
+def _run_components(hashes, max_distance, labels) -> numpy.ndarray:
+    """
+    Same as `_components`, for the graph of `hashes` within `max_distance` bits, without listing its edges :
+    distances are computed by blocks of rows, each hash taking the smallest label of the hashes close to it.
+    Starts from `labels` of hashes already known to be connected.
+    """
+    count = len(hashes)
+    rows = max(1, BLOCK_SIZE // count)
+    while True:
+        updated = labels.copy()
+        for start in range(0, count, rows):
+            close = hamming(hashes[start:start + rows, None], hashes[None, :]) <= max_distance
+            updated[start:start + rows] = numpy.where(close, updated, count).min(axis=1)
+        updated = updated[updated]
+        if numpy.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+
+class DuplicateIndex:
+    """
+    Hashes of the images of a dataset, for Hamming distance lookups.
+    Hashes are split in `max_distance + 1` bands : two hashes within `max_distance` bits share one band at least,
+    so only hashes sharing a band are compared when clustering.
+    """
+
+    def __init__(self, image_ids: List[str], hashes, max_distance=None):
+        self.image_ids = list(image_ids)
+        self._hashes = numpy.array(hashes, dtype=numpy.int64)
+        self.max_distance = max_distance if max_distance is not None else Config.IMAGES_DUPLICATE_DISTANCE
+        if not 0 <= self.max_distance <= MAX_DISTANCE:
+            raise ValueError(f'Distance of near duplicates must be between 0 and {MAX_DISTANCE} bits')
+
+    @classmethod
+    def of_dataset(cls, dataset_id, max_distance=None):
+        images = list(db.images.find({'dataset_id': dataset_id,
+                                      'original_image_id': None,
+                                      'dhash': {'$exists': True}}, {'dhash': 1}))
+        return cls([image['_id'] for image in images], [image['dhash'] for image in images], max_distance)
+
+    @property
+    def hashes(self) -> numpy.ndarray:
+        return self._hashes[:len(self.image_ids)]
+
+    def add(self, image_id, value):
+        """
+        Index one more hash, in amortised constant time : the array of hashes doubles its capacity when full.
+        """
+        if len(self.image_ids) == len(self._hashes):
+            self._hashes = numpy.concatenate([self._hashes, numpy.empty(max(64, len(self._hashes)), numpy.int64)])
+        self._hashes[len(self.image_ids)] = value
+        self.image_ids.append(image_id)
+
+    def find(self, value) -> Optional[str]:
+        """
+        Id of the closest image within `max_distance` bits of hash `value`, None if there is none.
+        """
+        if not len(self.hashes):
+            return None
+        distances = hamming(self.hashes, numpy.int64(value))
+        closest = int(numpy.argmin(distances))
+        return self.image_ids[closest] if distances[closest] <= self.max_distance else None
+
+    def _bands(self):
+        edges = numpy.linspace(0, 64, self.max_distance + 2).astype(int)
+        return [(numpy.uint64(start), numpy.uint64((1 << int(end - start)) - 1))
+                for start, end in zip(edges[:-1], edges[1:])]
+
+    def _edges(self, hashes):
+        """
+        Edges of a graph whose components are the groups of `hashes` within `max_distance` bits, comparing only
+        hashes sharing a band. Short runs of hashes sharing a band yield their close pairs, except pairs already
+        sharing a previous band. Long runs yield an edge from each hash to the smallest of its component, and are
+        skipped when previous bands already connected all of their hashes.
+        """
+        unsigned = hashes.view(numpy.uint64)
+        bands = self._bands()
+        lefts, rights = [numpy.empty(0, dtype=numpy.int64)], [numpy.empty(0, dtype=numpy.int64)]
+        for band, (shift, mask) in enumerate(bands):
+            keys = (unsigned >> shift) & mask
+            order = numpy.argsort(keys, kind='stable')
+            keys = keys[order]
+            starts = numpy.flatnonzero(numpy.r_[True, keys[1:] != keys[:-1]])
+            lengths = numpy.diff(numpy.r_[starts, len(keys)])
+
+            if band and numpy.any(lengths > SHORT_RUN):
+                connected = _components(len(hashes), numpy.concatenate(lefts), numpy.concatenate(rights))
+            else:
+                connected = numpy.arange(len(hashes))
+            for start, length in zip(starts[lengths > SHORT_RUN], lengths[lengths > SHORT_RUN]):
+                run = order[start:start + length]
+                _, first, inverse = numpy.unique(connected[run], return_index=True, return_inverse=True)
+                if len(first) == 1:
+                    continue
+                components = _run_components(hashes[run], self.max_distance, first[inverse.ravel()])
+                lefts.append(run)
+                rights.append(run[components])
+
+            # Sorted : positions `k` apart share their band while they are in the same short run of equal keys
+            short = numpy.repeat(lengths <= SHORT_RUN, lengths)
+            candidates = numpy.flatnonzero(short)
+            for k in range(1, SHORT_RUN):
+                candidates = candidates[candidates + k < len(keys)]
+                candidates = candidates[keys[candidates] == keys[candidates + k]]
+                if not len(candidates):
+                    break
+                left, right = order[candidates], order[candidates + k]
+                differences = unsigned[left] ^ unsigned[right]
+                close = hamming(hashes[left], hashes[right]) <= self.max_distance
+                for previous_shift, previous_mask in bands[:band]:
+                    close &= ((differences >> previous_shift) & previous_mask) != 0
+                lefts.append(left[close])
+                rights.append(right[close])
+        return numpy.concatenate(lefts), numpy.concatenate(rights)
+
+    def clusters(self) -> List[List[str]]:
+        """
+        Groups of near duplicate images, largest first.
+        """
+        unique, inverse = numpy.unique(self.hashes, return_inverse=True)
+        left, right = self._edges(unique)
+        components = _components(len(unique), left, right)[inverse.ravel()]
+
+        order = numpy.argsort(components, kind='stable')
+        boundaries = numpy.flatnonzero(numpy.diff(components[order])) + 1
+        clusters = [[self.image_ids[position] for position in group.tolist()]
+                    for group in numpy.split(order, boundaries) if len(group) > 1]
+        return sorted(clusters, key=len, reverse=True)
@@ -1,8 +1,10 @@
-from fastapi import APIRouter, Depends, File, UploadFile
+from fastapi import APIRouter, Depends, File, Query, UploadFile
 
 from dependencies import dataset_belongs_to_user
 from logger import logger
-from routers.images.core import find_images, find_image, remove_all_images, remove_image, insert_images
+from routers.images.core import find_images, find_image, remove_all_images, remove_image, insert_images, \
+    find_duplicates
+from routers.images.duplicates import MAX_DISTANCE
 from routers.images.models import *
 from utils import parse
 
@@ -14,15 +16,17 @@ def get_images(dataset_id: str,
                original_image_id: Optional[str] = None,
                include_labels=False,
                offset: int = 0,
-               limit: int = 0):
+               limit: int = 0,
+               rendition: Optional[ImageRendition] = None):
     """
-    Fetch paginated images list of given dataset.
+    Fetch paginated images list of given dataset, with paths of given rendition (full size by default).
     """
     response = {'images': find_images(dataset_id,
                                       original_image_id,
                                       include_labels=include_labels,
                                       offset=offset,
-                                      limit=limit)}
+                                      limit=limit,
+                                      rendition=rendition)}
     logger.notify('Images', f'Fetch images of dataset `{dataset_id}`')
     return parse(response)
 
@@ -37,6 +41,17 @@ def get_image_ids(dataset_id: str):
     return parse(response)
 
 
+@images.get('/duplicates', response_model=ImageDuplicatesResponse)
+def get_image_duplicates(dataset_id: str, max_distance: Optional[int] = Query(None, ge=0, le=MAX_DISTANCE)):
+    """
+    Fetch clusters of near duplicate original images of given dataset, largest first.
+    Near duplicates differ by `max_distance` bits at most (16), `IMAGES_DUPLICATE_DISTANCE` by default.
+    """
+    response = {'clusters': find_duplicates(dataset_id, max_distance)}
+    logger.notify('Images', f'Fetch duplicates of dataset `{dataset_id}`')
+    return parse(response)
+
+
 @images.get('/{image_id}', response_model=ImageResponse)
 def get_image(dataset_id, image_id):
     """
@@ -48,11 +63,14 @@ def get_image(dataset_id, image_id):
 
 
 @images.post('/')
-def post_images(dataset_id, files: List[UploadFile] = File(...), dataset=Depends(dataset_belongs_to_user)):
+def post_images(dataset_id,
+                files: List[UploadFile] = File(...),
+                duplicates: DuplicatesPolicy = DuplicatesPolicy.flag,
+                dataset=Depends(dataset_belongs_to_user)):
     """
-    Upload a list of images.
+    Upload a list of images. Near duplicates of images of the dataset are flagged (default), skipped or kept.
     """
-    response = {'images': insert_images(dataset_id, files)}
+    response = {'images': insert_images(dataset_id, files, duplicates)}
     logger.notify('Images', f'Upload {len(files)} for dataset `{dataset_id}`')
     return parse(response)
 
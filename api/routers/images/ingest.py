@@ -0,0 +1,127 @@
+import struct
+from typing import Dict, Optional, Tuple
+
+import cv2
+import numpy
+
+# Runs in the ingest processes : settings are passed as arguments, `config` would connect to mongo on import.
+
+RENDITIONS_ENCODING = {'jpg': ('.jpg', 'image/jpeg', [cv2.IMWRITE_JPEG_QUALITY, 85]),
+                       'webp': ('.webp', 'image/webp', [cv2.IMWRITE_WEBP_QUALITY, 80])}
+
+# Start Of Frame markers, holding the size of a JPEG
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+REDUCED_DECODES = [(8, cv2.IMREAD_REDUCED_COLOR_8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+                   (4, cv2.IMREAD_REDUCED_COLOR_4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                   (2, cv2.IMREAD_REDUCED_COLOR_2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+                   (1, cv2.IMREAD_COLOR, cv2.IMREAD_GRAYSCALE)]
+
+
+def compressed_size(width, height) -> Tuple[int, int]:
+    """
+    Size of an image once compressed : 1280 px wide at most, else 720 px high at most.
+    """
+    if width > 1280:
+        compression_ratio = width / 1280
+    elif height > 720:
+        compression_ratio = height / 720
+    else:
+        return width, height
+    return int(width / compression_ratio), int(height / compression_ratio)
+
+
+def compress_image(image):
+    height, width = image.shape[:2]
+    size = compressed_size(width, height)
+    if size != (width, height):
+        image = cv2.resize(image, size)
+    return image
+
+
+def encode_renditions(image, sizes: Dict[str, int], renditions_format) -> Dict[str, bytes]:
+    """
+    Encode renditions of decoded `image` smaller than it, in `renditions_format`, from the largest to the smallest
+    of `sizes` (largest side in px, by name), each one resized from the previous one.
+    """
+    extension, _, encoding = RENDITIONS_ENCODING[renditions_format]
+    renditions = {}
+    for name, size in sorted(sizes.items(), key=lambda item: -item[1]):
+        height, width = image.shape[:2]
+        if max(width, height) <= size:
+            continue
+        ratio = size / max(width, height)
+        image = cv2.resize(image, (max(1, round(width * ratio)), max(1, round(height * ratio))),
+                           interpolation=cv2.INTER_AREA)
+        renditions[name] = cv2.imencode(extension, image, encoding)[1].tobytes()
+    return renditions
+
+
+def dhash(image) -> int:
+    """
+    64 bits difference hash of decoded `image` : whether each pixel of its 9×8 greyscale thumbnail is brighter than
+    its right neighbour. Resizing, compression & small color changes keep it, or flip a few bits only.
+    Signed, to be stored as a Mongo int64.
+    """
+    grey = image if image.ndim == 2 else cv2.cvtColor(image[..., :3], cv2.COLOR_BGR2GRAY)
+    thumbnail = cv2.resize(grey, (9, 8), interpolation=cv2.INTER_AREA)
+    return int(numpy.packbits(thumbnail[:, 1:] > thumbnail[:, :-1]).view('>i8')[0])
+
+
+def jpeg_frame(data: bytes) -> Optional[Tuple[int, int, int]]:
+    """
+    `(width, height, components)` read in the frame header of JPEG `data`, without decoding it. None if not a JPEG.
+    """
+    if data[:2] != b'\xff\xd8':
+        return None
+    position = 2
+    while position + 4 <= len(data):
+        if data[position] != 0xFF:
+            return None
+        marker = data[position + 1]
+        if marker == 0xFF:  # fill byte
+            position += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:  # markers without length
+            position += 2
+            continue
+        if marker in JPEG_SOF_MARKERS:
+            if position + 10 > len(data):
+                return None
+            height, width, components = struct.unpack('>HHB', data[position + 5:position + 10])
+            return width, height, components
+        position += 2 + struct.unpack('>H', data[position + 2:position + 4])[0]
+    return None
+
+
+def decode_flags(frame) -> int:
+    """
+    Decode a JPEG at the smallest scale (1/8, 1/4, 1/2) still larger than its compressed size : the JPEG decoder
+    skips the pixels that would be thrown away by the resize. Other images are decoded fully.
+    Orientation is ignored & greyscale kept, like full decodes with `IMREAD_UNCHANGED`.
+    """
+    if frame is None:
+        return cv2.IMREAD_UNCHANGED
+    width, height, components = frame
+    target_width, target_height = compressed_size(width, height)
+    for factor, color, greyscale in REDUCED_DECODES:
+        if -(-width // factor) >= target_width and -(-height // factor) >= target_height:
+            return (greyscale if components == 1 else color) | cv2.IMREAD_IGNORE_ORIENTATION
+
+
+def ingest_image(data: bytes, renditions: Dict[str, int], renditions_format) \
+        -> Optional[Tuple[bytes, Tuple[int, int], Dict[str, bytes], int]]:
+    """
+    Decode an uploaded file, compress it & encode it with its `renditions` in `renditions_format`, and hash it.
+    Returns `(image_bytes, (width, height), renditions, dhash)`, or None if the file is not an image.
+    """
+    frame = jpeg_frame(data)
+    image = cv2.imdecode(numpy.frombuffer(data, numpy.uint8), decode_flags(frame))
+    if image is None:
+        return None
+    height, width = image.shape[:2]
+    size = compressed_size(*(frame[:2] if frame else (width, height)))
+    if size != (width, height):
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    renditions = encode_renditions(image, renditions, renditions_format)
+    return cv2.imencode('.jpg', image)[1].tobytes(), size, renditions, dhash(image)
+
@@ -1,4 +1,5 @@
-from typing import List, Optional
+from enum import Enum
+from typing import Dict, List, Optional
 
 from pydantic import BaseModel, Field
 
@@ -6,6 +7,17 @@ from routers.labels.models import Label
 from utils import MongoModel
 
 
+class ImageRendition(str, Enum):
+    thumbnail = 'thumbnail'
+    preview = 'preview'
+
+
+class DuplicatesPolicy(str, Enum):
+    keep = 'keep'
+    flag = 'flag'
+    skip = 'skip'
+
+
 class Image(MongoModel):
     id: str = Field()
     dataset_id: str
@@ -16,6 +28,11 @@ class Image(MongoModel):
     height: int
     pipeline_id: Optional[str] = None
     original_image_id: Optional[str] = None
+    seed: Optional[int] = None
+    is_virtual: bool = False
+    renditions: Optional[Dict[str, str]] = None
+    dhash: Optional[int] = None
+    duplicate_of: Optional[str] = None
 
 
 class ImageExtended(Image):
@@ -30,6 +47,10 @@ class ImageIdsResponse(BaseModel):
     image_ids: List[str] = []
 
 
+class ImageDuplicatesResponse(BaseModel):
+    clusters: List[List[str]] = []
+
+
 class ImageResponse(BaseModel):
     image: Image
 
@@ -4,6 +4,7 @@ from typing import Dict, List
 import errors
 from config import Config
 from routers.labels.models import Label
+from utils import BulkWriter
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
@@ -61,23 +62,20 @@ def replace_labels(image_id, labels) -> Dict[str, int]:
     # Find current image labels
     old_labels = find_labels(image_id)
 
-    # Delete these labels
-    db.labels.delete_many({'image_id': image_id})
-
-    # Update labels_count on associated categories
-    old = regroup_labels_by_category(old_labels)
-    new = regroup_labels_by_category(labels)
-    merged = merge_regrouped_labels(old, new)
-    for category_id, labels_count in merged.items():
-        db.categories.find_one_and_update(
-            {'_id': category_id},
-            {'$inc': {'labels_count': labels_count}}
-        )
-
-    # Insert new labels
-    if labels:
-        db.labels.insert_many([{**label.dict(),
-                                'image_id': image_id,
-                                '_id': str(uuid.uuid4())} for label in labels])
+    with BulkWriter() as writer:
+        # Delete these labels
+        writer.delete_many('labels', {'image_id': image_id})
+
+        # Update labels_count on associated categories
+        old = regroup_labels_by_category(old_labels)
+        new = regroup_labels_by_category(labels)
+        merged = merge_regrouped_labels(old, new)
+        for category_id, labels_count in merged.items():
+            writer.increment('categories', category_id, 'labels_count', labels_count)
+
+        # Insert new labels
+        writer.insert_many('labels', [{**label.dict(),
+                                       'image_id': image_id,
+                                       '_id': str(uuid.uuid4())} for label in labels])
 
     return merged
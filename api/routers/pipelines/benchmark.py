@@ -0,0 +1,66 @@
+import random
+import time
+
+import cv2
+import numpy
+from Augmentor import DataPipeline
+from PIL import Image as PILImage
+
+from logger import logger
+from routers.pipelines.operations import draw_operation
+
+# Microbenchmark of every operation on a 720p image, Augmentor (PIL) path against native OpenCV kernels.
+# Run from `api` folder : `python -m routers.pipelines.benchmark`
+
+OPERATIONS = [
+    ('rotate', {'max_left_rotation': 10, 'max_right_rotation': 10}),
+    ('flip_random', {}),
+    ('skew', {'magnitude': 0.3}),
+    ('crop_random', {'percentage_area': 0.7, 'randomise_percentage_area': True}),
+    ('shear', {'max_shear_left': 10, 'max_shear_right': 10}),
+    ('random_distortion', {'grid_width': 4, 'grid_height': 4, 'magnitude': 8}),
+    ('gaussian_distortion', {'grid_width': 4, 'grid_height': 4, 'magnitude': 8, 'corner': 'bell', 'method': 'in'}),
+    ('random_brightness', {'min_factor': 0.5, 'max_factor': 1.5}),
+    ('random_color', {'min_factor': 0.5, 'max_factor': 1.5}),
+    ('random_contrast', {'min_factor': 0.5, 'max_factor': 1.5}),
+    ('histogram_equalisation', {}),
+    ('invert', {}),
+    ('greyscale', {})
+]
+
+
+def _time(run, repeat):
+    start = time.perf_counter()
+    for seed in range(repeat):
+        run(seed)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def benchmark(width=1280, height=720, repeat=20):
+    image = cv2.GaussianBlur(numpy.random.randint(0, 256, (height, width, 3), numpy.uint8), (15, 15), 0)
+    size = (width, height)
+    results = {}
+
+    for operation_type, properties in OPERATIONS:
+        pipeline = DataPipeline([], [])
+        getattr(pipeline, operation_type)(probability=1, **properties)
+        operation = pipeline.operations[0]
+
+        def augmentor(seed):
+            do, _, _ = draw_operation(operation, size, random.Random(seed))
+            return numpy.asarray(do(PILImage.fromarray(image)))
+
+        def native(seed):
+            do, _, _ = draw_operation(operation, size, random.Random(seed), native=True)
+            return do(image)
+
+        results[operation_type] = (_time(augmentor, repeat), _time(native, repeat))
+
+    for operation_type, (augmentor_ms, native_ms) in results.items():
+        logger.notify('Benchmark', f'{operation_type:<24} augmentor {augmentor_ms:7.2f} ms | '
+                                   f'opencv {native_ms:7.2f} ms | x{augmentor_ms / native_ms:.1f}')
+    return results
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -1,5 +1,10 @@
+import functools
+import hashlib
+import json
+import os
 import random
-from typing import List, Union
+import threading
+from typing import List, Tuple, Union
 from uuid import uuid4
 
 import cv2
@@ -13,11 +18,19 @@ from config import Config
 from routers.images.core import find_images, remove_augmented_images
 from routers.images.models import Image
 from routers.labels.models import Label
-from routers.pipelines.models import Operation
+from routers.pipelines.operations import GEOMETRIC_OPERATIONS, DISTORTION_OPERATIONS, draw_operation, warp, \
+    transform_boxes
+from routers.pipelines.models import Operation, OperationBackend
 from routers.pipelines.models import Pipeline
+from storage.core import StorageNotFound, StorageError, storage
+from utils import LRUCache
 
 db = Config.db
 
+render_cache = LRUCache(Config.RENDER_CACHE_MAX_BYTES)
+render_slots = threading.BoundedSemaphore(Config.RENDER_MAX_CONCURRENCY or os.cpu_count())
+sample_cache = LRUCache(Config.SAMPLE_CACHE_MAX_BYTES, ttl=Config.SAMPLE_CACHE_TTL)
+
 
 def find_pipelines(dataset_id, offset=0, limit=0) -> List[Label]:
     pipelines = list(db.pipelines.find({'dataset_id': dataset_id}).skip(offset).limit(limit))
@@ -35,12 +48,28 @@ def delete_pipeline(dataset_id, pipeline_id):
 
 
 def from_image_bytes(image_bytes):
-    return cv2.imdecode(numpy.fromstring(image_bytes, numpy.uint8), cv2.IMREAD_UNCHANGED)
+    return cv2.imdecode(numpy.frombuffer(image_bytes, numpy.uint8), cv2.IMREAD_UNCHANGED)
 
 
 def from_image_path(path):
-    image_bytes = requests.get(path).content
-    return from_image_bytes(image_bytes)
+    """
+    Decode the image at `path` from storage, straight from the mapped file with `local` storage.
+    Images outside of storage (stored with another backend) are downloaded.
+    Raises `StorageNotFound` if there is no image at `path`, `StorageError` if it cannot be read.
+    """
+    key = storage.key(path)
+    if key is None:
+        try:
+            response = requests.get(path)
+        except requests.RequestException as e:
+            raise StorageError(f'Cannot download {path}, {str(e)}') from e
+        if response.status_code in (403, 404):  # missing objects of a private S3 bucket answer 403
+            raise StorageNotFound(f'Object not found, {path}')
+        if not response.ok:
+            raise StorageError(f'{path} answered {response.status_code}')
+        return from_image_bytes(response.content)
+    with storage.open(key) as image_bytes:
+        return from_image_bytes(image_bytes)
 
 
 def draw_ellipsis(width, height, label: Label):
@@ -58,7 +87,7 @@ def draw_ellipsis(width, height, label: Label):
 def retrieve_label_from_ellipsis(image, image_id) -> Union[Label, None]:
     mask = cv2.inRange(image, (120, 120, 120), (255, 255, 255))
     rect = cv2.boundingRect(mask)
-    if not rect:
+    if not rect[2] or not rect[3]:  # ellipse out of the image
         return None
     label = Label(
         id=str(uuid4()),
@@ -71,62 +100,260 @@ def retrieve_label_from_ellipsis(image, image_id) -> Union[Label, None]:
     return label
 
 
+def labels_to_boxes(labels: List[Label], width, height):
+    return numpy.array([[label.x * width, label.y * height, (label.x + label.w) * width, (label.y + label.h) * height]
+                        for label in labels], dtype=numpy.float64).reshape(-1, 4)
+
+
+def boxes_to_labels(boxes, width, height, image_id) -> List[Union[Label, None]]:
+    return [Label(
+        id=str(uuid4()),
+        image_id=image_id,
+        x=round(float(box[0]) / width, 6),
+        y=round(float(box[1]) / height, 6),
+        w=round(float(box[2] - box[0]) / width, 6),
+        h=round(float(box[3] - box[1]) / height, 6)
+    ) if box[2] > box[0] and box[3] > box[1] else None for box in boxes]
+
+
+def _augment(sources, labels: List[Label], operations, image_id, seed, label_mode, size, native):
+    """
+    Run Augmentor `operations` on `sources`, the image followed by its ellipse masks in `raster` mode.
+    In `geometric` mode `sources` is the image only : label boxes go through the matrix of each geometric
+    operation, and are rasterised to ellipse masks only once a distortion operation is performed.
+    Every random draw comes from `seed`. When the image is None, only its labels are computed.
+    With `native`, operations run on numpy arrays with OpenCV kernels, PIL is not used.
+    Consecutive geometric operations are composed, and resample images only once.
+    """
+    rng = random.Random(seed)
+    to_image = (lambda array: array) if native else PILImage.fromarray
+    augmented_images = [to_image(x) if x is not None else None for x in sources]
+
+    boxes = None
+    if label_mode == 'geometric':
+        boxes = labels_to_boxes(labels, *size)
+
+    def apply(do, images):
+        return [do(image) if image is not None else None for image in images]
+
+    # Geometric operations drawn but not applied yet : their kernels, and their composed matrix
+    pending, pending_matrix = [], None
+
+    def apply_pending(images):
+        if len(pending) == 1:
+            return apply(pending[0], images)
+        return apply(warp(pending_matrix, size, native), images)
+
+    for operation in operations:
+        roll = round(rng.uniform(0, 1), 1)
+        if roll > operation.probability:
+            continue
+        do, matrix, size = draw_operation(operation, size, rng, native)
+        if type(operation) in GEOMETRIC_OPERATIONS:
+            pending.append(do)
+            pending_matrix = matrix if pending_matrix is None else matrix @ pending_matrix
+            if boxes is not None:
+                boxes = transform_boxes(boxes, matrix, *size)
+            continue
+
+        if pending:
+            augmented_images = apply_pending(augmented_images)
+            pending, pending_matrix = [], None
+
+        if type(operation) in DISTORTION_OPERATIONS and boxes is not None:
+            width, height = size
+            for label in boxes_to_labels(boxes, width, height, image_id):
+                mask = draw_ellipsis(width, height, label) if label else numpy.zeros((height, width, 3), numpy.uint8)
+                augmented_images.append(to_image(mask))
+            boxes = None
+            augmented_images = apply(do, augmented_images)
+        elif type(operation) in DISTORTION_OPERATIONS:
+            augmented_images = apply(do, augmented_images)
+        else:
+            # Color operations must not alter ellipse masks
+            augmented_images = apply(do, augmented_images[:1]) + augmented_images[1:]
+
+    if pending:
+        augmented_images = apply_pending(augmented_images)
+
+    if boxes is None:
+        new_labels = [retrieve_label_from_ellipsis(numpy.asarray(image), image_id)
+                      for image in augmented_images[1:]]
+    else:
+        new_labels = boxes_to_labels(boxes, *size, image_id)
+
+    for index, label in enumerate(new_labels):
+        if label:
+            label.category_id = labels[index].category_id
+
+    return augmented_images[0], list(filter(None.__ne__, new_labels)), size
+
+
+def augment_sample(sources, labels: List[Label], operations, image_id, seed=None, label_mode=None,
+                   backend=OperationBackend.AUGMENTOR) -> Tuple[numpy.ndarray, List[Label]]:
+    label_mode = label_mode or Config.AUGMENTOR_LABEL_MODE
+    size = (sources[0].shape[1], sources[0].shape[0])
+    augmented_image, labels, _ = _augment(sources, labels, operations, image_id, seed, label_mode, size,
+                                          native=backend == OperationBackend.OPENCV)
+    return numpy.asarray(augmented_image), labels
+
+
+def augment_labels(size, masks, labels: List[Label], operations, image_id, seed, label_mode=None,
+                   backend=OperationBackend.AUGMENTOR) -> Tuple[Tuple[int, int], List[Label]]:
+    """
+    Labels & size of the image `augment_sample` would render with the same `seed`, without touching its pixels.
+    """
+    label_mode = label_mode or Config.AUGMENTOR_LABEL_MODE
+    _, labels, size = _augment([None, *masks], labels, operations, image_id, seed, label_mode, size,
+                               native=backend == OperationBackend.OPENCV)
+    return size, labels
+
+
+def canonical_operations(operations: List[Operation]) -> str:
+    return json.dumps([operation.dict() for operation in operations], sort_keys=True, default=str)
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_operations(canonical: str) -> tuple:
+    pipeline = DataPipeline([], [])
+    for operation in json.loads(canonical):
+        getattr(pipeline, operation['type'])(probability=operation['probability'], **operation['properties'])
+    return tuple(pipeline.operations)
+
+
+def build_operations(operations: List[Operation]) -> list:
+    """
+    Augmentor operations of `operations`, compiled once per distinct pipeline.
+    """
+    return list(_compile_operations(canonical_operations(operations)))
+
+
+def virtual_image_path(image_id) -> str:
+    return f'{Config.API_URI}/v2/public/renders/{image_id}'
+
+
+def render_virtual_image(image_id) -> bytes:
+    """
+    Render a virtual augmented image from its recipe : original image, pipeline operations and seed.
+    Only images stored with `is_virtual` are rendered, at most `RENDER_MAX_CONCURRENCY` at once per process.
+    """
+    image = db.images.find_one({'_id': image_id, 'is_virtual': True})
+    if image is None:
+        raise errors.NotFound('Images', errors.IMAGE_NOT_FOUND)
+
+    image_bytes = render_cache.get(image_id)
+    if image_bytes is not None:
+        return image_bytes
+
+    image = Image.from_mongo(image)
+    original_image = db.images.find_one({'_id': image.original_image_id})
+    if original_image is None:
+        raise errors.NotFound('Images', errors.IMAGE_NOT_FOUND)
+    pipeline = db.pipelines.find_one({'_id': image.pipeline_id})
+    if pipeline is None:
+        raise errors.NotFound('Pipelines', errors.PIPELINE_NOT_FOUND)
+    original_image = Image.from_mongo(original_image)
+    pipeline = Pipeline.from_mongo(pipeline)
+
+    with render_slots:
+        try:
+            pixels = from_image_path(original_image.path)
+        except StorageNotFound:
+            raise errors.NotFound('Images', errors.IMAGE_NOT_FOUND)
+        augmented_image, _ = augment_sample([pixels],
+                                            [],
+                                            build_operations(pipeline.operations),
+                                            image.id,
+                                            seed=image.seed,
+                                            label_mode='geometric',
+                                            backend=pipeline.backend)
+        image_bytes = cv2.imencode('.jpg', augmented_image)[1].tostring()
+    return render_cache.put(image_id, image_bytes)
+
+
+def load_sample_source(image: Image):
+    """
+    Decoded original image, kept in `sample_cache` while its pipeline sample is being tweaked.
+    """
+    key = ('source', image.id, image.path)
+    pixels = sample_cache.get(key)
+    if pixels is None:
+        pixels = from_image_path(image.path)
+        pixels.setflags(write=False)
+        sample_cache.put(key, pixels)
+    return pixels
+
+
+def sample_digest(labels: List[Label], operations: List[Operation], backend=OperationBackend.AUGMENTOR) -> str:
+    """
+    Canonical hash of sample inputs : same operations, labels and backend, in the same order, same digest.
+    """
+    canonical = json.dumps({'operations': canonical_operations(operations),
+                            'backend': backend,
+                            'labels': [[label.x, label.y, label.w, label.h, label.category_id] for label in labels]},
+                           sort_keys=True,
+                           default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
 class AugmentorPipeline(DataPipeline):
 
-    def __init__(self, image: Image, labels: List[Label]):
+    def __init__(self, image: Image, labels: List[Label], backend=OperationBackend.AUGMENTOR):
         self.image = image
         self.labels = labels
+        self.backend = backend
         super().__init__(image, labels)
 
-    def sample(self, n, cv2image=None):
+    def sample(self, n, cv2image=None, seed=None):
         if cv2image is None:
-            images = [from_image_path(self.image.path)]
+            images = [load_sample_source(self.image)]
         else:
             images = [cv2image]
 
-        for label in self.labels:
-            images.append(draw_ellipsis(self.image.width, self.image.height, label))
-
-        input_images = [PILImage.fromarray(x) for x in images]
+        if Config.AUGMENTOR_LABEL_MODE == 'raster':
+            for label in self.labels:
+                images.append(draw_ellipsis(self.image.width, self.image.height, label))
 
+        rng = random.Random(seed)
         output_images = []
         output_images_labels: List[List[Label]] = []
         for i in range(0, n):
-            augmented_images = input_images
-
-            for operation in self.operations:
-                roll = round(random.uniform(0, 1), 1)
-                if roll <= operation.probability:
-                    augmented_images = operation.perform_operation(augmented_images)
-
-            output_images.append(numpy.asarray(augmented_images[0]))
-
-            labels = [retrieve_label_from_ellipsis(numpy.asarray(image), self.image.id)
-                      for image in augmented_images[1:]]
-
-            for index, label in enumerate(labels):
-                if label:
-                    label.category_id = self.labels[index].category_id
-
-            labels = list(filter(None.__ne__, labels))
-
+            output_image, labels = augment_sample(images, self.labels, self.operations, self.image.id,
+                                                  seed=rng.getrandbits(32), backend=self.backend)
+            output_images.append(output_image)
             output_images_labels.append(labels)
 
         return output_images, output_images_labels
 
 
-def perform_sample(image: Image, labels: List[Label], operations: List[Operation], cv2image=None, n=None):
-    pipeline = AugmentorPipeline(image, labels)
-    for operation in operations:
-        getattr(pipeline, operation.type)(probability=operation.probability, **operation.properties)
+def perform_sample(image: Image, labels: List[Label], operations: List[Operation], cv2image=None, n=None,
+                   seed=None, backend=OperationBackend.AUGMENTOR):
+    pipeline = AugmentorPipeline(image, labels, backend)
+    pipeline.operations = build_operations(operations)
     if cv2image is not None:
         if cv2image.shape[1] > cv2image.shape[0]:
-            return pipeline.sample(4, cv2image=cv2image)
+            return pipeline.sample(4, cv2image=cv2image, seed=seed)
         else:
-            return pipeline.sample(3, cv2image=cv2image)
+            return pipeline.sample(3, cv2image=cv2image, seed=seed)
     elif n:
-        return pipeline.sample(n)
+        return pipeline.sample(n, seed=seed)
     elif image.width > image.height:
-        return pipeline.sample(4)
+        return pipeline.sample(4, seed=seed)
     else:
-        return pipeline.sample(3)
+        return pipeline.sample(3, seed=seed)
+
+
+def perform_cached_sample(image: Image, labels: List[Label], operations: List[Operation], seed,
+                          backend=OperationBackend.AUGMENTOR) -> Tuple[List[bytes], List[List[Label]]]:
+    """
+    JPEG encoded sample of `image`, memoized by image, operations, labels, backend and seed :
+    a repeated or undone configuration is served from `sample_cache`.
+    """
+    key = ('sample', image.id, sample_digest(labels, operations, backend), seed)
+    sample = sample_cache.get(key)
+    if sample is not None:
+        return sample
+
+    augmented_images, augmented_labels = perform_sample(image, labels, operations, seed=seed, backend=backend)
+    encoded_images = [cv2.imencode('.jpg', augmented_image)[1].tostring() for augmented_image in augmented_images]
+    return sample_cache.put(key, (encoded_images, augmented_labels))
@@ -1,5 +1,5 @@
 from enum import Enum
-from typing import List
+from typing import List, Optional
 
 from pydantic import BaseModel, Field
 from routers.labels.models import Label
@@ -23,6 +23,11 @@ class OperationType(str, Enum):
     GREYSCALE = 'greyscale'
 
 
+class OperationBackend(str, Enum):
+    AUGMENTOR = 'augmentor'  # PIL, as implemented by Augmentor
+    OPENCV = 'opencv'  # native kernels on numpy arrays
+
+
 class Operation(BaseModel):
     type: OperationType
     probability: float
@@ -34,6 +39,7 @@ class Pipeline(MongoModel):
     dataset_id: str
     image_count: int
     operations: List[Operation]
+    backend: OperationBackend = OperationBackend.AUGMENTOR
 
 
 class PipelinesResponse(BaseModel):
@@ -42,8 +48,11 @@ class PipelinesResponse(BaseModel):
 
 class SampleBody(BaseModel):
     operations: List[Operation]
+    backend: OperationBackend = OperationBackend.AUGMENTOR
+    seed: Optional[int] = None
 
 
 class SampleResponse(BaseModel):
     images: List[str]  # base64 encoded
     images_labels: List[List[Label]]
+    seed: Optional[int] = None
@@ -0,0 +1,450 @@
+import math
+import random
+
+import cv2
+import numpy
+from Augmentor.Operations import CropPercentage, Distort, Flip, GaussianDistortion, Greyscale, \
+    HistogramEqualisation, Invert, RandomBrightness, RandomColor, RandomContrast, RotateRange, Shear, Skew
+from PIL import Image as PILImage, ImageEnhance
+
+# Operations of Augmentor, split in two steps : every random parameter is first drawn from a given `rng`
+# for an input `size`, returning `(do, matrix, size)` where `do` transforms one PIL image, `matrix` maps
+# input pixel coordinates to output pixel coordinates (None for non-geometric operations) and `size`
+# is the output size. Same seed, same output : augmented images can be re-rendered from their recipe.
+# With `native`, `do` transforms one numpy array with OpenCV instead, from the same parameters.
+
+EPSILON = 1e-6  # pixels, points on the image border are inside it
+
+
+def _affine(coefficients):
+    a, b, c, d, e, f = coefficients
+    return numpy.array([[a, b, c], [d, e, f], [0, 0, 1]], dtype=numpy.float64)
+
+
+def _translation(tx, ty):
+    return _affine((1, 0, tx, 0, 1, ty))
+
+
+def _scaling(sx, sy):
+    return _affine((sx, 0, 0, 0, sy, 0))
+
+
+def _warp(image, matrix, size):
+    """
+    OpenCV warp of `image` by `matrix`, expressed like PIL in pixel corner coordinates.
+    """
+    matrix = _translation(-0.5, -0.5) @ matrix @ _translation(0.5, 0.5)
+    if numpy.allclose(matrix[2], [0, 0, 1]):
+        return cv2.warpAffine(image, matrix[:2], size, flags=cv2.INTER_CUBIC)
+    return cv2.warpPerspective(image, matrix, size, flags=cv2.INTER_CUBIC)
+
+
+def _grey(image):
+    if image.ndim == 2:
+        return image
+    # Arrays are read as RGB, like `PILImage.fromarray` does
+    return cv2.cvtColor(image, cv2.COLOR_RGBA2GRAY if image.shape[2] == 4 else cv2.COLOR_RGB2GRAY)
+
+
+def _grey_like(grey, image):
+    if image.ndim == 2:
+        return grey
+    return cv2.cvtColor(grey, cv2.COLOR_GRAY2RGBA if image.shape[2] == 4 else cv2.COLOR_GRAY2RGB)
+
+
+def _equalize(image):
+    """
+    Same lookup tables as `PIL.ImageOps.equalize`, one per channel.
+    """
+    channels = 1 if image.ndim == 2 else image.shape[2]
+    luts = []
+    for channel in range(channels):
+        histogram = cv2.calcHist([image], [channel], None, [256], [0, 256]).ravel().astype(numpy.int64)
+        non_zero = histogram[histogram > 0]
+        step = (non_zero.sum() - non_zero[-1]) // 255
+        if step:
+            luts.append(numpy.minimum((step // 2 + numpy.cumsum(histogram) - histogram) // step, 255))
+        else:
+            luts.append(numpy.arange(256))
+    return cv2.LUT(image, numpy.stack(luts, axis=-1).reshape(1, 256, channels).astype(numpy.uint8))
+
+
+def rotate(operation: RotateRange, size, rng, native=False):
+    random_left = rng.randint(operation.max_left_rotation, 0)
+    random_right = rng.randint(0, operation.max_right_rotation)
+    left_or_right = rng.randint(0, 1)
+    rotation = random_left if left_or_right == 0 else random_right
+
+    x, y = size
+
+    # Same inverse matrix & expanded canvas as `PIL.Image.rotate(rotation, expand=True)`
+    angle = -math.radians(rotation % 360.0)
+    cos, sin = round(math.cos(angle), 15), round(math.sin(angle), 15)
+    inverse = _translation(x / 2, y / 2) @ _affine((cos, sin, 0, -sin, cos, 0)) @ _translation(-x / 2, -y / 2)
+    corners = inverse @ numpy.array([[0, x, x, 0], [0, 0, y, y], [1, 1, 1, 1]])
+    X = math.ceil(corners[0].max()) - math.floor(corners[0].min())
+    Y = math.ceil(corners[1].max()) - math.floor(corners[1].min())
+    inverse = inverse @ _translation(-(X - x) / 2, -(Y - y) / 2)
+
+    # Largest area of same aspect ratio, as computed by Augmentor
+    angle_a_rad = math.radians(abs(rotation))
+    angle_b_rad = math.radians(90 - abs(rotation))
+    E = (math.sin(angle_a_rad)) / (math.sin(angle_b_rad)) * \
+        (Y - X * (math.sin(angle_a_rad) / math.sin(angle_b_rad)))
+    E = E / 1 - (math.sin(angle_a_rad) ** 2 / math.sin(angle_b_rad) ** 2)
+    B = X - E
+    A = (math.sin(angle_a_rad) / math.sin(angle_b_rad)) * B
+    box = (int(round(E)), int(round(A)), int(round(X - E)), int(round(Y - A)))
+
+    matrix = _scaling(x / (box[2] - box[0]), y / (box[3] - box[1])) \
+        @ _translation(-box[0], -box[1]) \
+        @ numpy.linalg.inv(inverse)
+
+    def do(image):
+        image = image.rotate(rotation, expand=True, resample=PILImage.BICUBIC)
+        image = image.crop(box)
+        return image.resize((x, y), resample=PILImage.BICUBIC)
+
+    if native:
+        return lambda image: _warp(image, matrix, size), matrix, size
+    return do, matrix, size
+
+
+def flip_random(operation: Flip, size, rng, native=False):
+    random_axis = rng.randint(0, 1)
+    w, h = size
+
+    if random_axis == 0:
+        method, flip_code, matrix = PILImage.FLIP_LEFT_RIGHT, 1, _affine((-1, 0, w, 0, 1, 0))
+    else:
+        method, flip_code, matrix = PILImage.FLIP_TOP_BOTTOM, 0, _affine((1, 0, 0, 0, -1, h))
+
+    if native:
+        return lambda image: cv2.flip(image, flip_code), matrix, size
+    return lambda image: image.transpose(method), matrix, size
+
+
+def skew(operation: Skew, size, rng, native=False):
+    w, h = size
+    x1, x2, y1, y2 = 0, h, 0, w
+    original_plane = [(y1, x1), (y2, x1), (y2, x2), (y1, x2)]
+
+    max_skew_amount = int(math.ceil(max(w, h) * operation.magnitude))
+    skew_amount = rng.randint(1, max_skew_amount)
+    skew_type = rng.choice(['TILT', 'TILT_LEFT_RIGHT', 'TILT_TOP_BOTTOM', 'CORNER'])
+
+    if skew_type == 'CORNER':
+        skew_direction = rng.randint(0, 7)
+        new_plane = list(original_plane)
+        corner = skew_direction // 2
+        dx, dy = [(-skew_amount, 0), (0, -skew_amount),
+                  (skew_amount, 0), (0, -skew_amount),
+                  (skew_amount, 0), (0, skew_amount),
+                  (-skew_amount, 0), (0, skew_amount)][skew_direction]
+        new_plane[corner] = (new_plane[corner][0] + dx, new_plane[corner][1] + dy)
+    else:
+        if skew_type == 'TILT':
+            skew_direction = rng.randint(0, 3)
+        elif skew_type == 'TILT_LEFT_RIGHT':
+            skew_direction = rng.randint(0, 1)
+        else:
+            skew_direction = rng.randint(2, 3)
+        new_plane = [
+            [(y1, x1 - skew_amount), (y2, x1), (y2, x2), (y1, x2 + skew_amount)],  # Left Tilt
+            [(y1, x1), (y2, x1 - skew_amount), (y2, x2 + skew_amount), (y1, x2)],  # Right Tilt
+            [(y1 - skew_amount, x1), (y2 + skew_amount, x1), (y2, x2), (y1, x2)],  # Forward Tilt
+            [(y1, x1), (y2, x1), (y2 + skew_amount, x2), (y1 - skew_amount, x2)]  # Backward Tilt
+        ][skew_direction]
+
+    matrix = homography(original_plane, new_plane)
+    inverse = numpy.linalg.inv(matrix)
+    coefficients = (inverse / inverse[2, 2]).flatten()[:8]
+
+    def do(image):
+        return image.transform(image.size, PILImage.PERSPECTIVE, coefficients, resample=PILImage.BICUBIC)
+
+    if native:
+        return lambda image: _warp(image, matrix, size), matrix, size
+    return do, matrix, size
+
+
+def crop_random(operation: CropPercentage, size, rng, native=False):
+    if operation.randomise_percentage_area:
+        percentage_area = round(rng.uniform(0.1, operation.percentage_area), 2)
+    else:
+        percentage_area = operation.percentage_area
+
+    w, h = size
+    w_new = int(math.floor(w * percentage_area))
+    h_new = int(math.floor(h * percentage_area))
+    left_shift = rng.randint(0, int((w - w_new)))
+    down_shift = rng.randint(0, int((h - h_new)))
+    box = (left_shift, down_shift, w_new + left_shift, h_new + down_shift)
+    matrix = _translation(-left_shift, -down_shift)
+
+    if native:
+        return lambda image: image[box[1]:box[3], box[0]:box[2]], matrix, (w_new, h_new)
+    return lambda image: image.crop(box), matrix, (w_new, h_new)
+
+
+def shear(operation: Shear, size, rng, native=False):
+    width, height = size
+    angle_to_shear = int(rng.uniform((abs(operation.max_shear_left) * -1) - 1, operation.max_shear_right + 1))
+    if angle_to_shear != -1:
+        angle_to_shear += 1
+    direction = rng.choice(['x', 'y'])
+
+    phi = math.tan(math.radians(angle_to_shear))
+    if direction == 'x':
+        shift_in_pixels = phi * height
+        shift_in_pixels = math.ceil(shift_in_pixels) if shift_in_pixels > 0 else math.floor(shift_in_pixels)
+    else:
+        shift_in_pixels = phi * width
+    matrix_offset = shift_in_pixels
+    if angle_to_shear <= 0:
+        shift_in_pixels = abs(shift_in_pixels)
+        matrix_offset = 0
+        phi = abs(phi) * -1
+
+    if direction == 'x':
+        coefficients = (1, phi, -matrix_offset, 0, 1, 0)
+        transformed_size = (int(round(width + shift_in_pixels)), height)
+        box = (abs(shift_in_pixels), 0, width, height)
+    else:
+        coefficients = (1, 0, 0, phi, 1, -matrix_offset)
+        transformed_size = (width, int(round(height + shift_in_pixels)))
+        box = (0, abs(shift_in_pixels), width, height)
+
+    # `PIL.Image.crop` rounds its box
+    left, top = round(box[0]), round(box[1])
+    matrix = _scaling(width / (width - left), height / (height - top)) \
+        @ _translation(-left, -top) \
+        @ numpy.linalg.inv(_affine(coefficients))
+
+    def do(image):
+        image = image.transform(transformed_size, PILImage.AFFINE, coefficients, PILImage.BICUBIC)
+        image = image.crop(box)
+        return image.resize((width, height), resample=PILImage.BICUBIC)
+
+    if native:
+        return lambda image: _warp(image, matrix, size), matrix, size
+    return do, matrix, size
+
+
+def enhance(operation, size, rng, native=False):
+    factor = rng.uniform(operation.min_factor, operation.max_factor)
+
+    if not native:
+        enhancer = {RandomBrightness: ImageEnhance.Brightness,
+                    RandomColor: ImageEnhance.Color,
+                    RandomContrast: ImageEnhance.Contrast}[type(operation)]
+        return lambda image: enhancer(image).enhance(factor), None, size
+
+    # Blends with the same degenerate images as `PIL.ImageEnhance`
+    def degenerate(image):
+        if type(operation) is RandomBrightness:
+            return numpy.zeros_like(image)
+        grey = _grey(image)
+        if type(operation) is RandomContrast:
+            grey = numpy.full_like(grey, int(grey.mean() + 0.5))
+        return _grey_like(grey, image)
+
+    return lambda image: cv2.addWeighted(image, factor, degenerate(image), 1 - factor, 0), None, size
+
+
+def _mesh(operation, size):
+    """
+    Augmentor distortion grid : boxes tiling the image, their source quads (NW, SW, SE, NE corners),
+    and the indices of the 4 quads sharing each inner vertex.
+    """
+    w, h = size
+    columns, rows = operation.grid_width, operation.grid_height
+    xs = [column * (w // columns) for column in range(columns)] + [w]
+    ys = [row * (h // rows) for row in range(rows)] + [h]
+    boxes = [(xs[column], ys[row], xs[column + 1], ys[row + 1]) for row in range(rows) for column in range(columns)]
+    quads = [[x1, y1, x1, y2, x2, y2, x2, y1] for x1, y1, x2, y2 in boxes]
+    vertices = [(row * columns + column, row * columns + column + 1,
+                 (row + 1) * columns + column, (row + 1) * columns + column + 1)
+                for row in range(rows - 1) for column in range(columns - 1)]
+    return boxes, quads, vertices
+
+
+def _displace(quads, vertex, dx, dy):
+    a, b, c, d = vertex
+    quads[a][4] += dx
+    quads[a][5] += dy
+    quads[b][2] += dx
+    quads[b][3] += dy
+    quads[c][6] += dx
+    quads[c][7] += dy
+    quads[d][0] += dx
+    quads[d][1] += dy
+
+
+def _mesh_maps(boxes, quads, size):
+    """
+    `cv2.remap` maps of `PIL.Image.transform(size, MESH, ...)` : each box is a bilinear warp of its quad.
+    """
+    w, h = size
+    map_x = numpy.empty((h, w), numpy.float32)
+    map_y = numpy.empty((h, w), numpy.float32)
+    for (x1, y1, x2, y2), quad in zip(boxes, quads):
+        u = (numpy.arange(x2 - x1) + 0.5) / (x2 - x1)
+        v = (numpy.arange(y2 - y1)[:, None] + 0.5) / (y2 - y1)
+        for output, (nw, sw, se, ne) in ((map_x, quad[0::2]), (map_y, quad[1::2])):
+            output[y1:y2, x1:x2] = nw + (ne - nw) * u + (sw - nw) * v + (se - sw - ne + nw) * u * v - 0.5
+    return map_x, map_y
+
+
+def _mesh_kernel(boxes, quads, size, native):
+    if native:
+        map_x, map_y = _mesh_maps(boxes, quads, size)
+        return lambda image: cv2.remap(image, map_x, map_y, cv2.INTER_CUBIC), None, size
+
+    mesh = list(zip(boxes, quads))
+    return lambda image: image.transform(image.size, PILImage.MESH, mesh, resample=PILImage.BICUBIC), None, size
+
+
+def distort(operation: Distort, size, rng, native=False):
+    """
+    Same draws as Augmentor, whose `random` generator is seeded from `rng`.
+    """
+    random_state = random.Random(rng.getrandbits(32))
+    boxes, quads, vertices = _mesh(operation, size)
+    for vertex in vertices:
+        dx = random_state.randint(-operation.magnitude, operation.magnitude)
+        dy = random_state.randint(-operation.magnitude, operation.magnitude)
+        _displace(quads, vertex, dx, dy)
+    return _mesh_kernel(boxes, quads, size, native)
+
+
+def gaussian_distort(operation: GaussianDistortion, size, rng, native=False):
+    """
+    Same draws as Augmentor, whose `numpy.random` generator is seeded from `rng`.
+    """
+    random_state = numpy.random.RandomState(rng.getrandbits(32))
+    w, h = size
+
+    x_min, x_max, y_min, y_max = {'dr': (0, 0.5, 0, 0.5),
+                                  'dl': (0.5, 1, 0, 0.5),
+                                  'ur': (0, 0.5, 0.5, 1),
+                                  'ul': (0.5, 1, 0.5, 1),
+                                  'bell': (0, 1, 0, 1)}[operation.corner]
+    const = -1 if operation.method == 'out' else 1
+
+    def surface(x, y):
+        return const * numpy.exp(-(((x - operation.mex) ** 2) / operation.sdx
+                                   + ((y - operation.mey) ** 2) / operation.sdy)) + max(0, -const) - max(0, const)
+
+    z = surface(*numpy.meshgrid(numpy.linspace(0, 1), numpy.linspace(0, 1)))
+    z_min, z_max = z.min(), z.max()
+
+    boxes, quads, vertices = _mesh(operation, size)
+    for vertex in vertices:
+        x, y = boxes[vertex[0]][2] / w, boxes[vertex[0]][3] / h
+        z = surface(x * (x_max - x_min) + x_min, y * (y_max - y_min) + y_min)
+        sigma = max((z - z_min) / (z_max - z_min), 0.01) * operation.magnitude
+        dx = random_state.normal(0, sigma, 1)[0]
+        dy = random_state.normal(0, sigma, 1)[0]
+        _displace(quads, vertex, dx, dy)
+    return _mesh_kernel(boxes, quads, size, native)
+
+
+def constant(operation, size, rng, native=False):
+    if native:
+        do = {HistogramEqualisation: _equalize, Greyscale: _grey, Invert: cv2.bitwise_not}[type(operation)]
+        return do, None, size
+    return lambda image: operation.perform_operation([image])[0], None, size
+
+
+GEOMETRIC_OPERATIONS = {
+    RotateRange: rotate,
+    Flip: flip_random,
+    Skew: skew,
+    CropPercentage: crop_random,
+    Shear: shear
+}
+
+DISTORTION_OPERATIONS = {
+    Distort: distort,
+    GaussianDistortion: gaussian_distort
+}
+
+COLOR_OPERATIONS = {
+    RandomBrightness: enhance,
+    RandomColor: enhance,
+    RandomContrast: enhance,
+    HistogramEqualisation: constant,
+    Greyscale: constant,
+    Invert: constant
+}
+
+OPERATIONS = {**GEOMETRIC_OPERATIONS, **DISTORTION_OPERATIONS, **COLOR_OPERATIONS}
+
+
+def draw_operation(operation, size, rng, native=False):
+    return OPERATIONS[type(operation)](operation, size, rng, native)
+
+
+def warp(matrix, size, native=False):
+    """
+    Kernel applying `matrix`, e.g. several geometric operations composed, with a single resampling.
+    """
+    if native:
+        return lambda image: _warp(image, matrix, size)
+
+    inverse = numpy.linalg.inv(matrix)
+    inverse = inverse / inverse[2, 2]
+    if numpy.allclose(inverse[2], [0, 0, 1]):
+        method, coefficients = PILImage.AFFINE, tuple(inverse[:2].flatten())
+    else:
+        method, coefficients = PILImage.PERSPECTIVE, tuple(inverse.flatten()[:8])
+    return lambda image: image.transform(size, method, coefficients, resample=PILImage.BICUBIC)
+
+
+def homography(source_plane, destination_plane):
+    """
+    Perspective matrix mapping the 4 points of `source_plane` onto `destination_plane`.
+    """
+    matrix = []
+    for (x, y), (u, v) in zip(source_plane, destination_plane):
+        matrix.append([x, y, 1, 0, 0, 0, -u * x, -u * y])
+        matrix.append([0, 0, 0, x, y, 1, -v * x, -v * y])
+    coefficients = numpy.linalg.solve(numpy.array(matrix, dtype=numpy.float64),
+                                      numpy.array(destination_plane, dtype=numpy.float64).reshape(8))
+    return numpy.append(coefficients, 1).reshape(3, 3)
+
+
+def transform_boxes(boxes, matrix, width, height):
+    """
+    Project (N, 4) `x_min, y_min, x_max, y_max` pixel boxes with `matrix`, returning the axis-aligned bounding
+    boxes of their parts inside the output image : of the projected corners inside the image, the intersections of
+    projected edges with the image borders, and the image corners inside projected boxes. Empty when outside.
+    """
+    corners = numpy.stack([boxes[:, [0, 1]], boxes[:, [2, 1]], boxes[:, [2, 3]], boxes[:, [0, 3]]], axis=1)
+    corners = numpy.concatenate([corners, numpy.ones(corners.shape[:2] + (1,))], axis=2) @ matrix.T
+    corners = corners[..., :2] / corners[..., 2:]
+
+    starts, ends = corners, numpy.roll(corners, -1, axis=1)
+    points = [corners]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        for axis, border in ((0, 0), (0, width), (1, 0), (1, height)):
+            ratio = (border - starts[..., axis]) / (ends[..., axis] - starts[..., axis])
+            ratio[~((ratio >= 0) & (ratio <= 1))] = numpy.nan
+            points.append(starts + ratio[..., None] * (ends - starts))
+
+    image_corners = numpy.array([[0, 0], [width, 0], [width, height], [0, height]], dtype=numpy.float64)
+    edges = (ends - starts)[:, None]  # (N, 1, 4, 2)
+    offsets = image_corners[None, :, None] - starts[:, None]  # (N, 4, 4, 2)
+    crosses = edges[..., 0] * offsets[..., 1] - edges[..., 1] * offsets[..., 0]
+    inside_boxes = numpy.all(crosses >= -EPSILON, axis=2) | numpy.all(crosses <= EPSILON, axis=2)
+    points.append(numpy.where(inside_boxes[..., None], image_corners, numpy.nan))
+
+    points = numpy.concatenate(points, axis=1)
+    inside = (points[..., 0] >= -EPSILON) & (points[..., 0] <= width + EPSILON) & \
+             (points[..., 1] >= -EPSILON) & (points[..., 1] <= height + EPSILON)
+    lowest = numpy.where(inside[..., None], points, numpy.inf).min(axis=1)
+    highest = numpy.where(inside[..., None], points, -numpy.inf).max(axis=1)
+    boxes = numpy.concatenate([lowest, highest], axis=1)
+    boxes[~inside.any(axis=1)] = 0
+    return numpy.clip(boxes, 0, [width, height, width, height])
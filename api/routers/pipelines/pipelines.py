@@ -1,12 +1,12 @@
 import base64
+import random
 
-import cv2
 from fastapi import APIRouter, Depends
 
 from dependencies import dataset_belongs_to_user
 from logger import logger
 from routers.images.core import find_images
-from routers.pipelines.core import find_pipelines, perform_sample, delete_pipeline
+from routers.pipelines.core import find_pipelines, perform_cached_sample, delete_pipeline
 from routers.pipelines.models import *
 from utils import parse
 
@@ -26,29 +26,31 @@ def get_dataset_pipelines(dataset_id, offset: int = 0, limit: int = 0):
 @pipelines.post('/sample', response_model=SampleResponse)
 def do_sample(dataset_id, payload: SampleBody, dataset=Depends(dataset_belongs_to_user)):
     """
-    Execute a sample of augmentor operations pipeline
+    Execute a sample of augmentor operations pipeline.
+    Same operations & seed on the same image return the same sample, memoized for a few minutes.
     """
     operations = payload.operations
+    seed = payload.seed if payload.seed is not None else random.getrandbits(32)
 
     images = find_images(dataset_id, limit=1, include_labels=True)
 
-    augmented_images = []
+    encoded_images = []
     augmented_labels = []
 
     for image in images:
-        current_images, current_labels = perform_sample(image, image.labels, operations)
-        augmented_images.extend(current_images)
+        current_images, current_labels = perform_cached_sample(image, image.labels, operations, seed,
+                                                               payload.backend)
+        encoded_images.extend(current_images)
         augmented_labels.extend(current_labels)
 
-    encoded_images = [cv2.imencode('.jpg', augmented_image)[1].tostring()
-                      for augmented_image in augmented_images]
     base64_encoded_images = [base64.b64encode(image) for image in encoded_images]
 
     logger.notify('Pipelines', f'Do sample with {len(operations)} operations for dataset `{dataset_id}`')
 
     return {
         'images': base64_encoded_images,
-        'images_labels': parse(augmented_labels)
+        'images_labels': parse(augmented_labels),
+        'seed': seed
     }
 
 
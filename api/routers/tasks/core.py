@@ -59,3 +59,28 @@ def insert_task(user, dataset_id, task_type, properties) -> Task:
         run_augmentor.delay(user.id, task.id, dataset_id, properties=task.properties)
 
     return task
+
+
+def retry_task(user, task_id) -> Task:
+    """
+    Run a failed task again : completed work of its checkpoint is skipped.
+    """
+    task = db.tasks.find_one({'_id': task_id, 'user_id': user.id})
+    if task is None:
+        raise errors.NotFound('Tasks', errors.TASK_NOT_FOUND)
+    task = Task.from_mongo(task)
+    if task.status != TaskStatus('failed'):
+        raise errors.Forbidden('Tasks', errors.TASK_NOT_FAILED)
+
+    task.status = TaskStatus('pending')
+    task.error = None
+    task.ended_at = None
+    db.tasks.update_one({'_id': task.id}, {'$set': {'status': task.status, 'error': None, 'ended_at': None}})
+
+    if task.type == 'generator':
+        run_generator.delay(user.id, task.id, properties=task.properties)
+
+    if task.type == 'augmentor':
+        run_augmentor.delay(user.id, task.id, task.dataset_id, properties=task.properties)
+
+    return task
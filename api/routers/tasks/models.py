@@ -1,11 +1,11 @@
 from datetime import datetime
 from enum import Enum
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Union
 
 from pydantic import BaseModel, Field
 
 from routers.datasources.models import DatasourceKey
-from routers.pipelines.models import Operation
+from routers.pipelines.models import Operation, OperationBackend
 from utils import MongoModel
 
 
@@ -30,11 +30,22 @@ class TaskGeneratorProperties(BaseModel):
 class TaskAugmentorProperties(BaseModel):
     image_count: int
     operations: List[Operation]
+    virtual: bool = False
+    backend: OperationBackend = OperationBackend.AUGMENTOR
+    jpeg_quality: int = Field(95, ge=0, le=100)
+    jpeg_progressive: bool = False
+    jpeg_optimize: bool = False
 
 
 TaskProperties = Union[TaskGeneratorProperties, TaskAugmentorProperties]
 
 
+class TaskCacheStats(BaseModel):
+    hits: int
+    misses: int
+    hit_rate: float
+
+
 class Task(MongoModel):
     id: str = Field()
     user_id: str
@@ -46,6 +57,10 @@ class Task(MongoModel):
     created_at: datetime
     ended_at: Optional[datetime] = None
     error: Optional[str] = None
+    cache: Optional[TaskCacheStats] = None
+    throughput: Optional[Dict[str, float]] = None  # images/sec of each stage, while it is busy
+    checkpoint: Optional[List[List[int]]] = None  # completed work items, as [start, end) index ranges
+    downloads: Optional[Dict[str, Dict[str, float]]] = None  # requests, failures & latency of each remote host
 
 
 class TaskPostBody(BaseModel):
@@ -2,7 +2,7 @@ from fastapi import APIRouter, Depends
 
 from dependencies import logged_user
 from logger import logger
-from routers.tasks.core import insert_task
+from routers.tasks.core import insert_task, retry_task
 from routers.tasks.models import *
 from routers.users.models import User
 from utils import parse
@@ -18,3 +18,13 @@ def post_task(payload: TaskPostBody, dataset_id=None, user: User = Depends(logge
     response = {'task': insert_task(user, dataset_id, payload.type, payload.properties)}
     logger.notify('Tasks', f'Add task `{payload.type}` for user `{user.id}`')
     return parse(response)
+
+
+@tasks.post('/{task_id}/retry', response_model=TaskResponse)
+def post_task_retry(task_id, user: User = Depends(logged_user)):
+    """
+    Retry a failed task, resuming from its last checkpoint
+    """
+    response = {'task': retry_task(user, task_id)}
+    logger.notify('Tasks', f'Retry task `{task_id}` for user `{user.id}`')
+    return parse(response)
@@ -1,2 +1,2 @@
 export PYTHONPATH=$PYTHONPATH:/Users/paulruelle/PycharmProjects/datatensor
-celery -A worker worker --loglevel=INFO
\ No newline at end of file
+celery -A worker worker -B --loglevel=INFO
\ No newline at end of file
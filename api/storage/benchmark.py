@@ -0,0 +1,57 @@
+import concurrent.futures
+import os
+import sys
+import tempfile
+import time
+from uuid import uuid4
+
+from logger import logger
+from storage.core import LocalStorage, MemoryStorage, S3Storage
+
+# Upload, read & batched deletion throughput of 200 KB images from 64 threads, for each storage backend.
+# For S3, a client pooling 10 connections (boto3 default) is compared to one pooling as many connections as threads.
+# Run from `api` folder, S3 against a S3 compatible server (MinIO, `moto_server`...) with an existing bucket :
+# `python -m storage.benchmark [image_count] [<endpoint_url> <bucket>]`
+
+THREADS = 64
+IMAGE_SIZE = 200 * 1024
+
+
+def _run(storage, image_count):
+    body = os.urandom(IMAGE_SIZE)
+    keys = [f'benchmark-{uuid4()}' for _ in range(image_count)]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=THREADS) as executor:
+        start = time.perf_counter()
+        list(executor.map(lambda key: storage.put(key, body), keys))
+        upload = time.perf_counter() - start
+
+        start = time.perf_counter()
+        list(executor.map(storage.get, keys))
+        read = time.perf_counter() - start
+
+    start = time.perf_counter()
+    storage.delete(keys)
+    deletion = time.perf_counter() - start
+    return upload, read, deletion, storage.stats()
+
+
+def benchmark(image_count=2000, endpoint_url=None, bucket=None):
+    with tempfile.TemporaryDirectory() as root:
+        storages = {'memory': MemoryStorage(), 'local': LocalStorage(root=root, location='file://')}
+        if endpoint_url:
+            for max_connections in (10, THREADS):
+                storages[f's3 ({max_connections:2d} connections)'] = S3Storage(
+                    bucket=bucket, max_connections=max_connections, endpoint_url=endpoint_url)
+
+        for name, storage in storages.items():
+            upload, read, deletion, stats = _run(storage, image_count)
+            logger.notify('Benchmark', f'{name} : {image_count} uploads in {upload:6.2f}s | '
+                                       f'{image_count / upload:.1f} images/sec | '
+                                       f'put latency {stats["put"]["latency_mean"]} ms '
+                                       f'(p95 {stats["put"]["latency_p95"]} ms) | '
+                                       f'read in {read:.2f}s | deleted in {deletion:.2f}s')
+
+
+if __name__ == '__main__':
+    benchmark(*[int(arg) for arg in sys.argv[1:2]], *sys.argv[2:4])
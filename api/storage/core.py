@@ -0,0 +1,303 @@
+import abc
+import concurrent.futures
+import contextlib
+import io
+import math
+import mmap
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Dict, List, Optional
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import ClientError
+
+from config import Config
+
+DELETE_BATCH_SIZE = 1000  # maximum keys of a `delete_objects` request
+LATENCIES_KEPT = 10000  # per operation
+
+
+def _is_not_found(e) -> bool:
+    if isinstance(e, ClientError):
+        return e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound')
+    return isinstance(e, (FileNotFoundError, KeyError))
+
+
+class StorageError(Exception):
+    """
+    Raised when a call to the storage failed, whatever its backend.
+    """
+
+
+class StorageNotFound(StorageError):
+    """
+    Raised when the object of a key does not exist, whatever its backend.
+    """
+
+
+class Storage(abc.ABC):
+    """
+    Objects stored under a key, served at `location` + key. Latency of every call is recorded.
+    Backends implement `_exists`, `_open`, `_put` & `_delete`, their errors are raised as `StorageError`,
+    `StorageNotFound` for missing keys.
+    """
+
+    location: str
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = defaultdict(lambda: deque(maxlen=LATENCIES_KEPT))
+        self._failures = defaultdict(int)
+
+    def _error(self, operation, e) -> StorageError:
+        """
+        Error `e` of a backend as a `StorageError`, counted as a failure unless the key is missing.
+        """
+        if _is_not_found(e):
+            return StorageNotFound(f'Object not found, {str(e)}')
+        with self._lock:
+            self._failures[operation] += 1
+        return e if isinstance(e, StorageError) else StorageError(f'Storage {operation} failed, {str(e)}')
+
+    def _call(self, operation, function, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except Exception as e:
+            error = self._error(operation, e)
+            if error is e:
+                raise
+            raise error from e
+        finally:
+            with self._lock:
+                self._latencies[operation].append(time.perf_counter() - start)
+
+    def url(self, key) -> str:
+        return f'{self.location}{key}'
+
+    def key(self, path) -> Optional[str]:
+        """
+        Key of the object at `path`, None if `path` is not in this storage.
+        """
+        if path and path.startswith(self.location):
+            return path[len(self.location):]
+        return None
+
+    def exists(self, key) -> bool:
+        return self._call('head', self._exists, key)
+
+    @contextlib.contextmanager
+    def open(self, key):
+        """
+        Content of object `key`, as a buffer valid inside the `with` block only.
+        """
+        with contextlib.ExitStack() as stack:
+            start = time.perf_counter()
+            try:
+                buffer = stack.enter_context(self._open(key))
+            except Exception as e:
+                error = self._error('get', e)
+                if error is e:
+                    raise
+                raise error from e
+            finally:
+                with self._lock:
+                    self._latencies['get'].append(time.perf_counter() - start)
+            yield buffer
+
+    def get(self, key) -> bytes:
+        with self.open(key) as buffer:
+            return bytes(buffer)
+
+    def put(self, key, body: bytes, content_type=None):
+        self._call('put', self._put, key, body, content_type)
+
+    def delete(self, keys: List[str]):
+        if keys:
+            self._call('delete', self._delete, keys)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Per operation : calls, failures, mean & 95th percentile latency in ms, over the last calls.
+        """
+        with self._lock:
+            latencies = {operation: sorted(values) for operation, values in self._latencies.items()}
+            failures = dict(self._failures)
+        return {operation: {
+            'calls': len(values),
+            'failures': failures.get(operation, 0),
+            'latency_mean': round(1000 * sum(values) / len(values), 1),
+            'latency_p95': round(1000 * values[math.ceil(0.95 * len(values)) - 1], 1)
+        } for operation, values in latencies.items() if values}
+
+    @abc.abstractmethod
+    def _exists(self, key) -> bool:
+        pass
+
+    @abc.abstractmethod
+    def _open(self, key):
+        """
+        Context manager yielding the content of object `key`.
+        """
+
+    @abc.abstractmethod
+    def _put(self, key, body: bytes, content_type):
+        pass
+
+    @abc.abstractmethod
+    def _delete(self, keys: List[str]):
+        """
+        Delete `keys`, missing ones are skipped.
+        """
+
+
+class S3Storage(Storage):
+    """
+    Objects of the S3 bucket, through one client shared by every thread of the process.
+    Its connection pool holds `S3_MAX_POOL_CONNECTIONS`, at least as many as threads uploading at once, so that
+    requests never wait for a connection. Bodies over `S3_MULTIPART_THRESHOLD` are uploaded by the transfer
+    manager, in parallel parts.
+    """
+
+    def __init__(self, bucket=None, max_connections=None, endpoint_url=None, location=None):
+        super().__init__()
+        self.bucket = bucket or Config.S3_BUCKET
+        self.location = location or Config.S3_LOCATION
+        self.max_connections = max_connections or Config.S3_MAX_POOL_CONNECTIONS or max(
+            Config.IMAGES_UPLOAD_WORKERS, Config.GENERATOR_MAX_DOWNLOADS, Config.AUGMENTOR_IO_WORKERS)
+        self.client = boto3.client(
+            's3',
+            aws_access_key_id=Config.S3_KEY,
+            aws_secret_access_key=Config.S3_SECRET,
+            endpoint_url=endpoint_url or Config.S3_ENDPOINT_URL,
+            config=BotoConfig(max_pool_connections=self.max_connections, retries={'mode': 'adaptive'})
+        )
+        self.transfer_config = TransferConfig(multipart_threshold=Config.S3_MULTIPART_THRESHOLD,
+                                              max_concurrency=min(10, self.max_connections))
+
+    def _exists(self, key) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except ClientError as e:
+            if _is_not_found(e):
+                return False
+            raise
+
+    @contextlib.contextmanager
+    def _open(self, key):
+        yield self.client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+
+    def _put(self, key, body: bytes, content_type):
+        extra_args = {'ACL': 'public-read', **({'ContentType': content_type} if content_type else {})}
+        if len(body) < Config.S3_MULTIPART_THRESHOLD:
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=body, **extra_args)
+        else:
+            self.client.upload_fileobj(io.BytesIO(body), self.bucket, key,
+                                       ExtraArgs=extra_args, Config=self.transfer_config)
+
+    def _delete_batch(self, keys):
+        response = self.client.delete_objects(Bucket=self.bucket,
+                                              Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+        return response.get('Errors', [])
+
+    def _delete(self, keys: List[str]):
+        """
+        Delete `keys`, by batches of 1000 sent in parallel.
+        """
+        batches = [keys[start:start + DELETE_BATCH_SIZE] for start in range(0, len(keys), DELETE_BATCH_SIZE)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(batches), self.max_connections)) as executor:
+            errors = [error for batch_errors in executor.map(self._delete_batch, batches) for error in batch_errors]
+        if errors:
+            raise StorageError(f'{len(errors)} objects not deleted, {errors[0]["Key"]} : {errors[0]["Message"]}')
+
+
+class LocalStorage(Storage):
+    """
+    Objects as files of folder `root`, for single node deployments : reads are memory mapped, writes are atomic
+    (temporary file renamed). Files are served by the API at `STORAGE_LOCAL_URL`.
+    """
+
+    def __init__(self, root=None, location=None):
+        super().__init__()
+        self.root = os.path.abspath(root or Config.STORAGE_LOCAL_PATH)
+        self.location = location or Config.STORAGE_LOCAL_URL
+        os.makedirs(self.root, exist_ok=True)
+
+    def _file(self, key) -> str:
+        path = os.path.abspath(os.path.join(self.root, key))
+        if os.path.dirname(path) != self.root:
+            raise StorageError(f'Invalid key {key}')
+        return path
+
+    def _exists(self, key) -> bool:
+        return os.path.isfile(self._file(key))
+
+    @contextlib.contextmanager
+    def _open(self, key):
+        with open(self._file(key), 'rb') as file:
+            if not os.fstat(file.fileno()).st_size:  # empty files cannot be mapped
+                yield b''
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield mapped
+
+    def _put(self, key, body: bytes, content_type):
+        path = self._file(key)
+        descriptor, temporary_path = tempfile.mkstemp(dir=self.root, prefix='.', suffix='.part')
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                file.write(body)
+            os.chmod(temporary_path, 0o644)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    def _delete(self, keys: List[str]):
+        for key in keys:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._file(key))
+
+
+class MemoryStorage(Storage):
+    """
+    Objects in a dict of the process, for load tests & benchmarks without any outside service.
+    """
+
+    def __init__(self, location='memory://'):
+        super().__init__()
+        self.location = location
+        self._objects: Dict[str, bytes] = {}
+
+    def _exists(self, key) -> bool:
+        return key in self._objects
+
+    @contextlib.contextmanager
+    def _open(self, key):
+        yield memoryview(self._objects[key])
+
+    def _put(self, key, body: bytes, content_type):
+        self._objects[key] = bytes(body)
+
+    def _delete(self, keys: List[str]):
+        for key in keys:
+            self._objects.pop(key, None)
+
+
+STORAGE_BACKENDS = {'s3': S3Storage, 'local': LocalStorage, 'memory': MemoryStorage}
+
+
+def create_storage(backend=None) -> Storage:
+    backend = backend or Config.STORAGE_BACKEND
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f'Unknown storage backend {backend}, expected one of {", ".join(STORAGE_BACKENDS)}')
+    return STORAGE_BACKENDS[backend]()
+
+
+storage = create_storage()
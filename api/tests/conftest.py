@@ -0,0 +1,23 @@
+import os
+import sys
+
+import mongomock
+import pytest
+
+from config import Config
+
+API_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """
+    In memory mongo database, in place of `Config.db` in every module of the api.
+    """
+    database = mongomock.MongoClient().datatensor
+    for module in list(sys.modules.values()):
+        path = getattr(module, '__file__', None) or ''
+        if path.startswith(API_PATH) and 'db' in vars(module) and vars(module)['db'] is Config.db:
+            monkeypatch.setattr(module, 'db', database)
+    monkeypatch.setattr(Config, 'db', database)
+    return database
@@ -0,0 +1,136 @@
+import hashlib
+import http.server
+import os
+import socket
+import threading
+
+import pytest
+
+import errors
+from config import Config
+from routers.datasources import core
+
+# Run from `api` folder : `python -m pytest tests`
+
+CONTENT = os.urandom(3 * core.DOWNLOAD_CHUNK_SIZE + 12345)
+
+
+class ArchiveServer(http.server.ThreadingHTTPServer):
+    """
+    Local stand-in of a datasource host, serving `CONTENT` with Range support. The first `drops` responses are
+    cut after half of their body.
+    """
+
+    def __init__(self, drops=0):
+        super().__init__(('127.0.0.1', 0), ArchiveHandler)
+        self.drops = drops
+        self.ranges = []
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/archive.zip'
+
+
+class ArchiveHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        header = self.headers.get('Range')
+        self.server.ranges.append(header)
+        start = int(header[len('bytes='):-1]) if header else 0
+        if start >= len(CONTENT):
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{len(CONTENT)}')
+            self.end_headers()
+            return
+
+        body = CONTENT[start:]
+        self.send_response(206 if header else 200)
+        self.send_header('Content-Length', str(len(body)))
+        if header:
+            self.send_header('Content-Range', f'bytes {start}-{len(CONTENT) - 1}/{len(CONTENT)}')
+        self.end_headers()
+        if self.server.drops:
+            self.server.drops -= 1
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(core.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(Config, 'DATASOURCE_DOWNLOAD_RETRIES', 3)
+    monkeypatch.setattr(Config, 'DATASOURCE_DOWNLOAD_TIMEOUT', 5)
+
+
+@pytest.fixture
+def server(request):
+    server = ArchiveServer(drops=getattr(request, 'param', 0))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def read(path):
+    with open(path, 'rb') as fd:
+        return fd.read()
+
+
+@pytest.mark.parametrize('server', [2], indirect=True)
+def test_resumes_dropped_connections(server, tmp_path):
+    path = str(tmp_path / 'archive.zip')
+    core._download_archive(server.url, path, hashlib.sha256(CONTENT).hexdigest())
+
+    assert read(path) == CONTENT
+    assert not os.path.exists(f'{path}.part')
+    assert server.ranges[0] is None
+    offsets = [int(header[len('bytes='):-1]) for header in server.ranges[1:]]
+    assert len(offsets) == 2 and 0 < offsets[0] < offsets[1] < len(CONTENT)
+
+
+def test_accepts_complete_partial_download(server, tmp_path):
+    path = str(tmp_path / 'archive.zip')
+    with open(f'{path}.part', 'wb') as fd:
+        fd.write(CONTENT)
+
+    core._download_archive(server.url, path)
+
+    assert read(path) == CONTENT
+    assert server.ranges == [f'bytes={len(CONTENT)}-']
+
+
+def test_restarts_partial_download_larger_than_remote_file(server, tmp_path):
+    path = str(tmp_path / 'archive.zip')
+    with open(f'{path}.part', 'wb') as fd:
+        fd.write(CONTENT + b'stale')
+
+    core._download_archive(server.url, path)
+
+    assert read(path) == CONTENT
+    assert server.ranges == [f'bytes={len(CONTENT) + 5}-', None]
+
+
+def test_checksum_mismatch(server, tmp_path):
+    path = str(tmp_path / 'archive.zip')
+    with pytest.raises(errors.InternalError):
+        core._download_archive(server.url, path, hashlib.sha256(b'other').hexdigest())
+    assert not os.path.exists(path) and not os.path.exists(f'{path}.part')
+
+
+def test_retries_refused_connections(tmp_path):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]  # closed once bound, refusing connections
+
+    path = str(tmp_path / 'archive.zip')
+    with pytest.raises(errors.APIError) as error:
+        core._download_archive(f'http://127.0.0.1:{port}/archive.zip', path)
+    assert error.value.status_code == 503
+    assert not os.path.exists(f'{path}.part')
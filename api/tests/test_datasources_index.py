@@ -0,0 +1,88 @@
+import json
+import os
+import threading
+
+from routers.datasources import index
+
+# Run from `api` folder : `python -m pytest tests`
+
+
+def write_annotations(path, image_count):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as file:
+        json.dump({'images': [{'id': image_id, 'width': 640, 'height': 480, 'file_name': f'{image_id}.jpg'}
+                              for image_id in range(image_count)],
+                   'annotations': [{'image_id': image_id, 'category_id': 1, 'bbox': [0, 0, 10, 10]}
+                                   for image_id in range(image_count)],
+                   'categories': [{'id': 1, 'name': 'cat', 'supercategory': 'animal'}]}, file)
+
+
+def test_update_swaps_versions(tmp_path, monkeypatch):
+    monkeypatch.setattr(index, 'REPLACED_INDEX_TTL', 0)
+    path = str(tmp_path / 'annotations' / 'train.json')
+    write_annotations(path, 3)
+    index.update_index([path])
+    assert index.is_indexed([path])
+    assert len(index.load_index([path]).image_ids) == 3
+
+    write_annotations(path, 5)
+    os.utime(path, (0, 0))
+    assert not index.is_indexed([path])
+    assert len(index.load_index([path]).image_ids) == 3  # previous version, never built by readers
+
+    index.update_index([path])
+    assert len(index.load_index([path]).image_ids) == 5
+    directory = index.index_path(path)
+    assert os.path.islink(directory)
+    assert [version for _, version in index._versions(directory)] == [os.path.realpath(directory)]
+
+
+def test_readers_always_find_an_index(tmp_path):
+    path = str(tmp_path / 'annotations' / 'train.json')
+    write_annotations(path, 100)
+    index.update_index([path])
+    directory = index.index_path(path)
+
+    failures = []
+    writing = threading.Event()
+
+    def read():
+        while not writing.is_set():
+            try:
+                index.DatasourceIndex(os.path.realpath(directory))
+            except FileNotFoundError as e:
+                failures.append(e)
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    for _ in range(20):
+        index.build_index(path)
+    writing.set()
+    reader.join()
+
+    assert not failures
+    assert len(index._versions(directory)) == 21  # replaced versions are kept for a while
+
+
+def test_replaces_unversioned_index(tmp_path):
+    path = str(tmp_path / 'annotations' / 'train.json')
+    write_annotations(path, 2)
+    directory = index.index_path(path)
+    os.makedirs(directory)
+    with open(os.path.join(directory, 'meta.json'), 'w') as file:
+        json.dump({}, file)
+
+    index.update_index([path])
+    assert os.path.islink(directory)
+    assert len(index.load_index([path]).image_ids) == 2
+
+
+def test_merged_index(tmp_path):
+    paths = [str(tmp_path / 'annotations' / 'train.json'), str(tmp_path / 'annotations' / 'val.json')]
+    write_annotations(paths[0], 3)
+    write_annotations(paths[1], 4)
+    assert not index.is_indexed(paths)
+
+    index.update_index(paths)
+    assert index.is_indexed(paths)
+    assert len(index.load_index(paths).image_ids) == 4
@@ -0,0 +1,151 @@
+import concurrent.futures
+import io
+import types
+
+import cv2
+import numpy
+import pytest
+
+from config import Config
+from routers.images import core as images_core
+from routers.images.duplicates import MAX_DISTANCE, DuplicateIndex
+from routers.images.ingest import dhash
+from routers.images.models import DuplicatesPolicy
+from storage.core import MemoryStorage
+
+# Run from `api` folder : `python -m pytest tests`
+
+
+def brute_force_clusters(image_ids, hashes, max_distance):
+    """
+    Connected components of the graph of hashes within `max_distance` bits, comparing every pair.
+    """
+    parents = list(range(len(hashes)))
+
+    def root(node):
+        while parents[node] != node:
+            node = parents[node]
+        return node
+
+    for left in range(len(hashes)):
+        for right in range(left + 1, len(hashes)):
+            if bin((hashes[left] ^ hashes[right]) & (2 ** 64 - 1)).count('1') <= max_distance:
+                parents[root(right)] = root(left)
+    groups = {}
+    for node in range(len(hashes)):
+        groups.setdefault(root(node), set()).add(image_ids[node])
+    return {frozenset(group) for group in groups.values() if len(group) > 1}
+
+
+def random_hashes(rng, count, max_distance, low_entropy=False):
+    """
+    Signed 64 bits hashes : random ones, each followed by a few copies within `max_distance` bits.
+    Low entropy hashes only set a few bits, so that many of them share each band.
+    """
+    hashes = []
+    while len(hashes) < count:
+        if low_entropy:
+            value = 0
+            for bit in rng.choice(64, size=3, replace=False):
+                value |= 1 << int(bit)
+        else:
+            value = int(rng.integers(0, 2 ** 64, dtype=numpy.uint64))
+        hashes.append(value)
+        for _ in range(rng.integers(0, 3)):
+            flipped = value
+            for bit in rng.choice(64, size=rng.integers(0, max_distance + 1), replace=False):
+                flipped ^= 1 << int(bit)
+            hashes.append(flipped)
+    return [int(numpy.uint64(value).view(numpy.int64)) for value in hashes[:count]]
+
+
+@pytest.mark.parametrize('low_entropy', [False, True])
+@pytest.mark.parametrize('max_distance', [0, 1, 4, 8, MAX_DISTANCE])
+def test_clusters_match_brute_force(max_distance, low_entropy):
+    rng = numpy.random.default_rng(max_distance)
+    hashes = random_hashes(rng, 400, max_distance, low_entropy)
+    image_ids = [str(position) for position in range(len(hashes))]
+
+    clusters = DuplicateIndex(image_ids, hashes, max_distance).clusters()
+
+    assert {frozenset(cluster) for cluster in clusters} == brute_force_clusters(image_ids, hashes, max_distance)
+    assert [len(cluster) for cluster in clusters] == sorted((len(cluster) for cluster in clusters), reverse=True)
+
+
+def test_find_within_distance():
+    index = DuplicateIndex([], [], max_distance=4)
+    assert index.find(0) is None
+
+    for position in range(200):  # grows past its initial capacity
+        index.add(f'far-{position}', (position + 1) * 0x0101010101010101 & 0x7FFFFFFFFFFFFFFF)
+    index.add('four-bits', 0b1111)
+    index.add('one-bit', 0b1)
+    assert index.find(0) == 'one-bit'  # closest
+    assert DuplicateIndex(['four-bits'], [0b1111], max_distance=4).find(0) == 'four-bits'
+    assert DuplicateIndex(['five-bits'], [0b11111], max_distance=4).find(0) is None
+    assert DuplicateIndex(['negative'], [-1], max_distance=0).find(-1) == 'negative'
+
+
+@pytest.mark.parametrize('max_distance', [-1, MAX_DISTANCE + 1, 63])
+def test_distance_bounds(max_distance):
+    with pytest.raises(ValueError):
+        DuplicateIndex([], [], max_distance)
+
+
+def noise_image(seed):
+    pixels = numpy.random.default_rng(seed).integers(0, 256, (12, 16, 3), dtype=numpy.uint8)
+    return cv2.resize(pixels, (640, 480), interpolation=cv2.INTER_CUBIC)
+
+
+def jpeg(image, quality=95) -> bytes:
+    return cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+def test_dhash_keeps_resized_images_close():
+    image = noise_image(0)
+    copy = cv2.imdecode(numpy.frombuffer(jpeg(cv2.resize(image, (320, 240)), quality=60), numpy.uint8),
+                        cv2.IMREAD_COLOR)
+    distance = bin((dhash(image) ^ dhash(copy)) & (2 ** 64 - 1)).count('1')
+    assert distance <= Config.IMAGES_DUPLICATE_DISTANCE
+    assert bin((dhash(image) ^ dhash(noise_image(1))) & (2 ** 64 - 1)).count('1') > MAX_DISTANCE
+
+
+@pytest.fixture
+def upload(db, monkeypatch):
+    """
+    `insert_images` of files, decoded in threads, stored in memory.
+    """
+    monkeypatch.setattr(images_core, 'storage', MemoryStorage())
+    monkeypatch.setattr(images_core, 'ingest_executor', lambda: concurrent.futures.ThreadPoolExecutor(2))
+    monkeypatch.setattr(Config, 'IMAGES_DUPLICATE_DISTANCE', 4)
+    original = noise_image(0)
+    db.images.insert_one({'_id': 'original', 'dataset_id': 'dataset', 'original_image_id': None,
+                          'dhash': dhash(original)})
+
+    def insert(duplicates):
+        files = [types.SimpleNamespace(filename=filename, file=io.BytesIO(data)) for filename, data in [
+            ('copy.jpg', jpeg(cv2.resize(original, (320, 240)), quality=60)),  # of an image of the dataset
+            ('new.jpg', jpeg(noise_image(1))),
+            ('new-copy.jpg', jpeg(noise_image(1), quality=70)),  # of an image of this request
+        ]]
+        return images_core.insert_images('dataset', files, duplicates)
+    return insert
+
+
+def test_flags_duplicates(upload):
+    images = {image.name: image for image in upload(DuplicatesPolicy.flag)}
+    assert images['copy.jpg'].duplicate_of == 'original'
+    assert images['new.jpg'].duplicate_of is None
+    assert images['new-copy.jpg'].duplicate_of == images['new.jpg'].id
+
+
+def test_skips_duplicates(upload, db):
+    images = upload(DuplicatesPolicy.skip)
+    assert [image.name for image in images] == ['new.jpg']
+    assert db.images.count_documents({'dataset_id': 'dataset'}) == 2
+
+
+def test_keeps_duplicates(upload):
+    images = upload(DuplicatesPolicy.keep)
+    assert [image.name for image in images] == ['copy.jpg', 'new.jpg', 'new-copy.jpg']
+    assert all(image.duplicate_of is None for image in images)
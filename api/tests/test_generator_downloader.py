@@ -0,0 +1,125 @@
+import asyncio
+import contextlib
+import time
+
+import pytest
+from aiohttp import web
+
+from workflows.generator.downloader import Downloader
+
+# Run from `api` folder : `python -m pytest tests`
+
+
+@contextlib.asynccontextmanager
+async def serve(handler):
+    """
+    Local stand-in of an image host, answering every path with `handler`. Yields its url & its count of requests.
+    """
+    requests = []
+
+    async def count(request):
+        requests.append(request.path)
+        return await handler(len(requests))
+
+    app = web.Application()
+    app.add_routes([web.get('/{name}', count)])
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    try:
+        yield f'127.0.0.1:{port}', requests
+    finally:
+        await runner.cleanup()
+
+
+def downloader(**kwargs):
+    return Downloader(**{'host_concurrency': 4, 'timeout': 5, 'retries': 2, 'backoff': 0.01, 'hedge_delay': 0.1,
+                         **kwargs})
+
+
+async def image(attempt):
+    return web.Response(body=b'image')
+
+
+def test_slow_primary_beaten_by_hedge():
+    async def slow(attempt):
+        await asyncio.sleep(1)
+        return web.Response(body=b'slow')
+
+    async def run():
+        async with serve(slow) as (primary, _), serve(image) as (secondary, _):
+            async with downloader() as client:
+                start = time.perf_counter()
+                content = await client.fetch_any([f'http://{primary}/1.jpg', f'http://{secondary}/1.jpg'])
+                return content, time.perf_counter() - start, client.stats(), primary, secondary
+
+    content, elapsed, stats, primary, secondary = asyncio.run(run())
+    assert content == b'image'
+    assert elapsed < 0.5  # primary cancelled, not awaited
+    assert stats[secondary]['wins'] == 1 and stats[primary]['wins'] == 0
+    assert stats[primary]['requests'] == 1 and stats[secondary]['requests'] == 1
+
+
+def test_failed_primary_hedged_at_once():
+    async def missing(attempt):
+        return web.Response(status=404)
+
+    async def run():
+        async with serve(missing) as (primary, _), serve(image) as (secondary, _):
+            async with downloader(hedge_delay=10) as client:
+                start = time.perf_counter()
+                content = await client.fetch_any([f'http://{primary}/1.jpg', f'http://{secondary}/1.jpg'])
+                return content, time.perf_counter() - start, client.stats()[secondary]
+
+    content, elapsed, stats = asyncio.run(run())
+    assert content == b'image' and elapsed < 5
+    assert stats['wins'] == 1
+
+
+@pytest.mark.parametrize('status', [503, 429])
+def test_retries_server_errors(status):
+    async def unavailable_once(attempt):
+        return web.Response(status=status) if attempt == 1 else web.Response(body=b'image')
+
+    async def run():
+        async with serve(unavailable_once) as (host, requests):
+            async with downloader() as client:
+                return await client.fetch(f'http://{host}/1.jpg'), requests, client.stats()[host]
+
+    content, requests, stats = asyncio.run(run())
+    assert content == b'image'
+    assert len(requests) == 2
+    assert stats['requests'] == 2 and stats['failures'] == 1 and stats['latency_mean'] > 0
+
+
+def test_gives_up_on_missing_image():
+    async def missing(attempt):
+        return web.Response(status=404)
+
+    async def run():
+        async with serve(missing) as (host, requests):
+            async with downloader() as client:
+                return await client.fetch_any([f'http://{host}/1.jpg', '']), requests, client.stats()[host]
+
+    content, requests, stats = asyncio.run(run())
+    assert content is None
+    assert len(requests) == 1  # not retried
+    assert stats['requests'] == 1 and stats['failures'] == 1 and stats['wins'] == 0
+
+
+def test_retries_timeouts_then_gives_up():
+    async def hanging(attempt):
+        await asyncio.sleep(1)
+        return web.Response(body=b'image')
+
+    async def run():
+        async with serve(hanging) as (host, requests):
+            async with downloader(timeout=0.2, retries=1) as client:
+                return await client.fetch(f'http://{host}/1.jpg'), requests, client.stats()[host]
+
+    content, requests, stats = asyncio.run(run())
+    assert content is None
+    assert len(requests) == 2
+    assert stats['requests'] == 2 and stats['failures'] == 2 and stats['latency_mean'] == 0
@@ -0,0 +1,76 @@
+import json
+import os
+
+import cv2
+import numpy
+import pytest
+
+import errors
+from config import Config
+from routers.images import core as images_core
+from routers.tasks.models import TaskGeneratorProperties
+from storage.core import MemoryStorage
+from workflows.generator import generator
+
+# Run from `api` folder : `python -m pytest tests`
+
+IMAGE_COUNT = 6
+FAILING_INDEX = 4
+
+
+@pytest.fixture
+def datasource(tmp_path, monkeypatch):
+    """
+    Local copy of a datasource : annotations already downloaded, images read from a mirror folder.
+    """
+    annotations_path = tmp_path / 'datasources' / 'coco2017' / 'annotations'
+    images_path = tmp_path / 'images'
+    annotations_path.mkdir(parents=True)
+    images_path.mkdir()
+    images, annotations = [], []
+    for image_id in range(1, IMAGE_COUNT + 1):
+        pixels = numpy.full((48, 64, 3), image_id * 30, numpy.uint8)
+        cv2.imwrite(str(images_path / f'{image_id}.jpg'), pixels)
+        images.append({'id': image_id, 'width': 64, 'height': 48, 'file_name': f'{image_id}.jpg'})
+        annotations.append({'image_id': image_id, 'category_id': 1, 'bbox': [8, 8, 16, 16]})
+    with open(annotations_path / 'instances.json', 'w') as file:
+        json.dump({'images': images, 'annotations': annotations,
+                   'categories': [{'id': 1, 'name': 'cat', 'supercategory': 'animal'}]}, file)
+
+    monkeypatch.setattr(Config, 'DATASOURCES_PATH', str(tmp_path / 'datasources'))
+    monkeypatch.setattr(Config, 'DATASOURCES', [{'key': 'coco2017', 'name': 'COCO 2017',
+                                                 'filenames': ['instances.json'], 'images_path': str(images_path)}])
+    monkeypatch.setattr(Config, 'DOWNLOADS_PATH', str(tmp_path / 'downloads'))
+    monkeypatch.setattr(Config, 'TASK_CHECKPOINT_INTERVAL', 3600)  # never saved before the task ends
+    monkeypatch.setattr(Config, 'GENERATOR_MAX_DOWNLOADS', 2)
+    monkeypatch.setattr(images_core, 'storage', MemoryStorage())
+
+
+def test_retry_after_partial_flush(db, datasource, monkeypatch):
+    properties = TaskGeneratorProperties(datasource_key='coco2017', selected_categories=['cat'],
+                                         image_count=IMAGE_COUNT)
+    db.tasks.insert_one({'_id': 'task', 'type': 'generator', 'status': 'pending', 'progress': 0})
+
+    store_image = generator._store_image
+
+    def failing_store_image(args, image_bytes, size):
+        if args['index'] == FAILING_INDEX:
+            raise IOError('storage unavailable')
+        store_image(args, image_bytes, size)
+
+    monkeypatch.setattr(generator, '_store_image', failing_store_image)
+    with pytest.raises(errors.InternalError):
+        generator.main('user', 'task', properties)
+    # Documents of the other images were flushed, without any checkpoint
+    assert db.images.count_documents({}) == IMAGE_COUNT - 1
+    assert not db.tasks.find_one({'_id': 'task'}).get('checkpoint')
+
+    monkeypatch.setattr(generator, '_store_image', store_image)
+    generator.main('user', 'task', properties)
+
+    dataset_id = db.tasks.find_one({'_id': 'task'})['dataset_id']
+    assert db.images.count_documents({'dataset_id': dataset_id}) == IMAGE_COUNT
+    assert db.labels.count_documents({}) == IMAGE_COUNT
+    assert db.datasets.find_one({'_id': dataset_id})['image_count'] == IMAGE_COUNT
+    assert db.categories.find_one({'dataset_id': dataset_id})['labels_count'] == IMAGE_COUNT
+    assert db.tasks.find_one({'_id': 'task'})['checkpoint'] == [[0, IMAGE_COUNT]]
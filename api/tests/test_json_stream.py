@@ -0,0 +1,52 @@
+import io
+import json
+
+import pytest
+
+from utils import JSONArrayStream
+
+# Run from `api` folder : `python -m pytest tests`
+
+DOCUMENT = {
+    'info': {'description': 'skipped', 'nested': [[1, 2], {'a': [3]}], 'version': 1.0},
+    'images': [{'id': 1, 'file_name': 'a "quoted" \\\\ name.jpg', 'width': 640, 'height': 480},
+               {'id': 22, 'file_name': 'b}].jpg', 'coco_url': None, 'flag': True}],
+    'numbers': [-1, 2.5e3, 0, -0.125, 1E-7, 123456789012345678, 3.0, -42, 6.02e+23, False, None, True],
+    'annotations': [{'image_id': 1, 'bbox': [1.5, 2.25, 30.125, 4e1], 'category_id': 7}],
+    'categories': [],
+    'unread': [{'id': 'ignored'}]
+}
+
+
+def items(text, keys, chunk_size):
+    return list(JSONArrayStream(io.StringIO(text), chunk_size=chunk_size).items(keys))
+
+
+def expected(document, keys):
+    return [(key, item) for key in document if key in keys for item in document[key]]
+
+
+@pytest.mark.parametrize('indent', [None, 2])
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 5, 7, 64, 1024 * 1024])
+def test_items_across_chunk_boundaries(chunk_size, indent):
+    text = json.dumps(DOCUMENT, indent=indent)
+    keys = ['images', 'numbers', 'annotations', 'categories']
+    assert items(text, keys, chunk_size) == expected(DOCUMENT, keys)
+
+
+@pytest.mark.parametrize('chunk_size', range(1, 12))
+def test_numbers_cut_by_chunks(chunk_size):
+    assert items('{"images": [-1, 2.5e3]}', ['images'], chunk_size) == [('images', -1), ('images', 2500.0)]
+    assert items('{"images": [12345, -6.75e-2,1e2]}', ['images'], chunk_size) == \
+        [('images', 12345), ('images', -0.0675), ('images', 100.0)]
+
+
+def test_stops_after_last_array():
+    text = json.dumps({'images': [1, 2], 'annotations': [3]}) + ' truncated garbage'
+    assert items(text, ['images'], 4) == [('images', 1), ('images', 2)]
+
+
+@pytest.mark.parametrize('text', ['[1, 2]', '{"images": [1, 2', '{"images": [1, tru]}'])
+def test_invalid_files(text):
+    with pytest.raises(ValueError):
+        items(text, ['images', 'annotations'], 3)
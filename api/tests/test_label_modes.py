@@ -0,0 +1,154 @@
+import random
+
+import cv2
+import numpy
+import pytest
+from PIL import Image as PILImage
+
+from routers.labels.models import Label
+from routers.pipelines import core
+from routers.pipelines.core import augment_sample, build_operations
+from routers.pipelines.models import Operation, OperationBackend, OperationType
+from routers.pipelines.operations import GEOMETRIC_OPERATIONS, draw_operation, transform_boxes, warp
+
+# Run from `api` folder : `python -m pytest tests`
+
+WIDTH, HEIGHT = 320, 240
+TOLERANCE = 2  # pixels, masks are resampled then thresholded
+SEEDS = range(20)
+
+# Initial properties of the UX operations
+PROPERTIES = {
+    OperationType.ROTATE: {'max_left_rotation': 25, 'max_right_rotation': 25},
+    OperationType.FLIP_RANDOM: {},
+    OperationType.SKEW: {'magnitude': 1},
+    OperationType.CROP_RANDOM: {'percentage_area': 0.75, 'randomise_percentage_area': False},
+    OperationType.SHEAR: {'max_shear_left': 25, 'max_shear_right': 25}
+}
+GEOMETRIC_TYPES = [OperationType(function.__name__) for function in GEOMETRIC_OPERATIONS.values()]
+CHAINS = [
+    [OperationType.ROTATE, OperationType.FLIP_RANDOM, OperationType.SHEAR],
+    [OperationType.SKEW, OperationType.CROP_RANDOM],
+    [OperationType.FLIP_RANDOM, OperationType.ROTATE, OperationType.CROP_RANDOM],
+    [OperationType.SHEAR, OperationType.SKEW, OperationType.ROTATE]
+]
+
+LABELS = [Label(id=str(position), x=x, y=y, w=w, h=h, category_id=str(position))
+          for position, (x, y, w, h) in enumerate([(0.4, 0.4, 0.2, 0.15),
+                                                    (0.3, 0.35, 0.1, 0.3),
+                                                    (0.45, 0.3, 0.12, 0.1),
+                                                    (0, 0, 0.25, 0.2),
+                                                    (0.7, 0.6, 0.3, 0.4),
+                                                    (0.05, 0.8, 0.5, 0.15)])]
+
+
+def rectangle_mask(label: Label):
+    """
+    Label as a filled rectangle : its bounding box after a projective transform is the one of its corners,
+    unlike the one of an ellipse.
+    """
+    mask = numpy.zeros((HEIGHT, WIDTH, 3), numpy.uint8)
+    mask[round(label.y * HEIGHT):round((label.y + label.h) * HEIGHT),
+         round(label.x * WIDTH):round((label.x + label.w) * WIDTH)] = 255
+    return mask
+
+
+def pixel_box(label: Label, width, height):
+    return numpy.array([label.x * width, label.y * height, (label.x + label.w) * width, (label.y + label.h) * height])
+
+
+def mask_box(mask):
+    x, y, w, h = cv2.boundingRect(cv2.inRange(mask, (120, 120, 120), (255, 255, 255)))
+    return numpy.array([x, y, x + w, y + h]) if w and h else None
+
+
+def sequential(sources, boxes, operations, seed, backend):
+    """
+    `sources` & pixel `boxes` transformed by each of `operations` in turn, drawn like `augment_sample` draws them :
+    one resampling per operation. Also returns the matrices of the operations composed.
+    """
+    native = backend == OperationBackend.OPENCV
+    rng = random.Random(seed)
+    size, composed = (WIDTH, HEIGHT), numpy.eye(3)
+    images = [source if native else PILImage.fromarray(source) for source in sources]
+    for operation in operations:
+        rng.uniform(0, 1)  # probability roll
+        do, matrix, size = draw_operation(operation, size, rng, native)
+        images = [do(image) for image in images]
+        boxes = transform_boxes(boxes, matrix, *size)
+        composed = matrix @ composed
+    return [numpy.asarray(image) for image in images], boxes, composed
+
+
+@pytest.mark.parametrize('backend', list(OperationBackend))
+@pytest.mark.parametrize('operation_type', GEOMETRIC_TYPES)
+def test_geometric_boxes_match_raster_masks(operation_type, backend):
+    image = numpy.random.default_rng(0).integers(0, 256, (HEIGHT, WIDTH, 3), dtype=numpy.uint8)
+    masks = [rectangle_mask(label) for label in LABELS]
+    operations = build_operations([Operation(type=operation_type, probability=1,
+                                             properties=PROPERTIES[operation_type])])
+
+    compared = 0
+    for seed in SEEDS:
+        raster_image, raster_labels = augment_sample([image, *masks], LABELS, operations, 'image', seed=seed,
+                                                     label_mode='raster', backend=backend)
+        geometric_image, geometric_labels = augment_sample([image], LABELS, operations, 'image', seed=seed,
+                                                           label_mode='geometric', backend=backend)
+        assert numpy.array_equal(raster_image, geometric_image)
+
+        # Labels pushed out of the image are dropped by both modes
+        assert [label.category_id for label in raster_labels] == [label.category_id for label in geometric_labels]
+
+        height, width = raster_image.shape[:2]
+        for raster_label, geometric_label in zip(raster_labels, geometric_labels):
+            raster_box = pixel_box(raster_label, width, height)
+            # Edges cut by the image border at a shallow angle : one pixel of mask along the border is several
+            # across it, boxes are only compared away from the borders
+            if raster_box[0] <= 0 or raster_box[1] <= 0 or raster_box[2] >= width or raster_box[3] >= height:
+                continue
+            assert numpy.abs(raster_box - pixel_box(geometric_label, width, height)).max() <= TOLERANCE
+            compared += 1
+    assert compared >= len(SEEDS)
+
+
+
+@pytest.mark.parametrize('backend', list(OperationBackend))
+@pytest.mark.parametrize('chain', CHAINS, ids=lambda chain: '-'.join(operation_type.value for operation_type in chain))
+def test_fused_operations_match_sequential(chain, backend, monkeypatch):
+    # Smooth image : resampling once or once per operation differ by interpolation only
+    image = cv2.resize(numpy.random.default_rng(0).integers(0, 256, (6, 8, 3), dtype=numpy.uint8), (WIDTH, HEIGHT),
+                       interpolation=cv2.INTER_CUBIC)
+    operations = build_operations([Operation(type=operation_type, probability=1,
+                                             properties=PROPERTIES[operation_type]) for operation_type in chain])
+    fused = []
+    monkeypatch.setattr(core, 'warp', lambda *args: fused.append(args) or warp(*args))
+
+    compared = 0
+    for seed in SEEDS:
+        fused_image, fused_labels = augment_sample([image], LABELS, operations, 'image', seed=seed,
+                                                   label_mode='geometric', backend=backend)
+        boxes = numpy.array([pixel_box(label, WIDTH, HEIGHT) for label in LABELS])
+        images, boxes, composed = sequential([image, *map(rectangle_mask, LABELS)], boxes, operations, seed, backend)
+        sequential_image, *masks = images
+
+        assert numpy.allclose(fused[-1][0], composed)
+        assert fused_image.shape == sequential_image.shape
+        differences = numpy.abs(fused_image.astype(int) - sequential_image.astype(int))
+        assert differences.mean() <= 1.5 and numpy.percentile(differences, 99) <= 8
+
+        height, width = fused_image.shape[:2]
+        fused_boxes = {label.category_id: pixel_box(label, width, height) for label in fused_labels}
+        for label, box, mask in zip(LABELS, boxes, masks):
+            if label.category_id not in fused_boxes:
+                assert box[2] <= box[0] or box[3] <= box[1]  # out of the image
+                continue
+            assert numpy.abs(fused_boxes[label.category_id] - box).max() <= 1e-3 * max(width, height)
+
+            # Boxes of each operation are boxed again by the next one : they contain the warped rectangle
+            masked = mask_box(mask)
+            if masked is None:
+                continue
+            assert (box[:2] <= masked[:2] + TOLERANCE).all() and (box[2:] >= masked[2:] - TOLERANCE).all()
+            compared += 1
+    assert len(fused) == len(SEEDS)  # every sample took the fused path
+    assert compared >= len(SEEDS)
@@ -0,0 +1,43 @@
+import threading
+import time
+
+import pytest
+
+from utils import LRUCache
+
+# Run from `api` folder : `python -m pytest tests`
+
+
+def test_concurrent_misses_load_once():
+    cache = LRUCache(1 << 20)
+    loads = []
+
+    def loader():
+        loads.append(1)
+        time.sleep(0.1)
+        return b'pixels'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_load('original', loader)))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(loads) == 1
+    assert sorted(hit for _, hit in results) == [False] + [True] * 7
+    assert all(value == b'pixels' for value, _ in results)
+    assert cache.stats()['misses'] == 1 and cache.stats()['hits'] == 7
+
+
+def test_failed_load_is_raised_then_retried():
+    cache = LRUCache(1 << 20)
+
+    def failing():
+        raise IOError('unreachable')
+
+    with pytest.raises(IOError):
+        cache.get_or_load('original', failing)
+    assert cache.get_or_load('original', lambda: b'pixels') == (b'pixels', False)
+    assert cache.get_or_load('original', lambda: b'other') == (b'pixels', True)
@@ -0,0 +1,36 @@
+import pytest
+
+from storage.core import LocalStorage, MemoryStorage, Storage, StorageError, StorageNotFound
+
+# Run from `api` folder : `python -m pytest tests`
+
+
+@pytest.fixture(params=['local', 'memory'])
+def storage(request, tmp_path):
+    if request.param == 'local':
+        return LocalStorage(str(tmp_path), 'http://localhost/storage/')
+    return MemoryStorage()
+
+
+def test_backends_implement_every_operation():
+    with pytest.raises(TypeError):
+        Storage()
+
+
+def test_missing_keys_raise_not_found(storage):
+    storage.put('image', b'content')
+    assert storage.get('image') == b'content'
+    storage.delete(['image'])
+
+    assert not storage.exists('image')
+    with pytest.raises(StorageNotFound):
+        storage.get('image')
+    assert storage.stats()['get']['failures'] == 0
+
+
+def test_failures_raise_storage_error(tmp_path):
+    storage = LocalStorage(str(tmp_path), 'http://localhost/storage/')
+    with pytest.raises(StorageError) as error:
+        storage.put('../image', b'content')
+    assert not isinstance(error.value, StorageNotFound)
+    assert storage.stats()['put']['failures'] == 1
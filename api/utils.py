@@ -1,11 +1,19 @@
+import concurrent.futures
 import json
-from uuid import UUID
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Any, Callable, Iterable, Iterator, List, Set, Tuple
+from uuid import UUID, uuid5
 
 from bson import json_util
 from bson.objectid import ObjectId
 from datetime import date, datetime
 from passlib.context import CryptContext
 from pydantic import BaseModel, BaseConfig
+from pymongo import DeleteMany, InsertOne, ReplaceOne, UpdateOne
 from pymongo.encryption import Algorithm
 
 from config import Config
@@ -97,6 +105,40 @@ class MongoModel(BaseModel):
         return cls(**dict(data, id=id))
 
 
+def derived_id(parent_id, name) -> str:
+    """
+    Deterministic id of `name` under `parent_id`, so that a retried task writes the same documents.
+    """
+    return str(uuid5(UUID(parent_id), str(name)))
+
+
+def to_ranges(indices) -> List[List[int]]:
+    ranges = []
+    for index in sorted(indices):
+        if ranges and ranges[-1][1] == index:
+            ranges[-1][1] = index + 1
+        else:
+            ranges.append([index, index + 1])
+    return ranges
+
+
+def merge_ranges(ranges) -> List[List[int]]:
+    """
+    Overlapping or adjacent `[start, end)` ranges merged, sorted.
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and merged[-1][1] >= start:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def from_ranges(ranges) -> Set[int]:
+    return {index for start, end in ranges for index in range(start, end)}
+
+
 def get_unique(iterable, key):
     unique_keys = list(set([el[key].lower() for el in iterable]))
     result = []
@@ -107,3 +149,300 @@ def get_unique(iterable, key):
         except StopIteration:
             pass
     return result
+
+
+def sizeof(value) -> int:
+    if isinstance(value, (list, tuple)):
+        return sum(sizeof(el) for el in value)
+    if hasattr(value, 'nbytes'):
+        return value.nbytes
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache, bounded by the total size in bytes of its values.
+    With a `ttl`, entries also expire `ttl` seconds after they were put.
+    """
+
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        if key in self._entries and self._entries[key][2] < time.monotonic():
+            self._bytes -= self._entries.pop(key)[1]
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key][0]
+
+    def get(self, key):
+        with self._lock:
+            value = self._lookup(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def get_or_load(self, key, loader: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        Value of `key` & whether it was a hit. On a miss, `loader()` is called & its value put : concurrent
+        calls for the same key wait for this single load, and are hits. Its error is raised to all of them.
+        """
+        with self._lock:
+            value = self._lookup(key)
+            loading = self._loading.get(key)
+            if value is None and loading is None:
+                self.misses += 1
+                loading = self._loading[key] = concurrent.futures.Future()
+                owner = True
+            else:
+                self.hits += 1
+                owner = False
+        if value is not None:
+            return value, True
+        if not owner:
+            return loading.result(), True
+
+        try:
+            value = self.put(key, loader())
+        except BaseException as e:
+            loading.set_exception(e)
+            raise
+        else:
+            loading.set_result(value)
+        finally:
+            with self._lock:
+                del self._loading[key]
+        return value, False
+
+    def put(self, key, value):
+        size = sizeof(value)
+        if size > self.max_bytes:
+            return value
+        expires_at = time.monotonic() + self.ttl if self.ttl else float('inf')
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size, expires_at)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+        return value
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0
+        }
+
+
+class BulkWriter:
+    """
+    Buffer inserts, deletes and `$inc` updates per collection, written as ordered `bulk_write` batches
+    once `max_operations` are pending or `max_delay` seconds passed since last flush.
+    `$inc` deltas on the same document are merged, and written after the other requests of their collection.
+    """
+
+    def __init__(self, max_operations=1000, max_delay=2.):
+        self.max_operations = max_operations
+        self.max_delay = max_delay
+        self._requests = defaultdict(list)
+        self._increments = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
+        self._pending = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    def _add(self, collection, requests):
+        with self._lock:
+            self._requests[collection].extend(requests)
+            self._pending += len(requests)
+        self._flush_if_needed()
+
+    def insert_one(self, collection, document):
+        self._add(collection, [InsertOne(document)])
+
+    def insert_many(self, collection, documents):
+        self._add(collection, [InsertOne(document) for document in documents])
+
+    def replace_one(self, collection, document):
+        self._add(collection, [ReplaceOne({'_id': document['_id']}, document, upsert=True)])
+
+    def delete_many(self, collection, query):
+        self._add(collection, [DeleteMany(query)])
+
+    def increment(self, collection, document_id, field, delta):
+        with self._lock:
+            self._increments[collection][document_id][field] += delta
+            self._pending += 1
+        self._flush_if_needed()
+
+    def _flush_if_needed(self):
+        if self._pending >= self.max_operations or time.monotonic() - self._last_flush >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                requests, self._requests = self._requests, defaultdict(list)
+                increments, self._increments = self._increments, defaultdict(
+                    lambda: defaultdict(lambda: defaultdict(int)))
+                self._pending = 0
+                self._last_flush = time.monotonic()
+
+            for collection in list(requests.keys()) + [key for key in increments.keys() if key not in requests]:
+                batch = requests.get(collection, []) + [UpdateOne({'_id': document_id}, {'$inc': dict(fields)})
+                                                        for document_id, fields in increments[collection].items()]
+                if batch:
+                    db[collection].bulk_write(batch, ordered=True)
+
+
+class Checkpoint:
+    """
+    Indices of the completed work items of a task, saved in its document as `[start, end)` ranges
+    at most every `TASK_CHECKPOINT_INTERVAL` seconds, with its progress. Documents buffered in `writer`
+    are flushed first : a checkpointed item is always fully written.
+    New ranges are merged with the saved ones, swapped only if no other worker saved meanwhile, so several workers
+    may checkpoint the same task & saved ranges stay compact.
+    A `redelivered` attempt may have written documents before its first save : it is `resumed` too.
+    """
+
+    def __init__(self, task_id, total, writer: BulkWriter, redelivered=False):
+        self.task_id = task_id
+        self.total = total
+        self.writer = writer
+        task = db.tasks.find_one({'_id': task_id}, {'checkpoint': 1}) or {}
+        self.done = from_ranges(task.get('checkpoint') or [])
+        self.resumed = bool(self.done) or redelivered
+        self._saved = set(self.done)
+        self._last_save = time.monotonic()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+    def add(self, index):
+        with self._lock:
+            self.done.add(index)
+            if time.monotonic() - self._last_save < Config.TASK_CHECKPOINT_INTERVAL:
+                return
+            self._last_save = time.monotonic()
+        self.save()
+
+    def save(self):
+        with self._save_lock:
+            with self._lock:
+                done = self.done - self._saved
+            self.writer.flush()
+            if not done:
+                return
+            while True:
+                task = db.tasks.find_one({'_id': self.task_id}, {'checkpoint': 1})
+                if task is None:
+                    return
+                saved = task.get('checkpoint')
+                ranges = merge_ranges((saved or []) + to_ranges(done))
+                progress = sum(end - start for start, end in ranges) / self.total
+                result = db.tasks.update_one({'_id': self.task_id, 'checkpoint': saved},
+                                             {'$set': {'checkpoint': ranges, 'progress': progress}})
+                if result.matched_count:
+                    break
+            self._saved |= done
+
+
+class JSONArrayStream:
+    """
+    Incrementally read the top level arrays of a JSON object file, decoding one item at a time
+    from a buffer of about `chunk_size` characters : memory is bounded by the largest item, not by the file.
+    """
+    _decoder = json.JSONDecoder()
+    _separators = re.compile(r'[\s,:]*')
+    _number_characters = re.compile(r'[\d.eE+-]*')
+
+    def __init__(self, file, chunk_size=1024 * 1024):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+
+    def _read(self):
+        chunk = self.file.read(self.chunk_size)
+        self.eof = not chunk
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+
+    def _next(self) -> str:
+        """
+        Skip separators, and return the next significant character without consuming it.
+        """
+        while True:
+            self.position = self._separators.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if self.eof:
+                raise ValueError('Unexpected end of JSON file')
+            self._read()
+
+    def _decode(self):
+        """
+        Decode the next value, reading more of the file while it may be cut by the end of the buffer :
+        invalid, or a number followed by number characters only (`2` of `2.5e3`).
+        """
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buffer, self.position)
+                is_number = isinstance(value, (int, float)) and not isinstance(value, bool)
+                if self.eof or not is_number or \
+                        self._number_characters.match(self.buffer, end).end() < len(self.buffer):
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._read()
+
+    def items(self, keys: Iterable[str]) -> Iterator[Tuple[str, object]]:
+        """
+        Yield `(key, item)` for the items of arrays `keys`, in file order. Other values are decoded & dropped,
+        and reading stops once every array of `keys` was read.
+        """
+        remaining = set(keys)
+        if self._next() != '{':
+            raise ValueError('JSON file is not an object')
+        self.position += 1
+        while remaining and self._next() != '}':
+            key = self._decode()
+            if self._next() != '[':
+                self._decode()
+                continue
+            self.position += 1
+            while self._next() != ']':
+                item = self._decode()
+                if key in remaining:
+                    yield key, item
+            self.position += 1
+            remaining.discard(key)
+
+
+def stream_json_arrays(path, keys: Iterable[str]) -> Iterator[Tuple[str, object]]:
+    with open(path, 'r') as file:
+        yield from JSONArrayStream(file).items(keys)
@@ -1,16 +1,22 @@
 import functools
+import time
 from datetime import datetime
 
-from celery import Celery
+from celery import Celery, chord
 
 import errors
+from config import Config
+from routers.images.core import collect_storage_garbage
 from routers.notifications.core import insert_notification
 from routers.notifications.models import NotificationPostBody, NotificationType
 from utils import update_task
 from workflows.augmentor import augmentor
 from workflows.generator import generator
 
-app = Celery('worker', broker='pyamqp://', backend='rpc://')
+# Results are stored in mongo : chunks of a task may run on several workers, and their results must be
+# visible to whichever worker runs the chord callback
+db_uri = Config.DB_HOST if Config.DB_HOST.startswith('mongodb://') else f'mongodb://{Config.DB_HOST}'
+app = Celery('worker', broker='pyamqp://', backend=f'{db_uri.rstrip("/")}/{Config.DB_NAME}')
 
 
 class CeleryConfig:
@@ -23,8 +29,19 @@ class CeleryConfig:
 
 app.config_from_object(CeleryConfig)
 
+# Run by a single beat : `celery-beat` service of builds/docker-compose.yml, or `-B` of a local worker (`run_worker.sh`)
+app.conf.beat_schedule = {
+    'collect-storage-garbage': {'task': 'worker.run_storage_garbage_collection', 'schedule': Config.STORAGE_GC_INTERVAL}
+}
+
+
+def handle_task_error(func=None, complete=True):
+    """
+    Mark the task failed on error. Unless `complete` is False, the task is also marked succeeded on return.
+    """
+    if func is None:
+        return functools.partial(handle_task_error, complete=complete)
 
-def handle_task_error(func):
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         user_id = args[0]
@@ -45,22 +62,52 @@ def handle_task_error(func):
                                                 description=message)
             insert_notification(user_id=user_id, notification=notification)
         else:
-            update_task(task_id, status='success', progress=1, ended_at=datetime.now())
-            notification = NotificationPostBody(type=NotificationType('TASK_SUCCEED'),
-                                                task_id=task_id)
-            insert_notification(user_id=user_id, notification=notification)
+            if complete:
+                update_task(task_id, status='success', progress=1, ended_at=datetime.now())
+                notification = NotificationPostBody(type=NotificationType('TASK_SUCCEED'),
+                                                    task_id=task_id)
+                insert_notification(user_id=user_id, notification=notification)
             return result
 
     return wrapper
 
 
-@app.task
-@handle_task_error
-def run_generator(user_id, task_id, properties):
-    generator.main(user_id, task_id, properties)
+# Acknowledged once done : a task whose worker is killed is delivered again, and resumes from its checkpoint
+@app.task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def run_generator(self, user_id, task_id, properties):
+    handle_task_error(generator.main)(user_id, task_id, properties,
+                                      redelivered=self.request.delivery_info.get('redelivered', False))
 
 
-@app.task
-@handle_task_error
+# Fan out : chunks of samples run on all workers, the task is completed by the chord callback
+@app.task(acks_late=True, reject_on_worker_lost=True)
+@handle_task_error(complete=False)
 def run_augmentor(user_id, task_id, dataset_id, properties):
-    augmentor.main(user_id, task_id, dataset_id, properties)
+    chunks = augmentor.chunks(task_id, dataset_id, properties)
+    callback = finalize_augmentor.s(user_id, task_id, dataset_id, properties, time.time())
+    if not chunks:
+        callback.delay([])
+        return
+    chord(run_augmentor_chunk.s(user_id, task_id, dataset_id, properties, chunk) for chunk in chunks)(callback)
+
+
+@app.task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def run_augmentor_chunk(self, user_id, task_id, dataset_id, properties, chunk):
+    # Never raises, so that the chord callback always runs & reports the failure
+    try:
+        return augmentor.sample_chunk(task_id, dataset_id, properties, chunk,
+                                      redelivered=self.request.delivery_info.get('redelivered', False))
+    except errors.APIError as error:
+        return {'errors': [error.detail]}
+    except Exception as e:
+        return {'errors': [f"An error occured {str(e)}"]}
+
+
+@app.task(acks_late=True, reject_on_worker_lost=True)
+def finalize_augmentor(results, user_id, task_id, dataset_id, properties, started_at):
+    handle_task_error(augmentor.finalize)(user_id, task_id, dataset_id, properties, results, started_at)
+
+
+@app.task
+def run_storage_garbage_collection():
+    return collect_storage_garbage()
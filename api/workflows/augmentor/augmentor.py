@@ -1,121 +1,432 @@
 import concurrent.futures
+import multiprocessing
+import os
 import random
-from uuid import uuid4
+import time
+from collections import defaultdict
+from multiprocessing import shared_memory
+from typing import List, Tuple
 
 import cv2
 import numpy
 from Augmentor import DataPipeline
-from PIL import Image as PILImage
 
+import errors
 from config import Config
-from routers.images.core import find_images, upload_image
+from logger import logger
+from routers.datasets.core import recount_dataset
+from routers.images.core import find_images, upload_image, upload_renditions
+from routers.images.ingest import encode_renditions
 from routers.images.models import Image
-from routers.labels.core import find_labels, regroup_labels_by_category
-from routers.pipelines.core import from_image_path, draw_ellipsis, retrieve_label_from_ellipsis
+from routers.labels.core import find_labels_from_image_ids
+from routers.pipelines.core import from_image_path, draw_ellipsis, augment_sample, augment_labels, \
+    virtual_image_path, build_operations
 from routers.pipelines.models import Pipeline
 from routers.tasks.models import TaskAugmentorProperties
-from utils import update_task, increment_task_progress
+from utils import update_task, derived_id, from_ranges, LRUCache, BulkWriter, Checkpoint
 
 db = Config.db
 
+_worker_cache = None
+
+
+def _share_pixels(pixels):
+    shm = shared_memory.SharedMemory(create=True, size=pixels.nbytes)
+    shared_pixels = numpy.ndarray(pixels.shape, dtype=pixels.dtype, buffer=shm.buf)
+    shared_pixels[:] = pixels
+    return shm, {'name': shm.name, 'shape': pixels.shape, 'dtype': pixels.dtype.str}
+
+
+def _attach_pixels(descriptor):
+    shm = shared_memory.SharedMemory(name=descriptor['name'])
+    pixels = numpy.ndarray(descriptor['shape'], dtype=descriptor['dtype'], buffer=shm.buf).copy()
+    shm.close()
+    return pixels
+
+
+def _init_worker(cache_max_bytes):
+    global _worker_cache
+    _worker_cache = LRUCache(cache_max_bytes)
+
+
+def _load_sources(image, labels, pixels=None, virtual=False):
+    if virtual:
+        sources = []
+    elif pixels is not None:
+        sources = [_attach_pixels(pixels)]
+    else:
+        sources = [from_image_path(image.path)]
+
+    if Config.AUGMENTOR_LABEL_MODE == 'raster':
+        for label in labels:
+            sources.append(draw_ellipsis(image.width, image.height, label))
+
+    for source in sources:
+        source.setflags(write=False)
+    return sources
+
+
+def _timed(function, *args):
+    """
+    Result of `function` with the monotonic times it started & ended at : clocks of every process of a host agree.
+    """
+    started_at = time.monotonic()
+    result = function(*args)
+    return started_at, time.monotonic(), result
+
+
+def _busy_time(intervals) -> float:
+    """
+    Seconds during which one of the `(start, end)` intervals at least was running.
+    """
+    busy, busy_until = 0., float('-inf')
+    for start, end in sorted(intervals):
+        if end > busy_until:
+            busy += end - max(start, busy_until)
+            busy_until = end
+    return busy
+
 
 def process_augmentation(payload):
-    index = payload['index']
+    """
+    CPU stage : augment one sample & encode it with its renditions,
+    returning `(cache_hit, new_image, new_labels, image_bytes, renditions)`.
+    """
     image = payload['image']
     labels = payload['labels']
     operations = payload['operations']
     dataset_id = payload['dataset_id']
     pipeline_id = payload['pipeline_id']
-    task_id = payload['task_id']
-    image_count = payload['image_count']
-
-    images = [from_image_path(image.path)]
-
-    for label in labels[index]:
-        images.append(draw_ellipsis(image.width, image.height, label))
+    virtual = payload['virtual']
+    backend = payload['backend']
+    encoding = payload['encoding']
+    new_image_id = payload['new_image_id']
+    pixels = payload.get('pixels')
+    cache = payload.get('cache') or _worker_cache
 
-    input_images = [PILImage.fromarray(x) for x in images]
+    # Samples of the same original running at once share a single load
+    images, cache_hit = cache.get_or_load(image.id, lambda: _load_sources(image, labels, pixels, virtual))
 
-    augmented_images = input_images
+    seed = random.getrandbits(32)
 
-    for operation in operations:
-        roll = round(random.uniform(0, 1), 1)
-        if roll <= operation.probability:
-            augmented_images = operation.perform_operation(augmented_images)
+    if virtual:
+        # Only the recipe is stored, pixels are rendered on demand
+        (width, height), new_labels = augment_labels((image.width, image.height), images, labels, operations,
+                                                     new_image_id, seed, backend=backend)
+        image_bytes, renditions = None, None
+        path = virtual_image_path(new_image_id)
+        size = 0
+    else:
+        augmented_image, new_labels = augment_sample(images, labels, operations, new_image_id, seed=seed,
+                                                     backend=backend)
+        image_bytes = cv2.imencode('.jpg', augmented_image, encoding)[1].tostring()
+        renditions = encode_renditions(augmented_image, Config.IMAGE_RENDITIONS, Config.IMAGE_RENDITIONS_FORMAT)
+        path = ''  # known once uploaded
+        size = len(image_bytes)
+        width, height = augmented_image.shape[1], augmented_image.shape[0]
 
-    new_image_id = str(uuid4())
-
-    new_labels = [retrieve_label_from_ellipsis(numpy.asarray(augmented_image), new_image_id)
-                  for augmented_image in augmented_images[1:]]
-    for j, label in enumerate(new_labels):
-        if label:
-            label.category_id = labels[index][j].category_id
-    new_labels = list(filter(None.__ne__, new_labels))
-
-    image_bytes = cv2.imencode('.jpg', numpy.asarray(augmented_images[0]))[1].tostring()
-    path = upload_image(image_bytes, new_image_id)
     new_image = Image(
         id=new_image_id,
         dataset_id=dataset_id,
         path=path,
         name=f'augmented-{image.name}',
-        size=len(image_bytes),
-        width=augmented_images[0].width,
-        height=augmented_images[0].height,
+        size=size,
+        width=width,
+        height=height,
         pipeline_id=pipeline_id,
-        original_image_id=image.id
+        original_image_id=image.id,
+        seed=seed,
+        is_virtual=virtual
     )
-    db.images.insert_one(new_image.mongo())
-    if new_labels:
-        db.labels.insert_many([label.mongo() for label in new_labels])
+    return cache_hit, new_image, new_labels, image_bytes, renditions
+
 
-    for category_id, labels_count in regroup_labels_by_category(new_labels).items():
-        db.categories.find_one_and_update(
-            {'_id': category_id},
-            {'$inc': {'labels_count': labels_count}}
-        )
+def store_augmentation(new_image: Image, new_labels, image_bytes, renditions, writer: BulkWriter, replace=False):
+    """
+    I/O stage : upload an encoded sample & its renditions, then buffer its documents.
+    With `replace`, documents a previous attempt may have written for this sample are replaced.
+    Dataset & categories counters are recomputed once the whole task is done.
+    """
+    if image_bytes is not None:
+        new_image.path = upload_image(image_bytes, new_image.id)
+        new_image.renditions = upload_renditions(renditions, new_image.path)
 
-    increment_task_progress(task_id, 1 / image_count)
+    if replace:
+        writer.replace_one('images', new_image.mongo())
+        writer.delete_many('labels', {'image_id': new_image.id})
+    else:
+        writer.insert_one('images', new_image.mongo())
+    writer.insert_many('labels', [label.mongo() for label in new_labels])
 
 
 class AugmentorPipeline(DataPipeline):
+    """
+    Samples of the `chunk` of indices `[start, end)` of an augmentor task, sample `index` augmenting the original
+    at `index % len(images)`. Originals are sorted by id, so every worker of the task agrees on this mapping.
+    """
 
-    def __init__(self, task_id, dataset_id, properties):
+    def __init__(self, task_id, dataset_id, properties, chunk=None):
         self.task_id = task_id
         self.dataset_id = dataset_id
-        self.images = find_images(dataset_id)
-        self.labels = [find_labels(image.id) for image in self.images]
+        self.images = sorted(find_images(dataset_id), key=lambda image: image.id)
         self.properties = properties
+        self.chunk = chunk or (0, properties.image_count)
+        self.cache = LRUCache(Config.AUGMENTOR_CACHE_MAX_BYTES)
+
+        # Only labels of the originals this chunk augments
+        image_ids = [image.id for position, image in enumerate(self.images) if self._indices(position)]
+        labels = defaultdict(list)
+        for label in find_labels_from_image_ids(image_ids):
+            labels[label.image_id].append(label)
+        self.labels = [labels[image.id] for image in self.images]
         super().__init__(self.images, self.labels)
 
-    def sample(self):
-        pipeline_id = str(uuid4())
-        pipeline = Pipeline(
-            id=pipeline_id,
-            dataset_id=self.dataset_id,
-            operations=self.properties.operations,
-            image_count=self.properties.image_count
-        )
-        db.pipelines.insert_one(pipeline.mongo())
-        db.datasets.update_one({'_id': self.dataset_id},
-                               {'$inc': {'augmented_count': self.properties.image_count}},
-                               upsert=False)
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            result = executor.map(process_augmentation,
-                                  [{'index': index % len(self.images),
-                                    'image': self.images[index % len(self.images)],
-                                    'labels': self.labels,
-                                    'operations': self.operations,
-                                    'dataset_id': self.dataset_id,
-                                    'pipeline_id': pipeline_id,
-                                    'task_id': self.task_id,
-                                    'image_count': self.properties.image_count
-                                    } for index in range(self.properties.image_count)])
+    def _indices(self, position):
+        """
+        Sample indices of the chunk augmenting the original at `position`, yielded together so its cached
+        sources stay hot.
+        """
+        start, end = self.chunk
+        return range(start + (position - start) % len(self.images), end, len(self.images))
 
+    def _payload(self, index, pipeline_id, pixels=None, cache=None):
+        position = index % len(self.images)
+        return {'image': self.images[position],
+                'labels': self.labels[position],
+                'operations': self.operations,
+                'dataset_id': self.dataset_id,
+                'pipeline_id': pipeline_id,
+                'index': index,
+                'new_image_id': derived_id(self.task_id, index),
+                'virtual': self.properties.virtual,
+                'backend': self.properties.backend,
+                'encoding': [cv2.IMWRITE_JPEG_QUALITY, self.properties.jpeg_quality,
+                             cv2.IMWRITE_JPEG_PROGRESSIVE, int(self.properties.jpeg_progressive),
+                             cv2.IMWRITE_JPEG_OPTIMIZE, int(self.properties.jpeg_optimize)],
+                'pixels': pixels,
+                'cache': cache}
 
-def main(user_id, task_id, dataset_id, properties: TaskAugmentorProperties):
+    def _work(self, pipeline_id, done, cache=None, shared=None):
+        """
+        Lazily yield payloads of samples not `done` yet, original by original. When `shared` is given, each
+        original is decoded here and exposed through shared memory, registered in `shared` with the count
+        of samples still using it.
+        """
+        for position, image in enumerate(self.images):
+            indices = [index for index in self._indices(position) if index not in done]
+            if not indices:
+                continue
+            pixels = None
+            if shared is not None and not self.properties.virtual:
+                shm, pixels = _share_pixels(from_image_path(image.path))
+                shared[shm.name] = [shm, len(indices)]
+            for index in indices:
+                yield self._payload(index, pipeline_id, pixels=pixels, cache=cache)
+
+    def _run(self, executor, work, window_size, io_executor, checkpoint, shared=None):
+        """
+        Two stages, consumed as they complete : `executor` augments & encodes at most `window_size` payloads
+        of `work` at once, then `io_executor` uploads them & writes their documents, with at most
+        `AUGMENTOR_IO_QUEUE_SIZE` waiting. No new payload is submitted while the I/O stage is full.
+        Only samples that were actually stored are checkpointed. The busy time of each stage is the time
+        one of its samples at least was running.
+        """
+        writer = checkpoint.writer
+        stats = {'hits': 0, 'misses': 0, 'errors': [], 'augmented': 0, 'stored': 0}
+        intervals = {'augmented': [], 'stored': []}
+        augmenting, storing = {}, {}
+
+        def fail(error):
+            stats['errors'].append(str(error))
+            logger.notify('Augmentor', f'Augmentation failed : {str(error)}', level='error')
+
+        def stored(futures):
+            for future in futures:
+                index = storing.pop(future)
+                try:
+                    started_at, ended_at, _ = future.result()
+                except Exception as e:
+                    fail(e)
+                    continue
+                intervals['stored'].append((started_at, ended_at))
+                stats['stored'] += 1
+                checkpoint.add(index)
+
+        def augmented(futures):
+            for future in futures:
+                payload = augmenting.pop(future)
+                pixels = payload['pixels']
+                if pixels is not None:
+                    entry = shared[pixels['name']]
+                    entry[1] -= 1
+                    if entry[1] == 0:
+                        entry[0].close()
+                        entry[0].unlink()
+                        del shared[pixels['name']]
+                try:
+                    started_at, ended_at, (cache_hit, *augmentation) = future.result()
+                except Exception as e:
+                    fail(e)
+                    continue
+                intervals['augmented'].append((started_at, ended_at))
+                stats['hits' if cache_hit else 'misses'] += 1
+                stats['augmented'] += 1
+
+                # Backpressure : wait for the I/O stage to make room
+                while len(storing) >= Config.AUGMENTOR_IO_QUEUE_SIZE:
+                    done, _ = concurrent.futures.wait(storing, return_when=concurrent.futures.FIRST_COMPLETED)
+                    stored(done)
+                storing[io_executor.submit(_timed, store_augmentation, *augmentation, writer, checkpoint.resumed)] = \
+                    payload['index']
+
+            stored([future for future in storing if future.done()])
+
+        try:
+            for payload in work:
+                augmenting[executor.submit(_timed, process_augmentation, payload)] = payload
+                if len(augmenting) >= window_size:
+                    done, _ = concurrent.futures.wait(augmenting, return_when=concurrent.futures.FIRST_COMPLETED)
+                    augmented(done)
+        finally:
+            done, _ = concurrent.futures.wait(augmenting)
+            augmented(done)
+            done, _ = concurrent.futures.wait(storing)
+            stored(done)
+
+        stats['busy'] = {stage: _busy_time(stage_intervals) for stage, stage_intervals in intervals.items()}
+        return stats
+
+    def _sample_with_threads(self, pipeline_id, max_workers, io_executor, checkpoint):
+        max_workers = max_workers or os.cpu_count()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            work = self._work(pipeline_id, checkpoint.done, cache=self.cache)
+            return self._run(executor, work, 2 * max_workers, io_executor, checkpoint)
+
+    def _sample_with_processes(self, pipeline_id, max_workers, io_executor, checkpoint):
+        """
+        Originals are decoded once in this process and exposed to workers through shared memory,
+        released as soon as their last sample completes, so memory does not grow with the dataset.
+        Each worker keeps its own cache, with an equal share of the byte budget.
+        """
+        max_workers = max_workers or os.cpu_count()
+        context = multiprocessing.get_context('spawn')
+        shared = {}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+                                                    mp_context=context,
+                                                    initializer=_init_worker,
+                                                    initargs=(Config.AUGMENTOR_CACHE_MAX_BYTES // max_workers,)) \
+                as executor:
+            work = self._work(pipeline_id, checkpoint.done, shared=shared)
+            try:
+                return self._run(executor, work, 2 * max_workers, io_executor, checkpoint, shared)
+            finally:
+                for shm, _ in shared.values():
+                    shm.close()
+                    shm.unlink()
+
+    def sample(self, executor=None, max_workers=None, io_workers=None, redelivered=False) -> dict:
+        """
+        Augment & store the samples of the chunk not checkpointed yet, returning the stats of its stages.
+        """
+        executor = executor or Config.AUGMENTOR_EXECUTOR
+        max_workers = max_workers or Config.AUGMENTOR_MAX_WORKERS
+        io_workers = io_workers or Config.AUGMENTOR_IO_WORKERS
+        pipeline_id = derived_id(self.task_id, 'pipeline')
+        start, end = self.chunk
+
+        started_at = time.perf_counter()
+        with BulkWriter() as writer:
+            checkpoint = Checkpoint(self.task_id, self.properties.image_count, writer, redelivered=redelivered)
+            done = len([index for index in range(start, end) if index in checkpoint.done])
+            if done:
+                logger.notify('Augmentor', f'Resume chunk [{start}, {end}) of task `{self.task_id}`, '
+                                           f'{done} of {end - start} images already augmented')
+            with concurrent.futures.ThreadPoolExecutor(max_workers=io_workers) as io_executor:
+                if executor == 'process':
+                    stats = self._sample_with_processes(pipeline_id, max_workers, io_executor, checkpoint)
+                else:
+                    stats = self._sample_with_threads(pipeline_id, max_workers, io_executor, checkpoint)
+            checkpoint.save()
+        elapsed = time.perf_counter() - started_at
+
+        logger.notify('Augmentor', f'Chunk [{start}, {end}) : {stats["stored"]} images augmented in {elapsed:.1f}s '
+                                   f'({stats["stored"] / elapsed:.1f} images/sec, {executor} pool)')
+        return {'hits': stats['hits'],
+                'misses': stats['misses'],
+                'errors': stats['errors'],
+                'augmented': stats['augmented'],
+                'stored': stats['stored'],
+                'busy': stats['busy']}
+
+
+def chunks(task_id, dataset_id, properties: TaskAugmentorProperties) -> List[Tuple[int, int]]:
+    """
+    Mark the task active & store its pipeline, then split its sample indices into `[start, end)` chunks
+    of `AUGMENTOR_CHUNK_SIZE`, leaving out chunks its checkpoint already covers.
+    """
     update_task(task_id, status='active')
-    pipeline = AugmentorPipeline(task_id, dataset_id, properties)
-    for operation in properties.operations:
-        getattr(pipeline, operation.type)(probability=operation.probability, **operation.properties)
-    pipeline.sample()
+
+    # Same pipeline & image ids on every attempt of this task
+    pipeline_id = derived_id(task_id, 'pipeline')
+    pipeline = Pipeline(
+        id=pipeline_id,
+        dataset_id=dataset_id,
+        operations=properties.operations,
+        image_count=properties.image_count,
+        backend=properties.backend
+    )
+    db.pipelines.replace_one({'_id': pipeline_id}, pipeline.mongo(), upsert=True)
+
+    task = db.tasks.find_one({'_id': task_id}, {'checkpoint': 1}) or {}
+    done = from_ranges(task.get('checkpoint') or [])
+    if done:
+        logger.notify('Augmentor', f'Resume task `{task_id}`, {len(done)} of '
+                                   f'{properties.image_count} images already augmented')
+
+    chunk_size = Config.AUGMENTOR_CHUNK_SIZE
+    return [(start, min(start + chunk_size, properties.image_count))
+            for start in range(0, properties.image_count, chunk_size)
+            if not all(index in done for index in range(start, min(start + chunk_size, properties.image_count)))]
+
+
+def sample_chunk(task_id, dataset_id, properties: TaskAugmentorProperties, chunk, redelivered=False) -> dict:
+    pipeline = AugmentorPipeline(task_id, dataset_id, properties, chunk)
+    pipeline.operations = build_operations(properties.operations)
+    return pipeline.sample(redelivered=redelivered)
+
+
+def finalize(user_id, task_id, dataset_id, properties: TaskAugmentorProperties, results: List[dict], started_at):
+    """
+    Once every chunk is done : recount dataset & categories, and aggregate the stats of all chunks in the task.
+    The throughput of each stage is its count of images by its busy time, summed over chunks.
+    """
+    recount_dataset(dataset_id)
+
+    elapsed = time.time() - started_at
+    stats = {key: sum(result.get(key, 0) for result in results) for key in ('hits', 'misses', 'augmented', 'stored')}
+    failures = [error for result in results for error in result.get('errors', [])]
+    total = stats['hits'] + stats['misses']
+    cache_stats = {'hits': stats['hits'],
+                   'misses': stats['misses'],
+                   'hit_rate': round(stats['hits'] / total, 4) if total else 0}
+    busy = {stage: sum(result.get('busy', {}).get(stage, 0) for result in results) for stage in ('augmented', 'stored')}
+    throughput = {stage: round(stats[stage] / busy[stage], 2) if busy[stage] else 0 for stage in busy}
+    update_task(task_id, cache=cache_stats, throughput=throughput)
+
+    logger.notify('Augmentor', f'{stats["stored"]} images augmented in {elapsed:.1f}s by {len(results)} chunks '
+                               f'({stats["stored"] / elapsed:.1f} images/sec, {throughput["augmented"]} images/sec '
+                               f'augmenting & {throughput["stored"]} images/sec storing)')
+
+    if failures:
+        raise errors.InternalError('Augmentor', f'{len(failures)} of {properties.image_count} images '
+                                                f'could not be augmented : {failures[0]}')
+
+
+def main(user_id, task_id, dataset_id, properties: TaskAugmentorProperties):
+    """
+    Run every chunk of the task in this process, one after the other.
+    """
+    started_at = time.time()
+    results = [sample_chunk(task_id, dataset_id, properties, chunk)
+               for chunk in chunks(task_id, dataset_id, properties)]
+    finalize(user_id, task_id, dataset_id, properties, results, started_at)
@@ -0,0 +1,75 @@
+import subprocess
+import sys
+import time
+from datetime import datetime
+from uuid import uuid4
+
+from config import Config
+from logger import logger
+from routers.datasets.core import recount_dataset
+from routers.pipelines.core import delete_pipeline
+from routers.pipelines.models import Operation
+from routers.tasks.models import Task, TaskStatus, TaskAugmentorProperties
+from utils import derived_id
+from worker import run_augmentor
+
+db = Config.db
+
+# Wall time of one augmentor task fanned out on 1, 2 & 4 local worker processes.
+# Needs rabbitmq & mongo running, and no other worker consuming the queue.
+# Run from `api` folder : `python -m workflows.augmentor.benchmark <dataset_id> [image_count]`
+
+OPERATIONS = [
+    Operation(type='rotate', probability=0.8, properties={'max_left_rotation': 10, 'max_right_rotation': 10}),
+    Operation(type='flip_random', probability=0.5, properties={}),
+    Operation(type='random_brightness', probability=0.5, properties={'min_factor': 0.5, 'max_factor': 1.5})
+]
+
+
+def _run(dataset_id, properties, concurrency):
+    dataset = db.datasets.find_one({'_id': dataset_id})
+    task = Task(
+        id=str(uuid4()),
+        user_id=dataset['user_id'],
+        dataset_id=dataset_id,
+        type='augmentor',
+        created_at=datetime.now(),
+        status=TaskStatus('pending'),
+        progress=0,
+        properties=properties
+    )
+    db.tasks.insert_one(task.mongo())
+
+    worker = subprocess.Popen(['celery', '-A', 'worker', 'worker', f'--concurrency={concurrency}',
+                               '--loglevel=WARNING', f'--hostname=benchmark-{concurrency}@%h'])
+    try:
+        start = time.perf_counter()
+        run_augmentor.delay(task.user_id, task.id, dataset_id, properties=properties)
+        while db.tasks.find_one({'_id': task.id})['status'] not in ('success', 'failed'):
+            time.sleep(0.5)
+        elapsed = time.perf_counter() - start
+    finally:
+        worker.terminate()
+        worker.wait()
+
+    result = db.tasks.find_one({'_id': task.id})
+    delete_pipeline(dataset_id, derived_id(task.id, 'pipeline'))
+    recount_dataset(dataset_id)
+    db.tasks.delete_one({'_id': task.id})
+    db.notifications.delete_many({'task_id': task.id})
+    return elapsed, result['status']
+
+
+def benchmark(dataset_id, image_count=2000, concurrencies=(1, 2, 4)):
+    properties = TaskAugmentorProperties(image_count=image_count, operations=OPERATIONS)
+    results = {concurrency: _run(dataset_id, properties, concurrency) for concurrency in concurrencies}
+
+    for concurrency, (elapsed, status) in results.items():
+        logger.notify('Benchmark', f'{concurrency} worker processes : {image_count} images in {elapsed:7.1f}s | '
+                                   f'{image_count / elapsed:.1f} images/sec | '
+                                   f'x{results[concurrencies[0]][0] / elapsed:.2f} | {status}')
+    return results
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1], *[int(arg) for arg in sys.argv[2:3]])
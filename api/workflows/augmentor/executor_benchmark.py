@@ -0,0 +1,66 @@
+import sys
+import time
+from datetime import datetime
+from uuid import uuid4
+
+from config import Config
+from logger import logger
+from routers.datasets.core import recount_dataset
+from routers.pipelines.core import delete_pipeline, build_operations
+from routers.tasks.models import Task, TaskStatus, TaskAugmentorProperties
+from utils import derived_id
+from workflows.augmentor.augmentor import AugmentorPipeline, chunks
+from workflows.augmentor.benchmark import OPERATIONS
+
+db = Config.db
+
+# Throughput of `AugmentorPipeline.sample` with the `thread` & `process` executors, in this process, on the same
+# dataset, operations & image count.
+# Needs mongo running. Set `STORAGE_BACKEND=local` or `memory` to leave network uploads out of the figures.
+# Run from `api` folder : `python -m workflows.augmentor.executor_benchmark <dataset_id> [image_count] [max_workers]`
+
+
+def _run(dataset_id, properties, executor, max_workers=None):
+    dataset = db.datasets.find_one({'_id': dataset_id})
+    task = Task(
+        id=str(uuid4()),
+        user_id=dataset['user_id'],
+        dataset_id=dataset_id,
+        type='augmentor',
+        created_at=datetime.now(),
+        status=TaskStatus('pending'),
+        progress=0,
+        properties=properties
+    )
+    db.tasks.insert_one(task.mongo())
+
+    try:
+        chunks(task.id, dataset_id, properties)
+        pipeline = AugmentorPipeline(task.id, dataset_id, properties)
+        pipeline.operations = build_operations(properties.operations)
+
+        start = time.perf_counter()
+        stats = pipeline.sample(executor=executor, max_workers=max_workers)
+        elapsed = time.perf_counter() - start
+    finally:
+        delete_pipeline(dataset_id, derived_id(task.id, 'pipeline'))
+        recount_dataset(dataset_id)
+        db.tasks.delete_one({'_id': task.id})
+        db.notifications.delete_many({'task_id': task.id})
+    return elapsed, stats
+
+
+def benchmark(dataset_id, image_count=500, max_workers=None, executors=('thread', 'process')):
+    properties = TaskAugmentorProperties(image_count=image_count, operations=OPERATIONS)
+    results = {executor: _run(dataset_id, properties, executor, max_workers) for executor in executors}
+
+    for executor, (elapsed, stats) in results.items():
+        logger.notify('Benchmark', f'{executor:7} pool : {stats["stored"]} images in {elapsed:7.1f}s | '
+                                   f'{stats["stored"] / elapsed:.1f} images/sec | '
+                                   f'x{results[executors[0]][0] / elapsed:.2f} | '
+                                   f'{len(stats["errors"])} errors')
+    return results
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1], *[int(arg) for arg in sys.argv[2:4]])
@@ -0,0 +1,142 @@
+import hashlib
+import heapq
+import os
+import tempfile
+import threading
+import time
+from typing import Optional
+
+from config import Config
+
+RESCAN_INTERVAL = 60  # seconds between scans of the cache, picking up files of other processes
+
+
+class DownloadCache:
+    """
+    Downloaded images on disk, content addressed : `objects/<sha256>` holds a content, `refs/<key>` the hash
+    of the content downloaded for `key`, so that an image shared by several datasource files is stored once.
+    Least recently used objects are evicted once `max_bytes` is exceeded, with the refs unused since.
+    Shared by every process of the host : files are written to a temporary file, then renamed.
+    """
+
+    def __init__(self, path=None, max_bytes=None):
+        self.path = path or Config.DOWNLOADS_PATH
+        self.max_bytes = max_bytes or Config.GENERATOR_CACHE_MAX_BYTES
+        self.objects_path = os.path.join(self.path, 'objects')
+        self.refs_path = os.path.join(self.path, 'refs')
+        os.makedirs(self.objects_path, exist_ok=True)
+        os.makedirs(self.refs_path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._scan()
+
+    def _scan(self):
+        """
+        Index objects & refs by last use, in heaps : oldest first. Later uses are seen when entries are popped.
+        """
+        self._objects = [(entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                         for entry in os.scandir(self.objects_path)]
+        self._refs = [(entry.stat().st_mtime, entry.path) for entry in os.scandir(self.refs_path)]
+        heapq.heapify(self._objects)
+        heapq.heapify(self._refs)
+        self._indexed = {entry[-1]: entry[0] for entries in (self._objects, self._refs) for entry in entries}
+        self._size = sum(size for _, size, _ in self._objects)
+        self._scanned_at = time.monotonic()
+
+    def _index(self, entries, entry):
+        heapq.heappush(entries, entry)
+        self._indexed[entry[-1]] = entry[0]
+
+    def _write(self, path, content: bytes):
+        descriptor, temporary = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(descriptor, 'wb') as file:
+            file.write(content)
+        os.replace(temporary, path)
+
+    def get(self, key) -> Optional[bytes]:
+        ref_path = os.path.join(self.refs_path, key)
+        try:
+            with open(ref_path, 'r') as file:
+                object_path = os.path.join(self.objects_path, file.read())
+            with open(object_path, 'rb') as file:
+                content = file.read()
+            os.utime(object_path)  # recently used
+            os.utime(ref_path)
+        except FileNotFoundError:
+            return None
+        return content
+
+    def put(self, key, content: bytes) -> str:
+        """
+        Store `content` downloaded for `key`, returning its hash.
+        """
+        content_hash = hashlib.sha256(content).hexdigest()
+        object_path = os.path.join(self.objects_path, content_hash)
+        ref_path = os.path.join(self.refs_path, key)
+        if os.path.exists(object_path):
+            os.utime(object_path)
+        else:
+            self._write(object_path, content)
+            with self._lock:
+                self._index(self._objects, (os.stat(object_path).st_mtime, len(content), object_path))
+                self._size += len(content)
+        self._write(ref_path, content_hash.encode())
+        with self._lock:
+            self._index(self._refs, (os.stat(ref_path).st_mtime, ref_path))
+        if self._size > self.max_bytes:
+            self._evict()
+        return content_hash
+
+    def _pop_unused(self, entries, before=None):
+        """
+        Pop the least recently used entry of heap `entries`, last used before `before` if set. Entries used since
+        they were indexed are indexed again. None if there is none.
+        """
+        while entries and (before is None or entries[0][0] < before):
+            entry = heapq.heappop(entries)
+            path = entry[-1]
+            if self._indexed.get(path) != entry[0]:  # indexed again since
+                continue
+            try:
+                used_at = os.stat(path).st_mtime
+            except FileNotFoundError:  # removed by another process
+                used_at = entry[0]
+            if used_at > entry[0]:
+                self._index(entries, (used_at, *entry[1:]))
+                continue
+            del self._indexed[path]
+            return entry
+        return None
+
+    def _evict(self):
+        """
+        Remove least recently used objects until the cache is back under 90 % of `max_bytes`, then refs unused
+        since the last removed object was used. Objects are indexed in memory : the cache is scanned again at
+        most once per `RESCAN_INTERVAL`, or when the index runs out.
+        """
+        with self._lock:
+            if time.monotonic() - self._scanned_at > RESCAN_INTERVAL:
+                self._scan()
+            evicted_before = None
+            while self._size > 0.9 * self.max_bytes:
+                entry = self._pop_unused(self._objects)
+                if entry is None:
+                    if time.monotonic() - self._scanned_at < 1:
+                        break
+                    self._scan()
+                    continue
+                used_at, size, path = entry
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                self._size -= size
+                evicted_before = used_at
+
+            while evicted_before is not None:
+                entry = self._pop_unused(self._refs, before=evicted_before)
+                if entry is None:
+                    break
+                try:
+                    os.remove(entry[1])
+                except FileNotFoundError:
+                    pass
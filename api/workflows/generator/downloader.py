@@ -0,0 +1,134 @@
+import asyncio
+import math
+import random
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+import aiohttp
+
+from config import Config
+from logger import logger
+
+
+class DownloadError(Exception):
+    """
+    Raised by `Downloader.fetch` for a failure worth retrying.
+    """
+
+
+class Downloader:
+    """
+    Download remote images through one pooled `aiohttp` session, with at most `GENERATOR_HOST_CONCURRENCY`
+    requests per host at once. Each request has a timeout, and is retried with exponential backoff on
+    connection errors, timeouts, 429 & 5xx responses. Latency & failures of every host are recorded.
+    Use as an async context manager.
+    """
+
+    def __init__(self,
+                 host_concurrency=None,
+                 timeout=None,
+                 retries=None,
+                 backoff=None,
+                 hedge_delay=None):
+        self.host_concurrency = host_concurrency or Config.GENERATOR_HOST_CONCURRENCY
+        self.timeout = timeout or Config.GENERATOR_DOWNLOAD_TIMEOUT
+        self.retries = retries if retries is not None else Config.GENERATOR_DOWNLOAD_RETRIES
+        self.backoff = backoff if backoff is not None else Config.GENERATOR_DOWNLOAD_BACKOFF
+        self.hedge_delay = hedge_delay if hedge_delay is not None else Config.GENERATOR_HEDGE_DELAY
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._semaphores = defaultdict(lambda: asyncio.Semaphore(self.host_concurrency))
+        self._requests = defaultdict(int)
+        self._latencies = defaultdict(list)
+        self._failures = defaultdict(int)
+        self._wins = defaultdict(int)
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.host_concurrency, ttl_dns_cache=300)
+        self.session = aiohttp.ClientSession(connector=connector,
+                                             timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, *args):
+        await self.session.close()
+
+    async def _get(self, url) -> Optional[bytes]:
+        """
+        One attempt : the image, None when it does not exist, or DownloadError.
+        """
+        host = urlparse(url).netloc
+        async with self._semaphores[host]:
+            self._requests[host] += 1
+            start = time.perf_counter()
+            try:
+                async with self.session.get(url) as response:
+                    if response.status == 429 or response.status >= 500:
+                        raise DownloadError(f'{host} answered {response.status}')
+                    content = await response.read() if response.status == 200 else None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self._failures[host] += 1
+                raise DownloadError(f'{host} unreachable, {str(e) or type(e).__name__}')
+            except DownloadError:
+                self._failures[host] += 1
+                raise
+            self._latencies[host].append(time.perf_counter() - start)
+            if content is None:
+                self._failures[host] += 1
+            return content
+
+    async def fetch(self, url) -> Optional[bytes]:
+        if not url:
+            return None
+        for attempt in range(self.retries + 1):
+            try:
+                return await self._get(url)
+            except DownloadError as e:
+                if attempt == self.retries:
+                    logger.notify('Downloader', f'Download of {url} failed : {str(e)}', level='warning')
+                    return None
+                await asyncio.sleep(self.backoff * 2 ** attempt * (1 + random.random()))
+
+    async def fetch_any(self, urls: List[str]) -> Optional[bytes]:
+        """
+        Hedged download of mirrors of the same image : the next mirror is raced once the previous ones
+        did not answer within `GENERATOR_HEDGE_DELAY` seconds, or failed. First image downloaded wins,
+        other requests are cancelled.
+        """
+        mirrors = [url for url in urls if url]
+        hosts, pending = {}, set()
+        try:
+            while mirrors or pending:
+                if mirrors:
+                    url = mirrors.pop(0)
+                    task = asyncio.ensure_future(self.fetch(url))
+                    hosts[task] = urlparse(url).netloc
+                    pending.add(task)
+                done, pending = await asyncio.wait(pending,
+                                                   timeout=self.hedge_delay if mirrors else None,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    content = task.result()
+                    if content is not None:
+                        self._wins[hosts[task]] += 1
+                        return content
+            return None
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Per host : requests, failures, mirror races won, mean & 95th percentile latency in ms.
+        """
+        stats = {}
+        for host, requests in self._requests.items():
+            latencies = sorted(self._latencies[host])
+            stats[host] = {
+                'requests': requests,
+                'failures': self._failures[host],
+                'wins': self._wins[host],
+                'latency_mean': round(1000 * sum(latencies) / len(latencies), 1) if latencies else 0,
+                'latency_p95': round(1000 * latencies[math.ceil(0.95 * len(latencies)) - 1], 1) if latencies else 0
+            }
+        return stats
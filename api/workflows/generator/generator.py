@@ -1,21 +1,28 @@
+import asyncio
 import concurrent.futures
-import json
-import os
+from collections import Counter
 from datetime import datetime
-from time import sleep
+from typing import List, Optional, Tuple
 from uuid import uuid4
 
-import requests
+import cv2
+import numpy
+from pymongo import UpdateOne
 
 import errors
 from config import Config
+from logger import logger
+from routers.datasets.core import recount_dataset
 from routers.datasets.models import Dataset
-from routers.datasources.core import download_annotations
-from routers.images.core import allowed_file, upload_image
-from routers.labels.core import regroup_labels_by_category
-from routers.labels.models import Label
+from routers.datasources.core import download_annotations, annotations_files
+from routers.datasources.index import DatasourceIndex, load_index
+from routers.images.core import allowed_file, upload_image, upload_renditions
+from routers.images.ingest import dhash, encode_renditions
 from routers.tasks.models import TaskGeneratorProperties
-from utils import update_task, increment_task_progress
+from utils import update_task, derived_id, BulkWriter, Checkpoint
+from workflows.generator.cache import DownloadCache
+from workflows.generator.downloader import Downloader
+from workflows.generator.mirror import LocalMirror
 
 db = Config.db
 
@@ -23,84 +30,167 @@ db = Config.db
 # TODO : refactor this (use models)
 
 
-def _download_image(image_url):
-    try:
-        response = requests.get(image_url)
-        if response.status_code != 200:
-            return
-        return response
-    except requests.exceptions.ConnectionError:
-        return
-
-
-def _process_image(args):
-    task_id = args['task_id']
+def _store_image(args, image_bytes, size=None):
+    index = args['index']
+    checkpoint = args['checkpoint']
+    writer = checkpoint.writer
     dataset_id = args['dataset_id']
     image_remote_dataset = args['image_remote_dataset']
-    image_count = args['image_count']
-    category_labels = args['category_labels']
-    categories = args['categories']
+    boxes = args['boxes']
+    category_ids = args['category_ids']
     filename = image_remote_dataset['file_name']
-    if filename and allowed_file(filename):
-        image_id = str(uuid4())
-        response = _download_image(image_remote_dataset['flickr_url'])
-        if not response:
-            response = _download_image(image_remote_dataset['coco_url'])
-        if not response:
-            return
-        image_bytes = response.content
-        path = upload_image(image_bytes, image_id)
+    width, height = size or (image_remote_dataset['width'], image_remote_dataset['height'])
+    if image_bytes is not None:
+        # Same ids on every attempt of this task
+        image_id = derived_id(dataset_id, image_remote_dataset['id'])
+        path = upload_image(image_bytes, image_id, deduplicate=True)
+        pixels = cv2.imdecode(numpy.frombuffer(image_bytes, numpy.uint8), cv2.IMREAD_COLOR)
+        renditions = {}
+        if pixels is not None:
+            renditions = encode_renditions(pixels, Config.IMAGE_RENDITIONS, Config.IMAGE_RENDITIONS_FORMAT)
         saved_image = {
             '_id': image_id,
             'dataset_id': dataset_id,
             'path': path,
             'name': str(filename),
             'size': len(image_bytes),
-            'width': image_remote_dataset['width'],
-            'height': image_remote_dataset['height']
+            'width': width,
+            'height': height,
+            'renditions': upload_renditions(renditions, path, deduplicate=True)
         }
+        if pixels is not None:
+            saved_image['dhash'] = dhash(pixels)
         labels = [{
-            '_id': str(uuid4()),
+            '_id': derived_id(image_id, position),
             'image_id': image_id,
-            'x': category_label['bbox'][0] / image_remote_dataset['width'],
-            'y': category_label['bbox'][1] / image_remote_dataset['height'],
-            'w': category_label['bbox'][2] / image_remote_dataset['width'],
-            'h': category_label['bbox'][3] / image_remote_dataset['height'],
-            'category_id': category_label['category_id']
-        } for category_label in category_labels]
-        saved_categories = []
-        for label in labels:
-            category = [category for category in categories
-                        if category['_internal_id'] == label['category_id']][0]
-            label['category_id'] = category['_id']
-
-            if category['name'] not in [saved_category['name'] for saved_category in saved_categories]:
-                saved_categories.append(category)
-
-        db.images.insert_one(saved_image)
-        db.labels.insert_many(labels)
-        labels = [Label.from_mongo(label) for label in labels]
-        for category_id, labels_count in regroup_labels_by_category(labels).items():
-            db.categories.find_one_and_update(
-                {'_id': category_id},
-                {'$inc': {'labels_count': labels_count}}
-            )
-        increment_task_progress(task_id, 1 / image_count)
-
-
-def _filter_annotations(json_remote_dataset, selected_categories, image_count=None):
-    categories_remote = [category for category in json_remote_dataset['categories']
-                         if category['name'] in selected_categories]
-    category_ids = [category['id'] for category in categories_remote]
-
-    labels_remote = [label for label in json_remote_dataset['annotations']
-                     if label['category_id'] in category_ids]
-    label_ids = [label['image_id'] for label in labels_remote]
-
-    images_remote = [image for image in json_remote_dataset['images'] if image['id'] in label_ids]
-    if image_count:
-        images_remote = images_remote[:image_count]
-    return images_remote, categories_remote, labels_remote
+            'x': x,
+            'y': y,
+            'w': w,
+            'h': h,
+            'category_id': category_id
+        } for position, ((x, y, w, h), category_id) in enumerate(zip(boxes.tolist(), category_ids))]
+
+        if checkpoint.resumed:
+            writer.replace_one('images', saved_image)
+            writer.delete_many('labels', {'image_id': image_id})
+        else:
+            writer.insert_one('images', saved_image)
+        writer.insert_many('labels', labels)
+        for category_id, labels_count in Counter(category_ids).items():
+            writer.increment('categories', category_id, 'labels_count', labels_count)
+    checkpoint.add(index)
+
+
+async def _process_images(images, cache: DownloadCache, mirror: Optional[LocalMirror] = None) -> Tuple[dict, dict]:
+    """
+    Download images concurrently, hedging flickr & coco mirrors, and store each one in a thread pool once downloaded.
+    Images already in `cache` are not downloaded again. With a local `mirror`, images are read from it instead.
+    `GENERATOR_MAX_DOWNLOADS` workers take images from a bounded queue : at most as many images are downloaded
+    or waiting for storage at once, and as many coroutines exist, whatever the count of images.
+    Returns download stats of each host, and cache stats.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=Config.GENERATOR_MAX_DOWNLOADS)
+    failures = []
+    cache_stats = {'hits': 0, 'misses': 0}
+
+    async with Downloader() as downloader:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=Config.GENERATOR_MAX_DOWNLOADS) as executor:
+            async def fetch(image_remote_dataset, cache_key):
+                if mirror is not None:
+                    return await loop.run_in_executor(executor, mirror.read, image_remote_dataset['file_name'])
+                image_bytes = await loop.run_in_executor(executor, cache.get, cache_key)
+                if image_bytes is not None:
+                    cache_stats['hits'] += 1
+                else:
+                    cache_stats['misses'] += 1
+                    image_bytes = await downloader.fetch_any([image_remote_dataset['flickr_url'],
+                                                              image_remote_dataset['coco_url']])
+                    if image_bytes is not None:
+                        await loop.run_in_executor(executor, cache.put, cache_key, image_bytes)
+                return image_bytes, None
+
+            async def process(args):
+                image_remote_dataset = args['image_remote_dataset']
+                image_bytes, size = None, None
+                if image_remote_dataset['file_name'] and allowed_file(image_remote_dataset['file_name']):
+                    image_bytes, size = await fetch(image_remote_dataset, args['cache_key'])
+                await loop.run_in_executor(executor, _store_image, args, image_bytes, size)
+
+            async def work():
+                while True:
+                    args = await queue.get()
+                    if args is None:
+                        return
+                    try:
+                        await process(args)
+                    except Exception as e:
+                        failures.append(e)
+
+            workers = [asyncio.create_task(work()) for _ in range(Config.GENERATOR_MAX_DOWNLOADS)]
+            try:
+                for args in images:
+                    await queue.put(args)
+                for _ in workers:
+                    await queue.put(None)
+                await asyncio.gather(*workers)
+            finally:
+                for worker in workers:
+                    worker.cancel()
+
+    if failures:
+        raise errors.InternalError('Generator', f'{len(failures)} of {len(images)} images could not be stored : '
+                                                f'{str(failures[0])}')
+    total = cache_stats['hits'] + cache_stats['misses']
+    cache_stats['hit_rate'] = round(cache_stats['hits'] / total, 4) if total else 0
+    return (mirror.stats() if mirror is not None else downloader.stats()), cache_stats
+
+
+def _filter_annotations(index: DatasourceIndex, categories, image_count=None) -> List[dict]:
+    """
+    First `image_count` images of the datasource with labels of `categories`, each with its labels :
+    normalised `boxes` & dataset `category_ids`. Labels are grouped by image once, their categories remapped
+    through a lookup table, and all boxes normalised with one array operation.
+    """
+    internal_ids = numpy.array([category['_internal_id'] for category in categories], dtype=numpy.int64)
+    selected = numpy.isin(index.label_category_ids, internal_ids)
+    label_image_ids = index.label_image_ids[selected]  # sorted by image id
+    label_bboxes = index.label_bboxes[selected]
+
+    lookup = numpy.full(int(internal_ids.max(initial=0)) + 1, -1, dtype=numpy.int64)
+    lookup[internal_ids] = numpy.arange(len(categories))
+    category_ids = [category['_id'] for category in categories]
+    label_category_ids = [category_ids[position] for position in lookup[index.label_category_ids[selected]].tolist()]
+
+    positions = numpy.flatnonzero(numpy.isin(index.image_ids, label_image_ids))
+    sizes = numpy.stack([index.image_widths[positions], index.image_heights[positions]] * 2, axis=1)
+    order = numpy.argsort(index.image_ids[positions])
+    boxes = label_bboxes / sizes[order[numpy.searchsorted(index.image_ids[positions], label_image_ids, sorter=order)]]
+
+    positions = positions[:image_count or None]
+    image_ids = index.image_ids[positions]
+    starts = numpy.searchsorted(label_image_ids, image_ids, side='left').tolist()
+    ends = numpy.searchsorted(label_image_ids, image_ids, side='right').tolist()
+
+    columns = zip(image_ids.tolist(), sizes[:len(positions)].tolist(), starts, ends,
+                  index.image_file_names[positions].tolist(),
+                  index.image_flickr_urls[positions].tolist(),
+                  index.image_coco_urls[positions].tolist())
+    images = []
+    for image_id, (width, height, _, _), start, end, file_name, flickr_url, coco_url in columns:
+        images.append({
+            'image_remote_dataset': {
+                'id': image_id,
+                'file_name': file_name.decode(),
+                'width': width,
+                'height': height,
+                'flickr_url': flickr_url.decode(),
+                'coco_url': coco_url.decode()
+            },
+            'boxes': boxes[start:end],
+            'category_ids': label_category_ids[start:end]
+        })
+    return images
 
 
 def _generate_dataset_name(categories):
@@ -109,12 +199,22 @@ def _generate_dataset_name(categories):
     return dataset_name.title()
 
 
-def main(user_id, task_id, properties: TaskGeneratorProperties):
+def main(user_id, task_id, properties: TaskGeneratorProperties, redelivered=False):
+    """
+    Store the images of the datasource with labels of the selected categories in a new dataset.
+    A `redelivered` task, or a failed one run again, keeps the dataset of its previous attempt & resumes from its
+    checkpoint : documents written since its last save are replaced.
+    """
     datasource_key = properties.datasource_key
     selected_categories = properties.selected_categories
     image_count = properties.image_count
 
-    dataset_id = str(uuid4())
+    # A resumed task keeps the dataset of its previous attempt
+    task = db.tasks.find_one({'_id': task_id}, {'dataset_id': 1})
+    dataset_id = task.get('dataset_id') if task else None
+    resumed = redelivered or dataset_id is not None
+    if dataset_id is None:
+        dataset_id = str(uuid4())
     update_task(task_id, dataset_id=dataset_id, status='active')
 
     try:
@@ -124,26 +224,17 @@ def main(user_id, task_id, properties: TaskGeneratorProperties):
 
     datasource = [datasource for datasource in Config.DATASOURCES if datasource['key'] == datasource_key][0]
 
-    # TODO : use multiple filenames
-    filename = datasource['filenames'][0]
-
-    annotations_path = os.path.join(Config.DATASOURCES_PATH, datasource_key, 'annotations')
-    json_file = open(os.path.join(annotations_path, filename), 'r')
-    json_remote_dataset = json.load(json_file)
-    json_file.close()
-
-    images_remote, categories_remote, labels_remote = _filter_annotations(json_remote_dataset,
-                                                                          selected_categories,
-                                                                          image_count)
-    del json_remote_dataset
+    index = load_index(annotations_files(datasource_key))
+    categories_remote = [category for category in index.categories if category['name'] in selected_categories]
 
     categories = [{
-        '_id': str(uuid4()),
+        '_id': derived_id(dataset_id, category['id']),
         '_internal_id': category['id'],
         'dataset_id': dataset_id,
         'name': category['name'],
         'supercategory': category['supercategory']
     } for category in categories_remote]
+    images_remote = _filter_annotations(index, categories, image_count)
 
     dataset = Dataset(id=dataset_id,
                       user_id=user_id,
@@ -153,26 +244,34 @@ def main(user_id, task_id, properties: TaskGeneratorProperties):
                       image_count=image_count,
                       augmented_count=0,
                       is_public=True)
-    db.datasets.insert_one(dataset.mongo())
-    db.categories.insert_many([{
-        '_id': category['_id'],
+    db.datasets.update_one({'_id': dataset_id}, {'$setOnInsert': dataset.mongo(exclude={'id'})}, upsert=True)
+    db.categories.bulk_write([UpdateOne({'_id': category['_id']}, {'$setOnInsert': {
         'dataset_id': category['dataset_id'],
         'name': category['name'],
         'supercategory': category['supercategory'],
         'labels_count': 0
-    } for category in categories])
-
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        executor.map(_process_image,
-                     ({'task_id': task_id,
-                       'dataset_id': dataset_id,
-                       'image_remote_dataset': image,
-                       'image_count': image_count,
-                       'category_labels': [el for el in labels_remote if el['image_id'] == image['id']],
-                       'categories': categories}
-                      for image in images_remote))
-
-    sleep(1)
-
-    image_count = db.images.count({'dataset_id': dataset_id})
-    db.datasets.find_one_and_update({'_id': dataset_id}, {'$set': {'image_count': image_count}})
+    }}, upsert=True) for category in categories])
+
+    mirror = None
+    if datasource.get('images_path'):
+        mirror = LocalMirror(datasource['images_path'], datasource.get('images_folders'))
+
+    with BulkWriter() as writer:
+        checkpoint = Checkpoint(task_id, len(images_remote), writer, redelivered=resumed)
+        downloads, cache_stats = asyncio.run(_process_images(
+            [{'index': index,
+              'checkpoint': checkpoint,
+              'dataset_id': dataset_id,
+              'cache_key': f"{datasource_key}-{image['image_remote_dataset']['id']}",
+              **image}
+             for index, image in enumerate(images_remote) if index not in checkpoint.done],
+            DownloadCache(),
+            mirror))
+        checkpoint.save()
+
+    update_task(task_id, downloads=downloads, cache=cache_stats)
+    for host, stats in downloads.items():
+        logger.notify('Generator', f'{host} : {stats["requests"]} requests, {stats["failures"]} failures, '
+                                   f'{stats["wins"]} images, latency {stats["latency_mean"]} ms '
+                                   f'(p95 {stats["latency_p95"]} ms)')
+    recount_dataset(dataset_id)
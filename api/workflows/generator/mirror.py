@@ -0,0 +1,74 @@
+import math
+import mmap
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy
+
+from config import Config
+from routers.images.ingest import compress_image
+
+
+class LocalMirror:
+    """
+    Images of a datasource already on a local volume : `<images_path>/<folder>/<file_name>`, for each folder of
+    `images_folders`. Files are memory mapped, and resized with `compress_image` when `compress` is set, instead of
+    being downloaded. Thread safe.
+    """
+
+    def __init__(self, images_path, images_folders: List[str] = None, compress=None):
+        self.images_path = images_path
+        self.images_folders = images_folders or ['']
+        self.compress = compress if compress is not None else Config.GENERATOR_MIRROR_COMPRESS
+        self._lock = threading.Lock()
+        self._latencies = []
+        self._failures = 0
+
+    def _find(self, file_name) -> Optional[str]:
+        for folder in self.images_folders:
+            path = os.path.join(self.images_path, folder, file_name)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def _read(self, path) -> Tuple[bytes, Optional[Tuple[int, int]]]:
+        with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if not self.compress:
+                return mapped[:], None
+            image = cv2.imdecode(numpy.frombuffer(mapped, numpy.uint8), cv2.IMREAD_COLOR)
+            if image is None:
+                return mapped[:], None
+            resized = compress_image(image)
+            if resized is image:  # small enough, uploaded as is
+                return mapped[:], None
+            return cv2.imencode('.jpg', resized)[1].tobytes(), (resized.shape[1], resized.shape[0])
+
+    def read(self, file_name) -> Tuple[Optional[bytes], Optional[Tuple[int, int]]]:
+        """
+        Content of image `file_name`, None when missing from the mirror, with its (width, height) once compressed.
+        """
+        start = time.perf_counter()
+        path = self._find(file_name)
+        result = self._read(path) if path else (None, None)
+        with self._lock:
+            if path:
+                self._latencies.append(time.perf_counter() - start)
+            else:
+                self._failures += 1
+        return result
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Same stats as `Downloader.stats`, mirror being the only host.
+        """
+        latencies = sorted(self._latencies)
+        return {'local': {
+            'requests': len(latencies) + self._failures,
+            'failures': self._failures,
+            'wins': len(latencies),
+            'latency_mean': round(1000 * sum(latencies) / len(latencies), 1) if latencies else 0,
+            'latency_p95': round(1000 * latencies[math.ceil(0.95 * len(latencies)) - 1], 1) if latencies else 0
+        }}
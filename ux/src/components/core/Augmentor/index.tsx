@@ -201,10 +201,10 @@ const Augmentor: FC<AugmentorProps> = ({open, handleClose}) => {
                                         </Typography>
 
                                         <PipelineSample
-                                            handler={operations =>
-                                                api.post<{images: string[]; images_labels: Label[][]}>(
+                                            handler={(operations, seed) =>
+                                                api.post<{images: string[]; images_labels: Label[][]; seed: number}>(
                                                     `/datasets/${dataset.id}/pipelines/sample`,
-                                                    {operations}
+                                                    {operations, seed}
                                                 )
                                             }
                                         />
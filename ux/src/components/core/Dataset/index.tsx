@@ -137,7 +137,8 @@ const DTDataset: FC<DatasetProps> = ({className, images = null, onClick, disable
             const response = await api.get<{images: Image[]}>(`/datasets/${dataset.id}/images/`, {
                 params: {
                     include_labels: true,
-                    limit: 1
+                    limit: 1,
+                    rendition: 'preview'
                 }
             });
             setImagesPreview(response.data.images);
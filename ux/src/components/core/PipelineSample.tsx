@@ -1,4 +1,4 @@
-import React, {FC, useCallback, useState} from 'react';
+import React, {FC, useCallback, useRef, useState} from 'react';
 import {AxiosResponse} from 'axios';
 import {useSnackbar} from 'notistack';
 import {Formik} from 'formik';
@@ -19,7 +19,7 @@ import useImages from 'src/hooks/useImages';
 import SubmitFormikOnRender from 'src/components/utils/SubmitFormikOnRender';
 
 interface PipelineSampleProps {
-    handler: (operations: Operation[]) => Promise<AxiosResponse>;
+    handler: (operations: Operation[], seed?: number | null) => Promise<AxiosResponse>;
     className?: string;
 }
 
@@ -45,6 +45,9 @@ const PipelineSample: FC<PipelineSampleProps> = ({handler, className}) => {
     const [imagesBase64, setImagesBase64] = useState<string[]>([]);
     const [imagesLabels, setImagesLabels] = useState<Label[][]>([]);
 
+    // Kept while operations are tweaked, so that an already computed configuration is served from cache
+    const seed = useRef<number | null>(null);
+
     const doSample = useCallback(async () => {
         setImagesBase64([]);
         setImagesLabels([]);
@@ -55,8 +58,9 @@ const PipelineSample: FC<PipelineSampleProps> = ({handler, className}) => {
             try {
                 await wait(10);
 
-                const response = await handler(operations);
+                const response = await handler(operations, seed.current);
 
+                seed.current = response.data.seed ?? null;
                 setImagesBase64(response.data.images);
                 setImagesLabels(response.data.images_labels);
             } catch (error) {
@@ -128,6 +132,9 @@ const PipelineSample: FC<PipelineSampleProps> = ({handler, className}) => {
                                 size="small"
                                 type="submit"
                                 disabled={isSubmitting}
+                                onClick={() => {
+                                    seed.current = null;
+                                }}
                                 endIcon={
                                     isSubmitting
                                         ? <CircularProgress className={classes.loader} color="inherit" />
@@ -55,7 +55,8 @@ export const ImagesProvider: FC<ImagesProviderProps> = ({children, original_imag
                     params: {
                         include_labels: true,
                         offset: currentOffset,
-                        limit: LAZY_LOAD_BATCH
+                        limit: LAZY_LOAD_BATCH,
+                        rendition: 'preview'
                     }
                 });
                 setTotalImagesCount(response.data.total_count);
@@ -66,7 +67,8 @@ export const ImagesProvider: FC<ImagesProviderProps> = ({children, original_imag
                         offset: currentOffset,
                         limit: LAZY_LOAD_BATCH,
                         original_image_id,
-                        include_labels: true
+                        include_labels: true,
+                        rendition: 'preview'
                     }
                 });
                 setTotalImagesCount(null);
@@ -11,5 +11,9 @@ export interface Image {
     height: number;
     pipeline_id?: string;
     original_image_id?: string;
+    seed?: number;
+    is_virtual?: boolean;
+    renditions?: Record<string, string>;
+    duplicate_of?: string;
     labels?: Label[];
 }
@@ -10,10 +10,21 @@ export interface TaskGeneratorProperties {
 
 export interface TaskAugmentorProperties {
     image_count: number;
+    virtual?: boolean;
+    backend?: 'augmentor' | 'opencv';
+    jpeg_quality?: number;
+    jpeg_progressive?: boolean;
+    jpeg_optimize?: boolean;
 }
 
 export type TaskProperties = TaskGeneratorProperties | TaskAugmentorProperties;
 
+export interface TaskCacheStats {
+    hits: number;
+    misses: number;
+    hit_rate: number;
+}
+
 export interface Task {
     id: string;
     user_id: string;
@@ -25,4 +36,8 @@ export interface Task {
     progress: number;
     ended_at?: string;
     error?: string;
+    cache?: TaskCacheStats;
+    throughput?: Record<string, number>;
+    checkpoint?: number[][];
+    downloads?: Record<string, Record<string, number>>;
 }